@@ -0,0 +1,75 @@
+from djutils.dashboard.provider import PanelProvider
+from djutils.dashboard.registry import registry
+from djutils.queue.metrics import percentile
+from djutils.queue.queue import get_invokers
+from djutils.queue.registry import registry as command_registry
+
+
+def get_queue_totals():
+    """
+    Add up the queue metrics of every registered command, over the default
+    queue and every named queue, for the last complete minute
+    """
+    totals = {'enqueued': 0, 'executed': 0, 'failed': 0, 'waited': 0,
+              'wait_ms': 0, 'exec_ms': 0, 'wait': None, 'exec': None}
+    
+    command_names = command_registry.get_command_names()
+    for invoker in get_invokers():
+        minute = invoker.metrics.get_minute(command_names)
+        for command_totals in minute.values():
+            for field, value in command_totals.items():
+                if isinstance(value, list):
+                    if totals[field] is None:
+                        totals[field] = value
+                    else:
+                        totals[field] = map(sum, zip(totals[field], value))
+                else:
+                    totals[field] += value
+    
+    return totals
+
+def get_queue_depth():
+    return sum([len(invoker.queue) for invoker in get_invokers()])
+
+
+class QueueThroughputPanel(PanelProvider):
+    """
+    The number of commands enqueued, executed and failed in the last minute,
+    and the number of messages waiting in all of the queues
+    """
+    def get_title(self):
+        return 'Queue throughput'
+    
+    def get_data(self):
+        totals = get_queue_totals()
+        return {
+            'enqueued': totals['enqueued'],
+            'executed': totals['executed'],
+            'failed': totals['failed'],
+            'depth': get_queue_depth(),
+        }
+
+
+class QueueLatencyPanel(PanelProvider):
+    """
+    The average and 95th percentile time, in milliseconds, that commands
+    executed in the last minute spent in the queue and executing
+    """
+    def get_title(self):
+        return 'Queue latency'
+    
+    def get_data(self):
+        totals = get_queue_totals()
+        data = {}
+        for field, count in (('wait', totals['waited']), ('exec', totals['executed'])):
+            if count:
+                data['%s_avg_ms' % field] = totals['%s_ms' % field] / count
+                data['%s_p95_ms' % field] = percentile(totals[field], 95)
+            else:
+                data['%s_avg_ms' % field] = 0
+                data['%s_p95_ms' % field] = 0
+        return data
+
+
+registry.register(QueueThroughputPanel)
+registry.register(QueueLatencyPanel)
@@ -2,6 +2,8 @@ import datetime
 
 from django.db import models
 
+from djutils.queue.constants import PRIORITY_NORMAL
+
 
 class QueueMessage(models.Model):
     """
@@ -11,6 +13,40 @@ class QueueMessage(models.Model):
     queue = models.CharField(max_length=255)
     message = models.TextField()
     created = models.DateTimeField(default=datetime.datetime.now, db_index=True)
+    priority = models.IntegerField(default=PRIORITY_NORMAL, db_index=True)
+    
+    # messages with an eta are not read until the consumer promotes them
+    scheduled_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    
+    # token written by a consumer when it claims the message for processing
+    claim = models.CharField(max_length=32, null=True, blank=True, db_index=True)
+    
+    # reserved messages become visible again once this time has passed
+    claimed_until = models.DateTimeField(null=True, blank=True, db_index=True)
+    
+    class Meta:
+        ordering = ('-priority', 'created', 'id') # FIFO queue within each priority
+
+
+class QueueResult(models.Model):
+    """
+    The model used for storing the results of executed QueueCommands, used by
+    the :module:`djutils.queue.results.DatabaseResultStore`
+    """
+    task_id = models.CharField(max_length=32, unique=True)
+    result = models.TextField()
+    expires = models.DateTimeField(db_index=True)
+
+
+class QueueUniqueKey(models.Model):
+    """
+    Records the task that claimed a unique command's key, used by the
+    :module:`djutils.queue.backends.database.DatabaseQueue`
+    """
+    queue = models.CharField(max_length=255)
+    key = models.CharField(max_length=40)
+    task_id = models.CharField(max_length=32)
+    expires = models.DateTimeField(db_index=True)
     
     class Meta:
-        ordering = ('created',) # FIFO queue
+        unique_together = (('queue', 'key'),)
@@ -1,9 +1,27 @@
+import time
+
+from django.core.cache import cache
+
+from djutils.queue.constants import PRIORITY_NORMAL
+from djutils.queue.exceptions import QueueException
+
+
 class BaseQueue(object):
     """
     Base implementation for a Queue, all backends should subclass
     """
+    # whether reads wait for a message to be written, blocking backends
+    # accept a timeout as the second argument to read_many
     blocking = False
     
+    # whether messages may contain arbitrary bytes, otherwise binary payloads
+    # are base64-encoded so they can be stored as text
+    binary = False
+    
+    # whether reserve_many hides messages until they are acknowledged, rather
+    # than simply reading them
+    reserves = False
+    
     def __init__(self, name, connection):
         """
         Initialize the Queue - this happens once when the module is loaded
@@ -11,12 +29,36 @@ class BaseQueue(object):
         self.name = name
         self.connection = connection
     
-    def write(self, data):
+    def write(self, data, priority=PRIORITY_NORMAL):
         """
-        Push 'data' onto the queue
+        Push 'data' onto the queue.  Messages with a higher priority are
+        read before those with a lower priority
         """
         raise NotImplementedError
     
+    def write_many(self, messages, priority=PRIORITY_NORMAL):
+        """
+        Push a list of messages onto the queue, preserving their order.  The
+        default implementation simply calls :meth:`write` for each message,
+        backends should override this to batch the writes where possible
+        """
+        for data in messages:
+            self.write(data, priority)
+    
+    def schedule(self, data, eta, priority=PRIORITY_NORMAL):
+        """
+        Store 'data' so that it is not read from the queue until it has been
+        promoted by :meth:`promote` at or after the datetime 'eta'
+        """
+        raise QueueException, '%s does not support scheduling' % type(self).__name__
+    
+    def promote(self, now, limit):
+        """
+        Move up to 'limit' scheduled messages whose eta is at or before 'now'
+        onto the queue, returning the number of messages moved
+        """
+        return 0
+    
     def read(self):
         """
         Pop 'data' from the queue, returning None if no data is available --
@@ -24,6 +66,92 @@ class BaseQueue(object):
         """
         raise NotImplementedError
     
+    def read_many(self, n):
+        """
+        Pop up to 'n' messages from the queue, returning a (possibly empty)
+        list.  The default implementation calls :meth:`read` until the queue
+        is empty, backends should override this to batch the reads
+        """
+        messages = []
+        while len(messages) < n:
+            data = self.read()
+            if not data:
+                break
+            messages.append(data)
+        return messages
+    
+    def reserve_many(self, n, timeout):
+        """
+        Like :meth:`read_many`, but the messages are only hidden from other
+        readers rather than removed.  Each message must be passed to
+        :meth:`ack` once it has been processed, otherwise it becomes visible
+        again after 'timeout' seconds.  The default implementation offers no
+        such guarantee and simply reads the messages
+        """
+        return self.read_many(n)
+    
+    def ack(self, data):
+        """
+        Permanently remove a message returned by :meth:`reserve_many`
+        """
+        pass
+    
+    def requeue_expired(self, now):
+        """
+        Make reserved messages whose timeout expired at or before 'now'
+        visible again, returning the number of messages requeued
+        """
+        return 0
+    
+    def wait(self, timeout):
+        """
+        Block until a message may have been written to the queue or 'timeout'
+        seconds have passed, returning whether the queue was woken before
+        the timeout.  The default implementation simply sleeps
+        """
+        time.sleep(timeout)
+        return False
+    
+    def start_consumer(self, invoker):
+        """
+        Called when the invoker creates the queue, backends that execute
+        messages within the process start their workers here
+        """
+        pass
+    
+    def sync(self):
+        """
+        Called periodically by the consumer, backends that batch their writes
+        to disk flush them here
+        """
+        pass
+    
+    def claim_unique(self, key, task_id, timeout):
+        """
+        Atomically associate 'key' with 'task_id' for 'timeout' seconds unless
+        another task already holds it, returning the id of the task holding
+        the key.  The default implementation uses django's cache
+        """
+        cache_key = 'djutils.queue.%s.unique.%s' % (self.name, key)
+        if cache.add(cache_key, task_id, timeout):
+            return task_id
+        return cache.get(cache_key)
+    
+    def acquire_lease(self, key, owner, timeout):
+        """
+        Acquire the lease on 'key' for 'owner', or renew it if 'owner' already
+        holds it, so that it expires in 'timeout' seconds.  Returns whether
+        'owner' holds the lease.  The default implementation uses django's
+        cache, where renewing is not atomic
+        """
+        cache_key = 'djutils.queue.%s.lease.%s' % (self.name, key)
+        if cache.add(cache_key, owner, timeout):
+            return True
+        if cache.get(cache_key) == owner:
+            cache.set(cache_key, owner, timeout)
+            return True
+        return False
+    
     def flush(self):
         """
         Delete everything from the queue
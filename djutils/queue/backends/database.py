@@ -1,7 +1,60 @@
-from django.db import DatabaseError
+import datetime
+import select
+import socket
+import uuid
+import zlib
 
-from djutils.models import QueueMessage
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError, IntegrityError
+
+from djutils.models import QueueMessage, QueueUniqueKey
 from djutils.queue.backends.base import BaseQueue
+from djutils.queue.constants import PRIORITY_NORMAL
+
+
+class PostgresListener(object):
+    """
+    Waits for notifications sent with NOTIFY, using a connection of its own
+    in autocommit mode so notifications are delivered as soon as they arrive
+    """
+    def __init__(self, channel):
+        self.db = type(connection)(connection.settings_dict, connection.alias)
+        cursor = self.db.cursor()
+        self.db.connection.set_isolation_level(0)
+        cursor.execute('LISTEN %s' % connection.ops.quote_name(channel))
+    
+    def wait(self, timeout):
+        conn = self.db.connection
+        conn.poll()
+        if not conn.notifies and select.select([conn], [], [], timeout)[0]:
+            conn.poll()
+        
+        notified = bool(conn.notifies)
+        del conn.notifies[:]
+        return notified
+
+
+class SocketListener(object):
+    """
+    Waits for datagrams sent to a port on localhost, for databases that have
+    no notification mechanism of their own
+    """
+    def __init__(self, address):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(address)
+        self.sock.setblocking(0)
+    
+    def wait(self, timeout):
+        if not select.select([self.sock], [], [], timeout)[0]:
+            return False
+        
+        # any number of writes only need to wake the consumer once
+        try:
+            while True:
+                self.sock.recv(64)
+        except socket.error:
+            pass
+        return True
 
 
 class DatabaseQueue(BaseQueue):
@@ -9,27 +62,304 @@ class DatabaseQueue(BaseQueue):
     A simple Queue that uses the database for persistence, good for basic
     use-cases such as sending emails
     """
+    # number of rows to insert per statement when writing in bulk -- sqlite
+    # limits the number of parameters allowed in a single query to 999
+    insert_chunk_size = 200
+    
+    reserves = True
+    
+    def __init__(self, name, connection):
+        super(DatabaseQueue, self).__init__(name, connection)
+        
+        # maps reserved messages to the (pk, claim token) of their row
+        self._reserved = {}
+        
+        # consumers are woken when messages are written, with LISTEN/NOTIFY on
+        # postgresql or a datagram sent to a port on localhost otherwise
+        self.notifications = getattr(settings, 'QUEUE_NOTIFY', True)
+        self.channel = ('djutils.queue.%s' % name)[:63]
+        self.notify_address = ('127.0.0.1', 20000 + zlib.crc32(name) % 10000)
+        self._listener = None
+        self._notify_socket = None
     
     def _get_queryset(self):
         return QueueMessage.objects.filter(queue=self.name)
     
-    def write(self, data):
-        QueueMessage.objects.create(queue=self.name, message=data)
+    def _get_ready_queryset(self):
+        return self._get_queryset().filter(scheduled_at__isnull=True)
+    
+    def write(self, data, priority=PRIORITY_NORMAL):
+        QueueMessage.objects.create(queue=self.name, message=data, priority=priority)
+        self.notify()
+    
+    def write_many(self, messages, priority=PRIORITY_NORMAL):
+        """
+        Insert the messages using a multi-row INSERT rather than issuing one
+        query per message
+        """
+        if not messages:
+            return
+        
+        opts = QueueMessage._meta
+        fields = [opts.get_field(name) for name in ('queue', 'message', 'created', 'priority')]
+        
+        created = fields[2].get_db_prep_save(datetime.datetime.now(), connection=connection)
+        
+        sql = 'INSERT INTO %s (%s) VALUES ' % (
+            connection.ops.quote_name(opts.db_table),
+            ', '.join([connection.ops.quote_name(f.column) for f in fields]),
+        )
+        
+        cursor = connection.cursor()
+        
+        for i in range(0, len(messages), self.insert_chunk_size):
+            chunk = messages[i:i + self.insert_chunk_size]
+            params = []
+            for data in chunk:
+                params.extend((self.name, data, created, priority))
+            
+            cursor.execute(sql + ', '.join(['(%s, %s, %s, %s)'] * len(chunk)), params)
+        
+        transaction.commit_unless_managed()
+        self.notify()
+    
+    def schedule(self, data, eta, priority=PRIORITY_NORMAL):
+        QueueMessage.objects.create(
+            queue=self.name,
+            message=data,
+            priority=priority,
+            scheduled_at=eta,
+        )
+    
+    def promote(self, now, limit):
+        """
+        Clear the eta of due messages, making them visible to readers
+        """
+        due = self._get_queryset().filter(scheduled_at__lte=now)
+        pks = list(due.order_by('scheduled_at').values_list('pk', flat=True)[:limit])
+        if not pks:
+            return 0
+        
+        promoted = due.filter(pk__in=pks).update(scheduled_at=None)
+        if promoted:
+            self.notify()
+        return promoted
     
     def read(self):
+        messages = self.read_many(1)
+        if messages:
+            return messages[0]
+    
+    def read_many(self, n):
+        """
+        Claim up to 'n' messages and remove them from the table.  Rows are
+        claimed atomically so that any number of consumers can safely read
+        from the same queue without executing a message twice
+        """
+        try:
+            if connection.vendor == 'postgresql':
+                rows = self._claim_skip_locked(n)
+            else:
+                rows = self._claim_with_token(n)
+        except DatabaseError:
+            transaction.rollback_unless_managed()
+            return []
+        
+        return [message for pk, token, message in rows]
+    
+    def reserve_many(self, n, timeout):
+        """
+        Claim up to 'n' messages, leaving them in the table until they are
+        acknowledged.  Claims that are not acknowledged within 'timeout'
+        seconds are released by :meth:`requeue_expired`
+        """
+        claimed_until = datetime.datetime.now() + datetime.timedelta(seconds=timeout)
         try:
-            message = self._get_queryset()[0]
-        except IndexError:
-            data = None
+            if connection.vendor == 'postgresql':
+                rows = self._claim_skip_locked(n, claimed_until)
+            else:
+                rows = self._claim_with_token(n, claimed_until)
         except DatabaseError:
-            data = None
+            transaction.rollback_unless_managed()
+            return []
+        
+        for pk, token, message in rows:
+            self._reserved[message] = (pk, token)
+        
+        return [message for pk, token, message in rows]
+    
+    def ack(self, data):
+        reserved = self._reserved.pop(data, None)
+        if reserved:
+            # a claim that expired and was taken by another consumer carries
+            # a different token, so a late ack does not delete it
+            pk, token = reserved
+            QueueMessage.objects.filter(pk=pk, claim=token).delete()
+    
+    def requeue_expired(self, now):
+        requeued = self._get_queryset().filter(claimed_until__lte=now).update(
+            claim=None,
+            claimed_until=None,
+        )
+        if requeued:
+            self.notify()
+        return requeued
+    
+    def notify(self):
+        """
+        Wake any consumer waiting on the queue.  On postgresql the
+        notification is only delivered once the current transaction commits
+        """
+        if not self.notifications:
+            return
+        
+        if connection.vendor == 'postgresql':
+            cursor = connection.cursor()
+            cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, ''])
+            transaction.commit_unless_managed()
         else:
-            data = message.message
-            message.delete()
-        return data
+            try:
+                if self._notify_socket is None:
+                    self._notify_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self._notify_socket.sendto('', self.notify_address)
+            except socket.error:
+                pass
+    
+    def wait(self, timeout):
+        """
+        Block until a message is written or 'timeout' seconds pass.  If the
+        listener cannot be set up, for instance because another consumer on
+        this host already listens on the port, fall back to sleeping
+        """
+        if self._listener is None and self.notifications:
+            try:
+                if connection.vendor == 'postgresql':
+                    self._listener = PostgresListener(self.channel)
+                else:
+                    self._listener = SocketListener(self.notify_address)
+            except (DatabaseError, socket.error):
+                self._listener = False
+        
+        if not (self.notifications and self._listener):
+            return super(DatabaseQueue, self).wait(timeout)
+        return self._listener.wait(timeout)
+    
+    def _claim_skip_locked(self, n, claimed_until=None):
+        """
+        Delete and return the oldest unlocked rows in a single statement --
+        rows locked by another consumer's claim are skipped rather than
+        waited on.  If 'claimed_until' is given the rows are stamped with a
+        claim instead of being deleted.  Requires PostgreSQL 9.5 or newer
+        """
+        qn = connection.ops.quote_name
+        opts = QueueMessage._meta
+        params = {
+            'table': qn(opts.db_table),
+            'pk': qn(opts.pk.column),
+            'queue': qn(opts.get_field('queue').column),
+            'message': qn(opts.get_field('message').column),
+            'created': qn(opts.get_field('created').column),
+            'priority': qn(opts.get_field('priority').column),
+            'scheduled_at': qn(opts.get_field('scheduled_at').column),
+            'claim': qn(opts.get_field('claim').column),
+            'claimed_until': qn(opts.get_field('claimed_until').column),
+        }
+        
+        select = (
+            'SELECT %(pk)s FROM %(table)s '
+            'WHERE %(queue)s = %%s AND %(scheduled_at)s IS NULL AND %(claim)s IS NULL '
+            'ORDER BY %(priority)s DESC, %(created)s, %(pk)s LIMIT %%s '
+            'FOR UPDATE SKIP LOCKED'
+        ) % params
+        returning = ' RETURNING %(priority)s, %(created)s, %(pk)s, %(message)s' % params
+        
+        token = None
+        cursor = connection.cursor()
+        if claimed_until is None:
+            cursor.execute(
+                'DELETE FROM %(table)s WHERE %(pk)s IN (' % params + select + ')' + returning,
+                [self.name, n]
+            )
+        else:
+            token = uuid.uuid4().hex
+            until = opts.get_field('claimed_until').get_db_prep_save(claimed_until, connection=connection)
+            cursor.execute(
+                'UPDATE %(table)s SET %(claim)s = %%s, %(claimed_until)s = %%s '
+                'WHERE %(pk)s IN (' % params + select + ')' + returning,
+                [token, until, self.name, n]
+            )
+        rows = sorted(cursor.fetchall(), key=lambda row: (-row[0], row[1], row[2]))
+        transaction.commit_unless_managed()
+        
+        return [(row[2], token, row[3]) for row in rows]
+    
+    @transaction.commit_on_success
+    def _claim_with_token(self, n, claimed_until=None):
+        """
+        Stamp a batch of unclaimed rows with a unique token using a single
+        UPDATE, which the database applies atomically -- rows that another
+        consumer claimed first are simply not matched.  Then read back
+        whatever rows carry our token, deleting them unless they are being
+        reserved until 'claimed_until'.  The steps run in one transaction, so
+        if a later step fails the rows are not left claimed by nobody
+        """
+        token = uuid.uuid4().hex
+        unclaimed = self._get_ready_queryset().filter(claim__isnull=True)
+        
+        pks = list(unclaimed.values_list('pk', flat=True)[:n])
+        if not pks or not unclaimed.filter(pk__in=pks).update(claim=token, claimed_until=claimed_until):
+            return []
+        
+        claimed = QueueMessage.objects.filter(claim=token)
+        rows = [(pk, token, message) for pk, message in claimed.values_list('pk', 'message')]
+        if claimed_until is None:
+            claimed.delete()
+        
+        return rows
+    
+    def claim_unique(self, key, task_id, timeout):
+        """
+        Rely on the unique constraint to claim the key, expired keys are
+        removed first
+        """
+        now = datetime.datetime.now()
+        keys = QueueUniqueKey.objects.filter(queue=self.name)
+        keys.filter(expires__lte=now).delete()
+        
+        sid = transaction.savepoint()
+        try:
+            QueueUniqueKey.objects.create(
+                queue=self.name,
+                key=key,
+                task_id=task_id,
+                expires=now + datetime.timedelta(seconds=timeout),
+            )
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            owners = list(keys.filter(key=key).values_list('task_id', flat=True))
+            if owners:
+                return owners[0]
+        else:
+            transaction.savepoint_commit(sid)
+        return task_id
+    
+    def acquire_lease(self, key, owner, timeout):
+        """
+        Leases are stored alongside the unique keys, with the owner in place of
+        the task id
+        """
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=timeout)
+        renewed = QueueUniqueKey.objects.filter(
+            queue=self.name,
+            key=key,
+            task_id=owner,
+            expires__gt=datetime.datetime.now(),
+        ).update(expires=expires)
+        return bool(renewed) or self.claim_unique(key, owner, timeout) == owner
     
     def flush(self):
         self._get_queryset().delete()
+        QueueUniqueKey.objects.filter(queue=self.name).delete()
     
     def __len__(self):
-        return self._get_queryset().count()
+        return self._get_ready_queryset().count()
@@ -0,0 +1,496 @@
+import fcntl
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+from djutils.queue.backends.base import BaseQueue
+from djutils.queue.constants import PRIORITIES, PRIORITY_NORMAL
+from djutils.queue.exceptions import QueueException
+
+
+# every record is its length as a 4-byte big-endian integer followed by data
+HEADER = struct.Struct('>I')
+
+def encode_records(messages):
+    return ''.join([HEADER.pack(len(data)) + data for data in messages])
+
+def scan_records(buf, offset, size):
+    """
+    Yield the (start, end) of the data of each complete record in 'buf'
+    from 'offset', stopping at a record that runs past 'size'
+    """
+    while offset + HEADER.size <= size:
+        length, = HEADER.unpack(buf[offset:offset + HEADER.size])
+        start = offset + HEADER.size
+        if start + length > size:
+            break
+        yield start, start + length
+        offset = start + length
+
+def read_file(path):
+    try:
+        fh = open(path, 'rb')
+    except IOError:
+        return ''
+    try:
+        return fh.read()
+    finally:
+        fh.close()
+
+def fsync_path(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_file(path, data, sync):
+    """
+    Atomically replace the contents of a file
+    """
+    tmp = '%s.tmp' % path
+    fh = open(tmp, 'wb')
+    try:
+        fh.write(data)
+        fh.flush()
+        if sync:
+            os.fsync(fh.fileno())
+    finally:
+        fh.close()
+    os.rename(tmp, path)
+
+
+class FileLock(object):
+    """
+    A lock held across threads and processes, using flock on a lock file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+    
+    def acquire(self):
+        self._lock.acquire()
+        try:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        except:
+            self._lock.release()
+            raise
+    
+    def release(self):
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._lock.release()
+
+
+class SegmentLog(object):
+    """
+    An append-only log of records split over segment files, with the read
+    position kept in a checkpoint file.  Segments are read through mmap and
+    removed once every record in them has been read
+    """
+    def __init__(self, path, segment_size, sync_every, sync_interval):
+        self.path = path
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(path):
+                    raise
+        
+        self.checkpoint_path = os.path.join(path, 'checkpoint')
+        self.lock = FileLock(os.path.join(path, 'lock'))
+        
+        # the segment being appended to, as (name, file), and the offset of
+        # the end of the last record known to be complete in it
+        self._tail = None
+        self._tail_end = 0
+        self._unsynced_writes = 0
+        self._unsynced_reads = 0
+        self._synced_at = time.time()
+    
+    def segments(self):
+        return sorted([name for name in os.listdir(self.path) if name.endswith('.seg')])
+    
+    def segment_path(self, name):
+        return os.path.join(self.path, name)
+    
+    def should_sync(self, unsynced):
+        return unsynced >= self.sync_every or time.time() - self._synced_at >= self.sync_interval
+    
+    def get_tail(self):
+        """
+        Return the file to append to, starting a new segment when the current
+        one is full.  Another process may have started a new segment, but
+        only once the current one is full, so a tail that is not full is
+        still the last segment.  Called with the lock held
+        """
+        if self._tail is not None:
+            name, fh = self._tail
+            try:
+                st = os.stat(self.segment_path(name))
+            except OSError:
+                st = None
+            if st and st.st_ino == os.fstat(fh.fileno()).st_ino and st.st_size < self.segment_size:
+                # another process appended since this one last did, and may
+                # have died halfway through a record
+                if st.st_size != self._tail_end:
+                    self._tail_end = self.recover(name, min(self._tail_end, st.st_size))
+                return fh
+            self.close_tail()
+        
+        segments = self.segments()
+        if segments and os.path.getsize(self.segment_path(segments[-1])) < self.segment_size:
+            name = segments[-1]
+            self._tail_end = self.recover(name)
+        elif segments:
+            name = '%016x.seg' % (int(segments[-1][:-4], 16) + 1)
+            self._tail_end = 0
+        else:
+            name = '%016x.seg' % 0
+            self._tail_end = 0
+        
+        self._tail = (name, open(self.segment_path(name), 'ab'))
+        return self._tail[1]
+    
+    def close_tail(self):
+        if self._tail is not None:
+            # other processes may have appended to the segment since the last
+            # fsync, so it is synced whatever this process wrote
+            name, fh = self._tail
+            os.fsync(fh.fileno())
+            self._unsynced_writes = 0
+            fh.close()
+            self._tail = None
+    
+    def sync(self):
+        """
+        fsync the last segment and the checkpoint if they have not been for
+        ``sync_interval`` seconds.  An fsync applies to the file rather than
+        the descriptor, so this covers records appended by any process
+        """
+        if time.time() - self._synced_at < self.sync_interval:
+            return
+        
+        self.lock.acquire()
+        try:
+            segments = self.segments()
+            paths = [self.checkpoint_path]
+            if segments:
+                paths.append(self.segment_path(segments[-1]))
+            
+            for path in paths:
+                fsync_path(path)
+            
+            self._unsynced_writes = 0
+            self._unsynced_reads = 0
+            self._synced_at = time.time()
+        finally:
+            self.lock.release()
+    
+    def recover(self, name, offset=0):
+        """
+        Truncate a record left half-written by a process that died while
+        appending, so that records appended after it can be read.  The
+        segment is scanned from 'offset', which must be the start of a
+        record.  Returns the size of the segment
+        """
+        fh = open(self.segment_path(name), 'r+b')
+        try:
+            fh.seek(offset)
+            data = fh.read()
+            end = 0
+            for start, end in scan_records(data, 0, len(data)):
+                pass
+            if end < len(data):
+                fh.truncate(offset + end)
+            return offset + end
+        finally:
+            fh.close()
+    
+    def append(self, messages):
+        self.lock.acquire()
+        try:
+            fh = self.get_tail()
+            data = encode_records(messages)
+            fh.write(data)
+            fh.flush()
+            self._tail_end += len(data)
+            
+            # fsync in batches, the data is already safe from a crash of this
+            # process once it has been flushed to the operating system
+            self._unsynced_writes += len(messages)
+            if self.should_sync(self._unsynced_writes):
+                os.fsync(fh.fileno())
+                self._unsynced_writes = 0
+                self._synced_at = time.time()
+        finally:
+            self.lock.release()
+    
+    def read_checkpoint(self, segments):
+        data = read_file(self.checkpoint_path).split()
+        if len(data) == 2 and data[0] in segments:
+            return data[0], int(data[1])
+        
+        # nothing has been read yet, or the segment was removed
+        if segments:
+            return segments[0], 0
+        return None, 0
+    
+    def read_segment(self, name, offset, n):
+        """
+        Read up to 'n' records from a segment starting at 'offset', returning
+        the records and the offset after the last one
+        """
+        messages = []
+        fh = open(self.segment_path(name), 'rb')
+        try:
+            size = os.fstat(fh.fileno()).st_size
+            if offset >= size:
+                return messages, offset
+            
+            buf = mmap.mmap(fh.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                for start, end in scan_records(buf, offset, size):
+                    messages.append(buf[start:end])
+                    offset = end
+                    if len(messages) >= n:
+                        break
+            finally:
+                buf.close()
+        finally:
+            fh.close()
+        return messages, offset
+    
+    def read(self, n):
+        """
+        Read up to 'n' records and move the checkpoint past them
+        """
+        self.lock.acquire()
+        try:
+            segments = self.segments()
+            name, offset = self.read_checkpoint(segments)
+            start = (name, offset)
+            
+            messages = []
+            consumed = []
+            while name is not None:
+                records, offset = self.read_segment(name, offset, n - len(messages))
+                messages.extend(records)
+                if len(messages) >= n:
+                    break
+                
+                # move on to the next segment once this one is full
+                later = segments[segments.index(name) + 1:]
+                if not later:
+                    break
+                consumed.append(name)
+                name, offset = later[0], 0
+            
+            if (name, offset) != start:
+                self._unsynced_reads += len(messages)
+                sync = self.should_sync(self._unsynced_reads)
+                write_file(self.checkpoint_path, '%s %d' % (name, offset), sync)
+                if sync:
+                    self._unsynced_reads = 0
+                    self._synced_at = time.time()
+                
+                for old in consumed:
+                    os.remove(self.segment_path(old))
+            
+            return messages
+        finally:
+            self.lock.release()
+    
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.close_tail()
+            for name in self.segments():
+                os.remove(self.segment_path(name))
+            if os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+        finally:
+            self.lock.release()
+    
+    def __len__(self):
+        self.lock.acquire()
+        try:
+            segments = self.segments()
+            name, offset = self.read_checkpoint(segments)
+            if name is None:
+                return 0
+            
+            count = 0
+            for name in segments[segments.index(name):]:
+                data = read_file(self.segment_path(name))
+                for record in scan_records(data, offset, len(data)):
+                    count += 1
+                offset = 0
+            return count
+        finally:
+            self.lock.release()
+
+
+class FileQueue(BaseQueue):
+    """
+    A durable queue stored in files on the local disk, for servers without
+    redis that should not fill the database with queue traffic.  Each
+    priority is an append-only log of segment files, writes and reads are
+    sequential and fsync is called in batches
+    """
+    binary = True
+    
+    # size at which a new segment file is started, in bytes
+    segment_size = 16 * 1024 * 1024
+    
+    # fsync after this many messages or seconds, whichever comes first -- once
+    # the interval has passed the consumer syncs even if nothing is written
+    sync_every = 100
+    sync_interval = 1
+    
+    def __init__(self, name, connection):
+        """
+        QUEUE_CONNECTION = '/path/to/a/directory'
+        """
+        super(FileQueue, self).__init__(name, connection)
+        
+        if not connection:
+            raise QueueException, 'FileQueue requires a directory to store messages in'
+        
+        self.path = os.path.join(connection, re.sub('[^a-zA-Z0-9._-]', '_', name))
+        self.logs = dict([
+            (priority, SegmentLog(
+                os.path.join(self.path, str(priority)),
+                self.segment_size,
+                self.sync_every,
+                self.sync_interval,
+            )) for priority in PRIORITIES
+        ])
+        
+        # scheduled messages are kept in a single file that is rewritten when
+        # it changes, as they are not read in the order they were written
+        self.schedule_path = os.path.join(self.path, 'scheduled')
+        self.schedule_lock = FileLock(os.path.join(self.path, 'scheduled.lock'))
+        self._unsynced_schedules = 0
+        self._schedule_synced_at = time.time()
+    
+    def should_sync_schedule(self):
+        return (self._unsynced_schedules >= self.sync_every or
+                time.time() - self._schedule_synced_at >= self.sync_interval)
+    
+    def get_log(self, priority):
+        if priority not in self.logs:
+            raise QueueException, '%s is not a valid priority' % priority
+        return self.logs[priority]
+    
+    def write(self, data, priority=PRIORITY_NORMAL):
+        self.get_log(priority).append([data])
+    
+    def write_many(self, messages, priority=PRIORITY_NORMAL):
+        if messages:
+            self.get_log(priority).append(messages)
+    
+    def schedule(self, data, eta, priority=PRIORITY_NORMAL):
+        self.get_log(priority)
+        
+        timestamp = time.mktime(eta.timetuple()) + eta.microsecond / 1e6
+        record = '%r:%s:%s' % (timestamp, priority, data)
+        
+        self.schedule_lock.acquire()
+        try:
+            fh = open(self.schedule_path, 'ab')
+            try:
+                fh.write(encode_records([record]))
+                fh.flush()
+                
+                # fsync in batches, like the logs
+                self._unsynced_schedules += 1
+                if self.should_sync_schedule():
+                    os.fsync(fh.fileno())
+                    self._unsynced_schedules = 0
+                    self._schedule_synced_at = time.time()
+            finally:
+                fh.close()
+        finally:
+            self.schedule_lock.release()
+    
+    def promote(self, now, limit):
+        now = time.mktime(now.timetuple()) + now.microsecond / 1e6
+        
+        self.schedule_lock.acquire()
+        try:
+            data = read_file(self.schedule_path)
+            due = {}
+            pending = []
+            promoted = 0
+            for start, end in scan_records(data, 0, len(data)):
+                record = data[start:end]
+                timestamp, priority, message = record.split(':', 2)
+                if float(timestamp) <= now and promoted < limit:
+                    due.setdefault(int(priority), []).append(message)
+                    promoted += 1
+                else:
+                    pending.append(record)
+            
+            if promoted:
+                for priority, messages in due.items():
+                    self.logs[priority].append(messages)
+                write_file(self.schedule_path, encode_records(pending), True)
+                self._unsynced_schedules = 0
+            return promoted
+        finally:
+            self.schedule_lock.release()
+    
+    def read(self):
+        messages = self.read_many(1)
+        if messages:
+            return messages[0]
+    
+    def read_many(self, n):
+        messages = []
+        for priority in PRIORITIES:
+            if len(messages) >= n:
+                break
+            messages.extend(self.logs[priority].read(n - len(messages)))
+        return messages
+    
+    def sync(self):
+        for log in self.logs.values():
+            log.sync()
+        
+        # like the logs, this covers messages scheduled by any process
+        if time.time() - self._schedule_synced_at >= self.sync_interval:
+            self.schedule_lock.acquire()
+            try:
+                fsync_path(self.schedule_path)
+                self._unsynced_schedules = 0
+                self._schedule_synced_at = time.time()
+            finally:
+                self.schedule_lock.release()
+    
+    def flush(self):
+        for log in self.logs.values():
+            log.clear()
+        
+        self.schedule_lock.acquire()
+        try:
+            if os.path.exists(self.schedule_path):
+                os.remove(self.schedule_path)
+        finally:
+            self.schedule_lock.release()
+    
+    def __len__(self):
+        return sum([len(log) for log in self.logs.values()])
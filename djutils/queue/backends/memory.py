@@ -0,0 +1,265 @@
+import collections
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from djutils.queue.backends.base import BaseQueue
+from djutils.queue.constants import PRIORITIES, PRIORITY_NORMAL
+from djutils.queue.exceptions import QueueException
+from djutils.queue.registry import registry
+
+
+logger = logging.getLogger('djutils.queue.logger')
+
+
+class MemoryQueue(BaseQueue):
+    """
+    A queue kept in the memory of the current process, for sites running on a
+    single server and for measuring the overhead of the other backends.
+    Messages are lost when the process exits, and are only visible to
+    readers in the same process -- commands are executed by a pool of
+    worker threads embedded in the process, or by a consumer enqueueing its
+    own periodic commands and retries
+    """
+    blocking = True
+    binary = True
+    reserves = True
+    
+    # seconds a read waits for a message before returning empty-handed
+    read_timeout = 1
+    
+    def __init__(self, name, connection):
+        """
+        QUEUE_CONNECTION = number of embedded worker threads, defaults to 0
+        """
+        super(MemoryQueue, self).__init__(name, connection)
+        
+        self.workers = int(connection or 0)
+        self._threads = []
+        self._stopped = threading.Event()
+        
+        self._cond = threading.Condition()
+        self._lanes = dict([(priority, collections.deque()) for priority in PRIORITIES])
+        
+        # scheduled messages as a heap of (eta, sequence, priority, message)
+        self._scheduled = []
+        self._sequence = itertools.count()
+        
+        # reserved messages map to their (deadline, priority)
+        self._reserved = {}
+        
+        # unique keys and leases map to their (owner, expiry time)
+        self._keys = {}
+    
+    def _lane(self, priority):
+        if priority not in self._lanes:
+            raise QueueException, '%s is not a valid priority' % priority
+        return self._lanes[priority]
+    
+    def _ready(self):
+        for priority in PRIORITIES:
+            if self._lanes[priority]:
+                return True
+        return False
+    
+    def write(self, data, priority=PRIORITY_NORMAL):
+        self.write_many([data], priority)
+    
+    def write_many(self, messages, priority=PRIORITY_NORMAL):
+        self._cond.acquire()
+        try:
+            self._lane(priority).extend(messages)
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+    
+    def schedule(self, data, eta, priority=PRIORITY_NORMAL):
+        self._cond.acquire()
+        try:
+            self._lane(priority)
+            heapq.heappush(self._scheduled, (eta, self._sequence.next(), priority, data))
+        finally:
+            self._cond.release()
+    
+    def promote(self, now, limit):
+        self._cond.acquire()
+        try:
+            promoted = 0
+            while self._scheduled and promoted < limit and self._scheduled[0][0] <= now:
+                eta, sequence, priority, data = heapq.heappop(self._scheduled)
+                self._lanes[priority].append(data)
+                promoted += 1
+            if promoted:
+                self._cond.notify_all()
+            return promoted
+        finally:
+            self._cond.release()
+    
+    def read(self):
+        messages = self.read_many(1)
+        if messages:
+            return messages[0]
+    
+    def read_many(self, n, timeout=None):
+        """
+        Pop up to 'n' messages, highest priority first, waiting up to
+        'timeout' or ``read_timeout`` seconds for the first one
+        """
+        return [data for priority, data in self._pop(n, timeout)]
+    
+    def _pop(self, n, timeout=None):
+        if timeout is None:
+            timeout = self.read_timeout
+        
+        self._cond.acquire()
+        try:
+            if n > 0 and not self._ready():
+                self._cond.wait(timeout)
+            
+            popped = []
+            for priority in PRIORITIES:
+                lane = self._lanes[priority]
+                while lane and len(popped) < n:
+                    popped.append((priority, lane.popleft()))
+            return popped
+        finally:
+            self._cond.release()
+    
+    def reserve_many(self, n, timeout):
+        popped = self._pop(n)
+        deadline = datetime.datetime.now() + datetime.timedelta(seconds=timeout)
+        
+        self._cond.acquire()
+        try:
+            for priority, data in popped:
+                self._reserved[data] = (deadline, priority)
+        finally:
+            self._cond.release()
+        return [data for priority, data in popped]
+    
+    def ack(self, data):
+        self._cond.acquire()
+        try:
+            self._reserved.pop(data, None)
+        finally:
+            self._cond.release()
+    
+    def requeue_expired(self, now):
+        self._cond.acquire()
+        try:
+            expired = [data for data, (deadline, priority) in self._reserved.items() if deadline <= now]
+            for data in expired:
+                deadline, priority = self._reserved.pop(data)
+                self._lanes[priority].appendleft(data)
+            if expired:
+                self._cond.notify_all()
+            return len(expired)
+        finally:
+            self._cond.release()
+    
+    def wait(self, timeout):
+        self._cond.acquire()
+        try:
+            if not self._ready():
+                self._cond.wait(timeout)
+            return self._ready()
+        finally:
+            self._cond.release()
+    
+    def claim_unique(self, key, task_id, timeout):
+        self._cond.acquire()
+        try:
+            now = time.time()
+            owner, expires = self._keys.get(key, (None, 0))
+            if expires <= now:
+                self._keys[key] = (task_id, now + timeout)
+                return task_id
+            return owner
+        finally:
+            self._cond.release()
+    
+    def acquire_lease(self, key, owner, timeout):
+        self._cond.acquire()
+        try:
+            now = time.time()
+            holder, expires = self._keys.get(key, (None, 0))
+            if holder == owner or expires <= now:
+                self._keys[key] = (owner, now + timeout)
+                return True
+            return False
+        finally:
+            self._cond.release()
+    
+    def start_consumer(self, invoker):
+        """
+        Start the embedded worker threads, if any were configured
+        """
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run_worker, args=(invoker,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+    
+    def stop_consumer(self):
+        """
+        Stop the embedded worker threads once they finish their current
+        message, waiting up to ``read_timeout`` seconds for each
+        """
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join(self.read_timeout * 2)
+        self._threads = []
+    
+    def run_worker(self, invoker):
+        while not self._stopped.is_set():
+            self.promote(datetime.datetime.now(), 100)
+            for message in self.read_many(1):
+                try:
+                    self.execute_message(invoker, message)
+                except:
+                    logger.error('unable to handle failed message', exc_info=1)
+    
+    def execute_message(self, invoker, message):
+        """
+        Execute a message in an embedded worker, applying the retry policy of
+        its command if it fails
+        """
+        try:
+            command = registry.get_command_for_message(message)
+        except Exception:
+            # any message that cannot be decoded, whatever the reason
+            logger.error('unable to load message, moving it to the dead letter queue', exc_info=1)
+            try:
+                invoker.bury(message)
+            except:
+                logger.error('unable to move message to the dead letter queue', exc_info=1)
+            return
+        
+        try:
+            invoker.execute(command)
+        except QueueException:
+            logger.warn('queue exception raised', exc_info=1)
+        except:
+            logger.warn('exception encountered', exc_info=1)
+            invoker.handle_failure(command)
+    
+    def flush(self):
+        self._cond.acquire()
+        try:
+            for lane in self._lanes.values():
+                lane.clear()
+            del self._scheduled[:]
+            self._reserved.clear()
+            self._keys.clear()
+        finally:
+            self._cond.release()
+    
+    def __len__(self):
+        self._cond.acquire()
+        try:
+            return sum([len(lane) for lane in self._lanes.values()])
+        finally:
+            self._cond.release()
@@ -1,40 +1,309 @@
+import bisect
+import itertools
+import math
+import os
 import re
+import time
+import uuid
+
 import redis
 
 from djutils.queue.backends.base import BaseQueue
+from djutils.queue.constants import PRIORITIES, PRIORITY_NORMAL
+from djutils.queue.exceptions import QueueException
+from djutils.queue.registry import registry, shard_hash
+
+
+# pop up to ARGV[1] messages from the tails of the lists given as KEYS,
+# exhausting each list before moving on to the next
+MULTI_POP_SCRIPT = """
+local n = tonumber(ARGV[1])
+local result = {}
+for _, key in ipairs(KEYS) do
+    local remaining = n - #result
+    if remaining < 1 then
+        break
+    end
+    local items = redis.call('LRANGE', key, -remaining, -1)
+    if #items > 0 then
+        redis.call('LTRIM', key, 0, -#items - 1)
+        for i = #items, 1, -1 do
+            table.insert(result, items[i])
+        end
+    end
+end
+return result
+"""
+
+
+# move up to ARGV[2] members of the sorted set KEYS[1] scored at or below
+# ARGV[1] onto the list for their priority.  members are stored as
+# <priority>:<unique id>:<message>, the lists are given as KEYS[2:] and their
+# priorities as ARGV[3:]
+PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local lanes = {}
+for i = 3, #ARGV do
+    lanes[ARGV[i]] = KEYS[i - 1]
+end
+for _, member in ipairs(due) do
+    local priority, data = string.match(member, '^([^:]*):[^:]*:(.*)$')
+    redis.call('LPUSH', lanes[priority], data)
+    redis.call('ZREM', KEYS[1], member)
+end
+return #due
+"""
+
+
+# like MULTI_POP_SCRIPT, but each message popped from the lists given as
+# KEYS[1:-1] is also pushed onto the processing list KEYS[-1] as
+# <deadline>:<priority>:<message>, where the deadline is ARGV[2] and the
+# priority of each list is given in ARGV[3:].  returns the processing list
+# members
+RESERVE_SCRIPT = """
+local n = tonumber(ARGV[1])
+local processing = KEYS[#KEYS]
+local result = {}
+for k = 1, #KEYS - 1 do
+    local remaining = n - #result
+    if remaining < 1 then
+        break
+    end
+    local items = redis.call('LRANGE', KEYS[k], -remaining, -1)
+    if #items > 0 then
+        redis.call('LTRIM', KEYS[k], 0, -#items - 1)
+        for i = #items, 1, -1 do
+            local member = ARGV[2] .. ':' .. ARGV[k + 2] .. ':' .. items[i]
+            redis.call('LPUSH', processing, member)
+            table.insert(result, member)
+        end
+    end
+end
+return result
+"""
+
+
+# replace the bare message ARGV[1] on the processing list KEYS[1] with the
+# member ARGV[2].  REQUEUE_SCRIPT may have stamped the bare message first, in
+# which case its member is replaced instead.  returns 1 if the message was
+# still on the processing list
+STAMP_SCRIPT = """
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 0 then
+    local stamped = nil
+    for _, member in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+        if string.match(member, '^[%d%.]+:%-?%d+:(.*)$') == ARGV[1] then
+            stamped = member
+            break
+        end
+    end
+    if not stamped then
+        return 0
+    end
+    redis.call('LREM', KEYS[1], 1, stamped)
+end
+redis.call('LPUSH', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+# move members of the processing list KEYS[1] whose deadline is at or before
+# ARGV[1] back onto the front of the list for their priority.  the lists are
+# given as KEYS[2:] and their priorities as ARGV[4:].  bare messages left
+# behind by a blocking reserve are given the deadline ARGV[2] and the
+# priority ARGV[3]
+REQUEUE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local lanes = {}
+for i = 4, #ARGV do
+    lanes[ARGV[i]] = KEYS[i - 2]
+end
+local count = 0
+for _, member in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    local deadline, priority, data = string.match(member, '^([%d%.]+):(%-?%d+):(.*)$')
+    if not deadline then
+        redis.call('LREM', KEYS[1], 1, member)
+        redis.call('LPUSH', KEYS[1], ARGV[2] .. ':' .. ARGV[3] .. ':' .. member)
+    elseif tonumber(deadline) <= now then
+        redis.call('LREM', KEYS[1], 1, member)
+        redis.call('RPUSH', lanes[priority], data)
+        count = count + 1
+    end
+end
+return count
+"""
+
+# set the key KEYS[1] to ARGV[1] with an expiry of ARGV[2] milliseconds,
+# unless it is already held by another value.  returns 1 if the key holds
+# ARGV[1]
+LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+def to_timestamp(dt):
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
+
+# redis clients by (process id, connection string)
+_clients = {}
+
+def get_client(connection):
+    """
+    Return a client for 'host:port:database', defaulting to localhost:6379:0.
+    Every queue and result store in a process that uses the same server
+    shares the client and its thread-safe connection pool.  Connections are
+    only opened when first used, and a forked process gets a client of its
+    own rather than sharing the parent's sockets
+    """
+    connection = connection or 'localhost:6379:0'
+    key = (os.getpid(), connection)
+    if key not in _clients:
+        host, port, db = connection.split(':')
+        pool = redis.ConnectionPool(host=host, port=int(port), db=int(db))
+        _clients.setdefault(key, redis.Redis(connection_pool=pool))
+    return _clients[key]
 
 
 class RedisQueue(BaseQueue):
     """
-    A simple Queue that uses the redis to store messages
+    A simple Queue that uses the redis to store messages.  Each priority is
+    stored in a separate list
     """
+    binary = True
+    reserves = True
+    
+    # seconds before a message found on the processing list without a
+    # deadline is requeued
+    stamp_timeout = 300
+    
     def __init__(self, name, connection):
         """
         QUEUE_CONNECTION = 'host:port:database' or defaults to localhost:6379:0
         """
         super(RedisQueue, self).__init__(name, connection)
         
-        if not connection:
-            connection = 'localhost:6379:0'
-        
         self.queue_name = 'djutils.redis.%s' % re.sub('[^a-z0-9]', '', name)
-        host, port, db = connection.split(':')
-
-        self.conn = redis.Redis(
-            host=host, port=int(port), db=int(db)
-        )
+        self.conn = get_client(connection)
+        
+        # keys of the priority lists, highest priority first
+        self.queue_keys = [self.queue_key(priority) for priority in PRIORITIES]
+        self._multi_pop = self.conn.register_script(MULTI_POP_SCRIPT)
+        
+        # scheduled messages are kept out of the lists in a sorted set
+        self.schedule_key = '%s.scheduled' % self.queue_name
+        self._promote = self.conn.register_script(PROMOTE_SCRIPT)
+        
+        # reserved messages are moved to a processing list until acknowledged
+        self.processing_key = '%s.processing' % self.queue_name
+        self._reserve = self.conn.register_script(RESERVE_SCRIPT)
+        self._stamp = self.conn.register_script(STAMP_SCRIPT)
+        self._requeue = self.conn.register_script(REQUEUE_SCRIPT)
+        
+        # maps reserved messages to their member of the processing list
+        self._reserved = {}
+        
+        self._lease = self.conn.register_script(LEASE_SCRIPT)
+    
+    def queue_key(self, priority):
+        if priority not in PRIORITIES:
+            raise QueueException, '%s is not a valid priority' % priority
+        
+        # normal priority messages live in the same list they always have
+        if priority == PRIORITY_NORMAL:
+            return self.queue_name
+        return '%s.%s' % (self.queue_name, priority)
+    
+    def write(self, data, priority=PRIORITY_NORMAL):
+        self.conn.lpush(self.queue_key(priority), data)
     
-    def write(self, data):
-        self.conn.lpush(self.queue_name, data)
+    def write_many(self, messages, priority=PRIORITY_NORMAL):
+        # a single variadic LPUSH -- messages end up in the same order as if
+        # they had been pushed one at a time
+        if messages:
+            self.conn.lpush(self.queue_key(priority), *messages)
+    
+    def schedule(self, data, eta, priority=PRIORITY_NORMAL):
+        # validate the priority up-front
+        self.queue_key(priority)
+        
+        member = '%s:%s:%s' % (priority, uuid.uuid4().hex, data)
+        self.conn.zadd(self.schedule_key, {member: to_timestamp(eta)})
+    
+    def promote(self, now, limit):
+        return self._promote(
+            keys=[self.schedule_key] + self.queue_keys,
+            args=[to_timestamp(now), limit] + list(PRIORITIES),
+        )
     
     def read(self):
-        return self.conn.rpop(self.queue_name)
+        messages = self.read_many(1)
+        if messages:
+            return messages[0]
+    
+    def read_many(self, n):
+        """
+        Atomically pop up to 'n' messages, draining the higher priority lists
+        first, using a single lua script
+        """
+        if n < 1:
+            return []
+        return self._multi_pop(keys=self.queue_keys, args=[n])
+    
+    def reserve_many(self, n, timeout):
+        """
+        Atomically move up to 'n' messages onto the processing list, where
+        they stay until acknowledged or until :meth:`requeue_expired` finds
+        that their deadline has passed
+        """
+        if n < 1:
+            return []
+        members = self._reserve(
+            keys=self.queue_keys + [self.processing_key],
+            args=[n, repr(time.time() + timeout)] + list(PRIORITIES),
+        )
+        return [self._track(member) for member in members]
+    
+    def _track(self, member):
+        data = member.split(':', 2)[2]
+        self._reserved[data] = member
+        return data
+    
+    def ack(self, data):
+        member = self._reserved.pop(data, None)
+        if member:
+            self.conn.lrem(self.processing_key, 1, member)
+    
+    def requeue_expired(self, now):
+        return self._requeue(
+            keys=[self.processing_key] + self.queue_keys,
+            args=[to_timestamp(now), repr(time.time() + self.stamp_timeout), PRIORITY_NORMAL] + list(PRIORITIES),
+        )
+    
+    def claim_unique(self, key, task_id, timeout):
+        unique_key = '%s.unique.%s' % (self.queue_name, key)
+        if self.conn.set(unique_key, task_id, nx=True, px=int(timeout * 1000)):
+            return task_id
+        return self.conn.get(unique_key)
+    
+    def acquire_lease(self, key, owner, timeout):
+        return bool(self._lease(
+            keys=['%s.lease.%s' % (self.queue_name, key)],
+            args=[owner, int(timeout * 1000)],
+        ))
     
     def flush(self):
-        self.conn.delete(self.queue_name)
+        self.conn.delete(self.schedule_key, self.processing_key, *self.queue_keys)
     
     def __len__(self):
-        return self.conn.llen(self.queue_name)
+        pipe = self.conn.pipeline()
+        for key in self.queue_keys:
+            pipe.llen(key)
+        return sum(pipe.execute())
 
 
 class RedisBlockingQueue(RedisQueue):
@@ -46,4 +315,184 @@ class RedisBlockingQueue(RedisQueue):
     blocking = True
 
     def read(self):
-        return self.conn.brpop(self.queue_name)
+        # brpop checks the keys in the order given and returns a 2-tuple of
+        # (key, value)
+        return self.conn.brpop(self.queue_keys)[1]
+    
+    def read_many(self, n, timeout=None):
+        """
+        Block until a message is available, or for at most 'timeout' seconds,
+        then grab up to n - 1 additional messages without blocking
+        """
+        if n < 1:
+            return []
+        
+        if timeout is None:
+            messages = [self.read()]
+        else:
+            # brpop takes whole seconds, and 0 means to wait forever
+            popped = self.conn.brpop(self.queue_keys, max(int(math.ceil(timeout)), 1))
+            if popped is None:
+                return []
+            messages = [popped[1]]
+        messages.extend(super(RedisBlockingQueue, self).read_many(n - 1))
+        return messages
+    
+    def reserve_many(self, n, timeout):
+        """
+        Reserve whatever messages are available on any of the lists, otherwise
+        block on the normal priority list for up to a second.  Redis does not
+        allow blocking commands in lua scripts, so the message is moved onto
+        the processing list by BRPOPLPUSH and given its deadline by a script
+        afterwards, which also takes over a deadline that
+        :meth:`requeue_expired` may have given it in between.  Once a message
+        has arrived the rest of the batch is reserved without blocking, higher
+        priority messages first
+        """
+        messages = super(RedisBlockingQueue, self).reserve_many(n, timeout)
+        if messages or n < 1:
+            return messages
+        
+        data = self.conn.brpoplpush(self.queue_key(PRIORITY_NORMAL), self.processing_key, 1)
+        if data is None:
+            return []
+        
+        # a message already requeued from the processing list is delivered
+        # from its priority list instead
+        member = '%r:%s:%s' % (time.time() + timeout, PRIORITY_NORMAL, data)
+        if self._stamp(keys=[self.processing_key], args=[data, member]):
+            messages.append(self._track(member))
+        
+        return super(RedisBlockingQueue, self).reserve_many(n - len(messages), timeout) + messages
+
+
+class HashRing(object):
+    """
+    Maps hashes onto nodes using consistent hashing, so that adding or
+    removing a node only moves the keys of its neighbours on the ring
+    """
+    # points on the ring per node, more points spread keys more evenly
+    replicas = 100
+    
+    def __init__(self, nodes):
+        ring = []
+        for i, node in enumerate(nodes):
+            for replica in range(self.replicas):
+                ring.append((shard_hash('%s-%d' % (node, replica)), i))
+        ring.sort()
+        self._points = [point for point, i in ring]
+        self._nodes = [i for point, i in ring]
+    
+    def get_node(self, h):
+        """
+        Return the index of the node owning the hash 'h'
+        """
+        i = bisect.bisect(self._points, h) % len(self._points)
+        return self._nodes[i]
+
+
+class ShardedRedisQueue(BaseQueue):
+    """
+    Spreads a queue over several redis servers, each holding a
+    :class:`RedisQueue`.  Commands with a shard key are routed by consistent
+    hashing, so all messages with the same key are stored in order on the
+    same shard, other messages are written to the shards in turn
+    """
+    binary = True
+    reserves = True
+    
+    def __init__(self, name, connection):
+        """
+        QUEUE_CONNECTION = 'host:port:db,host:port:db' or a list of connections
+        """
+        super(ShardedRedisQueue, self).__init__(name, connection)
+        
+        if isinstance(connection, basestring):
+            connection = connection.split(',')
+        if not connection:
+            raise QueueException, 'ShardedRedisQueue requires a list of connections'
+        
+        self.shards = [RedisQueue(name, conn.strip()) for conn in connection]
+        self.ring = HashRing([conn.strip() for conn in connection])
+        self._next_write = itertools.count()
+        self._next_read = itertools.count()
+    
+    def get_shard(self, data):
+        key = registry.get_headers_for_message(data).get('k')
+        if key is None:
+            return self.shards[self._next_write.next() % len(self.shards)]
+        return self.shards[self.ring.get_node(int(key, 16))]
+    
+    def get_shard_for_key(self, key):
+        return self.shards[self.ring.get_node(shard_hash(key))]
+    
+    def write(self, data, priority=PRIORITY_NORMAL):
+        self.get_shard(data).write(data, priority)
+    
+    def write_many(self, messages, priority=PRIORITY_NORMAL):
+        """
+        Group the messages by shard, preserving their order, and write each
+        group with a single LPUSH
+        """
+        by_shard = {}
+        for data in messages:
+            by_shard.setdefault(self.get_shard(data), []).append(data)
+        for shard, shard_messages in by_shard.items():
+            shard.write_many(shard_messages, priority)
+    
+    def schedule(self, data, eta, priority=PRIORITY_NORMAL):
+        self.get_shard(data).schedule(data, eta, priority)
+    
+    def promote(self, now, limit):
+        return sum([shard.promote(now, limit) for shard in self.shards])
+    
+    def read(self):
+        messages = self.read_many(1)
+        if messages:
+            return messages[0]
+    
+    def _read_fairly(self, n, read):
+        """
+        Read up to 'n' messages, starting with a different shard each time
+        and asking each shard for an equal share of whatever is still wanted
+        """
+        count = len(self.shards)
+        start = self._next_read.next() % count
+        
+        messages = []
+        for i in range(count):
+            wanted = n - len(messages)
+            if wanted < 1:
+                break
+            share = -(-wanted // (count - i))
+            messages.extend(read(self.shards[(start + i) % count], share))
+        return messages
+    
+    def read_many(self, n):
+        return self._read_fairly(n, lambda shard, share: shard.read_many(share))
+    
+    def reserve_many(self, n, timeout):
+        return self._read_fairly(n, lambda shard, share: shard.reserve_many(share, timeout))
+    
+    def ack(self, data):
+        # only the shard that reserved the message knows about it
+        for shard in self.shards:
+            if data in shard._reserved:
+                shard.ack(data)
+                break
+    
+    def requeue_expired(self, now):
+        return sum([shard.requeue_expired(now) for shard in self.shards])
+    
+    def claim_unique(self, key, task_id, timeout):
+        return self.get_shard_for_key(key).claim_unique(key, task_id, timeout)
+    
+    def acquire_lease(self, key, owner, timeout):
+        return self.get_shard_for_key(key).acquire_lease(key, owner, timeout)
+    
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+    
+    def __len__(self):
+        return sum([len(shard) for shard in self.shards])
@@ -1,10 +1,44 @@
 #!/usr/bin/env python
+import sys
+
+
+def greenlets_requested(argv):
+    """
+    Whether the command line asks for a non-zero number of greenlets, checked
+    before the options are parsed
+    """
+    for i, arg in enumerate(argv):
+        if arg.startswith('--greenlets='):
+            value = arg.split('=', 1)[1]
+        elif arg in ('--greenlets', '-g'):
+            value = i + 1 < len(argv) and argv[i + 1] or ''
+        elif arg.startswith('-g'):
+            value = arg[2:]
+        else:
+            continue
+        try:
+            return int(value) > 0
+        except ValueError:
+            return False
+    return False
+
+# gevent needs to patch the standard library before anything else has a
+# chance to import it, so this comes before the other imports
+if __name__ == '__main__' and greenlets_requested(sys.argv[1:]):
+    from gevent import monkey
+    monkey.patch_all()
+
+import copy
+import datetime
 import logging
+import multiprocessing
 import os
 import Queue
-import sys
+import signal
 import time
 import threading
+import traceback
+import uuid
 from logging.handlers import RotatingFileHandler
 from optparse import OptionParser
 
@@ -13,13 +47,83 @@ if __name__ == '__main__':
         print 'DJANGO_SETTINGS_MODULE environment variable not set, exiting'
         sys.exit(2)
 
+from django.db import connections
 from django.db.models.loading import get_apps
 
 # avoid importing these if the environment variable is not set
 from djutils.daemon import Daemon
 from djutils.queue import autodiscover
 from djutils.queue.exceptions import QueueException
-from djutils.queue.queue import invoker, queue_name, registry
+from djutils.queue.queue import get_invoker, invoker, queue_name, registry
+from djutils.queue.schedules import PeriodicScheduler
+from djutils.queue.throttle import Throttle, clock
+
+
+def initialize_process():
+    """
+    Runs in each pool worker immediately after it is forked from the consumer
+    """
+    # forget any database connections inherited from the parent -- closing
+    # them would close the parent's connection as well
+    for conn in connections.all():
+        conn.connection = None
+    
+    # let the parent handle shutting down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def execute_command(invoker, command):
+    """
+    Execute a command read by the given invoker, applying its retry policy if
+    it fails.  Returns a 2-tuple of a status and, if the command failed, the
+    formatted traceback
+    """
+    try:
+        invoker.execute(command)
+    except QueueException:
+        return ('warn', traceback.format_exc())
+    except:
+        tb = traceback.format_exc()
+        try:
+            return (invoker.handle_failure(command), tb)
+        except:
+            # the message could not be re-enqueued or buried
+            return ('error', tb + traceback.format_exc())
+    return ('ok', None)
+
+def execute_in_process(name, message):
+    """
+    Execute a message read from the named queue in a pool worker.
+    Exceptions are not raised, since they may not be pickle-able, rather a
+    3-tuple of a status, the formatted traceback and the time taken to
+    execute the command is returned to the parent for reporting
+    """
+    try:
+        invoker = get_invoker(name)
+        try:
+            command = registry.get_command_for_message(message)
+        except Exception:
+            tb = traceback.format_exc()
+            try:
+                invoker.bury(message)
+            except:
+                return ('error', tb + traceback.format_exc(), None)
+            return ('invalid', tb, None)
+        
+        start = clock()
+        status, tb = execute_command(invoker, command)
+        return (status, tb, clock() - start)
+    except:
+        # the pool only calls back with a result, so nothing may be raised or
+        # the message would hold its slot in the window forever
+        return ('error', traceback.format_exc(), None)
+
+
+def parse_queues(value):
+    """
+    Split the comma-separated --queues option into a list of queue names
+    """
+    names = [name.strip() for name in (value or '').split(',') if name.strip()]
+    return names or ['default']
 
 
 class QueueDaemon(Daemon):
@@ -37,8 +141,19 @@ class QueueDaemon(Daemon):
     # python consumer.py stop
     """
     
+    # seconds between removing expired results from the result store
+    purge_interval = 300
+    
     def __init__(self, options, *args, **kwargs):
+        self.queues = parse_queues(options.queues)
+        self.invoker = get_invoker(self.queues[0])
+        self._queue_threads = []
+        
+        # consumers of different queues running on the same host need their
+        # own pid and log files
         self.queue_name = queue_name
+        if self.queues != ['default']:
+            self.queue_name = '%s-%s' % (queue_name, '-'.join(self.queues))
         
         self.pidfile = options.pidfile or '/var/run/djutils-%s.pid' % self.queue_name
         self.logfile = options.logfile or '/var/log/djutils-%s.log' % self.queue_name
@@ -53,13 +168,46 @@ class QueueDaemon(Daemon):
         self.max_delay = float(options.max_delay)
         self.backoff_factor = float(options.backoff)
         self.threads = int(options.threads)
+        self.processes = int(options.processes)
+        self.greenlets = int(options.greenlets)
+        self.prefetch = int(options.prefetch)
+        self.window = int(options.window or (
+            (self.processes or self.greenlets or self.threads) + self.prefetch
+        ))
         self.periodic_commands = not options.no_periodic
+        self.scheduler_interval = float(options.scheduler_interval)
+        self.lease = float(options.lease)
+        self._purged_at = clock()
+        
+        # identifies this consumer when holding the periodic command lease
+        self.consumer_id = uuid.uuid4().hex
 
         if self.backoff_factor < 1.0:
             raise ValueError, 'backoff must be greater than or equal to 1'
         
         if self.threads < 1:
             raise ValueError, 'threads must be at least 1'
+        
+        if self.processes < 0:
+            raise ValueError, 'processes must not be negative'
+        
+        if self.greenlets < 0:
+            raise ValueError, 'greenlets must not be negative'
+        
+        if self.scheduler_interval <= 0:
+            raise ValueError, 'scheduler interval must be greater than 0'
+        
+        if self.lease <= 0:
+            raise ValueError, 'lease must be greater than 0'
+        
+        if self.processes and self.greenlets:
+            raise ValueError, 'processes and greenlets cannot be used together'
+        
+        if self.prefetch < 1:
+            raise ValueError, 'prefetch must be at least 1'
+        
+        if self.window < 1:
+            raise ValueError, 'window must be at least 1'
          
         # initialize delay
         self.delay = self.default_delay
@@ -85,27 +233,303 @@ class QueueDaemon(Daemon):
         
         return periodic_command_thread
     
+    def start_scheduler_thread(self):
+        scheduler_thread = threading.Thread(target=self.promote_scheduled_commands)
+        scheduler_thread.daemon = True
+        
+        self.logger.info('Starting scheduled command thread')
+        scheduler_thread.start()
+        
+        return scheduler_thread
+    
+    def promote_scheduled(self, batch_size=1000):
+        """
+        Move any scheduled messages that are due onto the queue, a batch at a
+        time, returning the total number moved
+        """
+        total = 0
+        while 1:
+            promoted = self.invoker.promote_scheduled(limit=batch_size)
+            total += promoted
+            if promoted < batch_size:
+                return total
+    
+    def promote_scheduled_commands(self):
+        while True:
+            try:
+                promoted = self.promote_scheduled()
+                if promoted:
+                    self.logger.info('Promoted %d scheduled commands' % promoted)
+            except:
+                self.logger.error('error promoting scheduled commands', exc_info=1)
+            
+            try:
+                requeued = self.invoker.requeue_expired()
+                if requeued:
+                    self.logger.warn('Requeued %d unacknowledged messages' % requeued)
+            except:
+                self.logger.error('error requeueing unacknowledged messages', exc_info=1)
+            
+            try:
+                self.invoker.metrics.maybe_flush()
+            except:
+                self.logger.error('error writing queue metrics', exc_info=1)
+            
+            try:
+                self.invoker.sync()
+            except:
+                self.logger.error('error syncing the queue', exc_info=1)
+            
+            try:
+                self.purge_results()
+            except:
+                self.logger.error('error removing expired results', exc_info=1)
+            
+            time.sleep(self.scheduler_interval)
+    
+    def purge_results(self):
+        """
+        Remove expired results from the result store, if one is configured,
+        every ``purge_interval`` seconds
+        """
+        if self.invoker.result_store and clock() - self._purged_at >= self.purge_interval:
+            self._purged_at = clock()
+            self.invoker.result_store.purge_expired()
+    
     def _queue_worker(self):
         """
         A worker thread that will chew on dequeued messages
         """
         while 1:
             message = self._queue.get()
-            self._queue.task_done()
             
             try:
-                command = registry.get_command_for_message(message)
-                command.execute()
-            except QueueException:
-                # log error
-                self.logger.warn('queue exception raised', exc_info=1)
+                self.execute_message(message)
             except:
-                self.logger.error('exception encountered, exiting thread', exc_info=1)
-                self._error.set()
+                self.logger.error('unable to handle message', exc_info=1)
+            finally:
+                self.finish_message(message)
+                self._queue.task_done()
+    
+    def execute_message(self, message):
+        try:
+            command = registry.get_command_for_message(message)
+        except Exception:
+            # any message that cannot be decoded, whatever the reason
+            tb = traceback.format_exc()
+            try:
+                self.invoker.bury(message)
+            except:
+                self.report('error', tb + traceback.format_exc())
+            else:
+                self.report('invalid', tb)
+                self.acknowledge(message, 'invalid')
+            return
+        
+        if 'z' in command.headers:
+            self.log_compression(command, message)
+        
+        start = clock()
+        status, tb = execute_command(self.invoker, command)
+        self.record_metrics(message, status, clock() - start)
+        self.report(status, tb)
+        self.acknowledge(message, status)
+    
+    def acknowledge(self, message, status):
+        """
+        Acknowledge a message once it has been dealt with.  A message whose
+        failure could not be handled is left reserved, it is delivered again
+        once its visibility timeout expires
+        """
+        if status == 'error':
+            return
+        try:
+            self.invoker.ack(message)
+        except:
+            self.logger.error('unable to acknowledge message', exc_info=1)
+    
+    def record_metrics(self, message, status, duration):
+        """
+        Record how long a message spent in the queue, measured from when it
+        became available to consumers, and how long it took to execute
+        """
+        try:
+            klass = registry.get_class_for_message(message)
+            headers = registry.get_headers_for_message(message)
+        except Exception:
+            return
+        
+        wait = None
+        if 't' in headers:
+            wait = max(time.time() - duration - float(headers['t']), 0)
+        
+        self.invoker.metrics.record_execution(
+            registry.command_to_string(klass), status, wait, duration)
+    
+    def report(self, status, tb):
+        """
+        Log the outcome of executing a message.  Failing commands are retried
+        or moved to the dead letter queue, the consumer only shuts down if a
+        failed message could not be put anywhere
+        """
+        if status == 'warn':
+            self.logger.warn('queue exception raised\n%s' % tb)
+        elif status == 'invalid':
+            self.logger.error('unable to load message, moved to dead letter queue\n%s' % tb)
+        elif status == 'retry':
+            self.logger.warn('exception encountered, command will be retried\n%s' % tb)
+        elif status == 'dead':
+            self.logger.error('exception encountered, command moved to dead letter queue\n%s' % tb)
+        elif status == 'error':
+            self.logger.error('unable to handle failed message, shutting down\n%s' % tb)
+            self._error.set()
+    
+    def describe_message(self, message):
+        """
+        Identify a message in the log by its command class and task id rather
+        than its payload, which may be binary or large
+        """
+        try:
+            klass = registry.get_class_for_message(message)
+            headers = registry.get_headers_for_message(message)
+        except Exception:
+            return 'unreadable message'
+        return '%s %s' % (registry.command_to_string(klass), headers.get('id', ''))
+    
+    def log_compression(self, command, message):
+        original = int(command.headers['o'])
+        self.logger.info('%s message compressed with %s: %d bytes -> %d bytes (%.2f)' % (
+            type(command).__name__, command.headers['z'], original, len(message),
+            float(len(message)) / original))
+    
+    def acquire_slots(self, n):
+        """
+        Reserve room for up to 'n' messages in the window of in-flight
+        messages, blocking while the window is full.  Returns the number of
+        slots actually reserved
+        """
+        self._window_cond.acquire()
+        try:
+            while self._in_flight >= self.window:
+                self._window_cond.wait()
+            n = min(n, self.window - self._in_flight)
+            self._in_flight += n
+            return n
+        finally:
+            self._window_cond.release()
+    
+    def release_slots(self, n):
+        if n < 1:
+            return
+        self._window_cond.acquire()
+        try:
+            self._in_flight -= n
+            self._window_cond.notify()
+        finally:
+            self._window_cond.release()
+    
+    def initialize_window(self):
+        self._error = threading.Event()
+        
+        # number of messages handed to the workers that have not finished
+        self._in_flight = 0
+        self._window_cond = threading.Condition()
+        
+        # messages held back by their command's concurrency or rate limit, as
+        # a list of (time when to try again, message, command class, time by
+        # which it must be dispatched)
+        self.throttle = Throttle()
+        self._deferred = []
+    
+    def finish_message(self, message):
+        """
+        Called once a worker is done with a message
+        """
+        self.release_slots(1)
+        
+        try:
+            klass = registry.get_class_for_message(message)
+        except QueueException:
+            return
+        if self.throttle.is_limited(klass):
+            self.throttle.release(klass)
+    
+    def submit(self, message):
+        """
+        Dispatch a message, unless its command is over its concurrency or rate
+        limit -- then the message is deferred and its slot in the window freed
+        rather than tying up a worker, so other commands keep flowing
+        """
+        try:
+            klass = registry.get_class_for_message(message)
+        except QueueException:
+            # the worker will move it to the dead letter queue
+            klass = None
+        
+        if klass is not None and self.throttle.is_limited(klass):
+            wait = self.throttle.acquire(klass)
+            if wait:
+                self.release_slots(1)
+                self.defer(message, klass, wait)
+                return
+        
+        self.logger.info('Processing: %s' % self.describe_message(message))
+        self.dispatch(message)
+    
+    def defer(self, message, klass, wait, deadline=None):
+        """
+        Hold a message back for 'wait' seconds.  With acks a message held past
+        its visibility timeout would be delivered again, so it must be
+        dispatched well before then -- a message that cannot be is let go
+        without being acknowledged, and is delivered again once its
+        reservation expires
+        """
+        now = clock()
+        if deadline is None:
+            deadline = float('inf')
+            if self.invoker.acks and self.invoker.queue.reserves:
+                deadline = now + self.invoker.visibility_timeout / 2.0
+        
+        if now + wait < deadline:
+            self._deferred.append((now + wait, message, klass, deadline))
+        else:
+            self.logger.info('Releasing: %s until its reservation expires' % self.describe_message(message))
+    
+    def get_deferred_wait(self):
+        """
+        The number of seconds until the next deferred message is ready, or
+        None if no messages are deferred
+        """
+        if self._deferred:
+            return max(min([item[0] for item in self._deferred]) - clock(), 0)
+    
+    def dispatch_deferred(self):
+        """
+        Dispatch deferred messages whose wait is over, in the order they were
+        deferred
+        """
+        if not self._deferred:
+            return
+        
+        now = clock()
+        deferred, self._deferred = self._deferred, []
+        
+        for ready_at, message, klass, deadline in deferred:
+            if ready_at > now:
+                self._deferred.append((ready_at, message, klass, deadline))
+                continue
+            
+            wait = self.throttle.acquire(klass)
+            if wait:
+                self.defer(message, klass, wait, deadline)
+            else:
+                self.acquire_slots(1)
+                self.logger.info('Processing: %s' % self.describe_message(message))
+                self.dispatch(message)
     
     def initialize_threads(self):
+        self.initialize_window()
         self._queue = Queue.Queue()
-        self._error = threading.Event()
         self._threads = []
         
         for i in range(self.threads):
@@ -116,21 +540,94 @@ class QueueDaemon(Daemon):
     def start_workers(self):
         [t.start() for t in self._threads]
     
+    def initialize_pool(self):
+        """
+        Fork the pool of worker processes -- this happens after django has
+        been set up and the commands autodiscovered, so the workers share the
+        parent's memory copy-on-write
+        """
+        self.initialize_window()
+        self._pool = multiprocessing.Pool(self.processes, initialize_process)
+    
+    def initialize_greenlets(self):
+        """
+        Execute commands in a pool of greenlets, which lets a large number of
+        I/O-bound commands run concurrently in a single process.  Requires
+        gevent, and the standard library must have been monkey-patched
+        """
+        from gevent import monkey
+        from gevent.pool import Pool
+        
+        self.initialize_window()
+        self._pool = Pool(self.greenlets)
+        
+        # once threading is patched every greenlet opens database connections
+        # of its own, which have to be closed when it finishes
+        self._close_connections = monkey.is_module_patched('threading')
+    
+    def _greenlet_worker(self, message):
+        try:
+            self.execute_message(message)
+        except:
+            self.logger.error('unable to handle message', exc_info=1)
+        finally:
+            self.finish_message(message)
+            if self._close_connections:
+                for conn in connections.all():
+                    conn.close()
+    
+    def dispatch(self, message):
+        if self.greenlets:
+            self._pool.spawn(self._greenlet_worker, message)
+        elif self.processes:
+            self._pool.apply_async(
+                execute_in_process,
+                (self.invoker.name, message),
+                callback=lambda result: self._process_callback(message, result)
+            )
+        else:
+            self._queue.put(message)
+    
+    def _process_callback(self, message, result):
+        """
+        Called in the parent when a pool worker finishes with a message
+        """
+        status, tb, duration = result
+        try:
+            if duration is not None:
+                self.record_metrics(message, status, duration)
+            self.report(status, tb)
+            self.acknowledge(message, status)
+        except:
+            # raising here would stop the pool delivering any more results
+            self.logger.error('unable to handle result', exc_info=1)
+        finally:
+            self.finish_message(message)
+    
     def run(self):
         """
         Entry-point of the daemon -- in what might be a premature optimization,
         I've chosen to keep the code paths separate depending on whether the
         periodic command thread is started.
         """
-        self.logger.info('Initializing daemon with options:\npidfile: %s\nlogfile: %s\ndelay: %s\nbackoff: %s\nthreads: %s' % (
-            self.pidfile, self.logfile, self.delay, self.backoff_factor, self.threads))
+        self.logger.info('Initializing daemon with options:\npidfile: %s\nlogfile: %s\nqueues: %s\ndelay: %s\nbackoff: %s\nthreads: %s\nprocesses: %s\ngreenlets: %s\nprefetch: %s\nwindow: %s' % (
+            self.pidfile, self.logfile, ', '.join(self.queues), self.delay, self.backoff_factor, self.threads, self.processes, self.greenlets, self.prefetch, self.window))
 
         self.logger.info('Loaded classes:\n%s' % '\n'.join([
             klass for klass in registry._registry
         ]))
 
-        self.initialize_threads()
-        self.start_workers()
+        # every queue is consumed with its own workers, this daemon consumes
+        # the first in the main thread and the others in threads of their own
+        consumers = [self] + [self.get_queue_consumer(name) for name in self.queues[1:]]
+        for consumer in consumers:
+            consumer.initialize_workers()
+        
+        # threads are only started once every process pool has been forked
+        for consumer in consumers:
+            consumer.start_threads()
+        
+        self._queue_threads = [consumer.start_queue_thread() for consumer in consumers[1:]]
         
         try:
             if self.periodic_commands:
@@ -139,6 +636,56 @@ class QueueDaemon(Daemon):
                 self.run_only_queue()
         except:
             self.logger.error('error', exc_info=1)
+        
+        for consumer in consumers:
+            if consumer.processes:
+                consumer._pool.terminate()
+    
+    def initialize_workers(self):
+        if self.greenlets:
+            self.initialize_greenlets()
+        elif self.processes:
+            self.initialize_pool()
+        else:
+            self.initialize_threads()
+    
+    def start_threads(self):
+        if not (self.greenlets or self.processes):
+            self.start_workers()
+        self.start_scheduler_thread()
+    
+    def get_queue_consumer(self, name):
+        """
+        Return a copy of the daemon that consumes the named queue, it has the
+        same options but workers, window and throttling of its own
+        """
+        consumer = copy.copy(self)
+        consumer.invoker = get_invoker(name)
+        consumer.delay = self.default_delay
+        return consumer
+    
+    def start_queue_thread(self):
+        queue_thread = threading.Thread(target=self.consume_queue)
+        queue_thread.daemon = True
+        
+        self.logger.info('Starting consumer thread for %s' % self.invoker.queue.name)
+        queue_thread.start()
+        
+        return queue_thread
+    
+    def consume_queue(self):
+        try:
+            while 1:
+                self.process_message()
+        except:
+            self.logger.error('error consuming %s' % self.invoker.queue.name, exc_info=1)
+    
+    def queue_threads_alive(self):
+        for queue_thread in self._queue_threads:
+            if not queue_thread.is_alive():
+                self.logger.error('Consumer thread died, shutting down')
+                return False
+        return True
     
     def run_with_periodic_commands(self):
         """
@@ -148,52 +695,141 @@ class QueueDaemon(Daemon):
         """
         t = self.start_periodic_command_thread()
         
-        while t.is_alive():
+        while t.is_alive() and self.queue_threads_alive():
             self.process_message()
         
-        self.logger.error('Periodic command thread died, shutting down')
+        if not t.is_alive():
+            self.logger.error('Periodic command thread died, shutting down')
     
     def run_only_queue(self):
         """
         Pull messages from the queue until shut down or an unhandled exception
         is encountered while dequeue-ing and processing messages
         """
-        while 1:
+        while self.queue_threads_alive():
             self.process_message()
     
     def process_message(self):
         if self._error.is_set():
-            raise Exception, 'Error raised by worker thread, shutting down'
+            raise Exception, 'Unable to handle a failed message, shutting down'
+        
+        self.dispatch_deferred()
+        
+        # stop reading while as many messages are held back as fit in the
+        # window, rather than pulling in more that cannot run yet
+        deferred_wait = self.get_deferred_wait()
+        if len(self._deferred) >= self.window:
+            delay = min(deferred_wait, self.max_delay)
+            self.logger.info('Too many messages held back, waiting for: %s' % delay)
+            time.sleep(delay)
+            return
         
-        message = invoker.read()
+        # only read as many messages as there is room for in the window, the
+        # workers free up slots as they finish executing messages
+        slots = self.acquire_slots(self.prefetch)
         
-        if message:
-            self.logger.info('Processing: %s' % message)
+        # a blocking read must return in time to dispatch deferred messages
+        messages = self.invoker.read_many(slots, deferred_wait)
+        self.release_slots(slots - len(messages))
+        
+        if messages:
             self.delay = self.default_delay
-            self._queue.put(message)
-            self._queue.join()
+            for message in messages:
+                self.submit(message)
         else:
             if self.delay > self.max_delay:
                 self.delay = self.max_delay
             
-            self.logger.info('No messages, sleeping for: %s' % self.delay)
+            delay = self.delay
+            if deferred_wait is not None:
+                delay = min(delay, deferred_wait)
+            
+            self.logger.info('No messages, waiting for: %s' % delay)
             
-            time.sleep(self.delay)
+            # backends that can notify the consumer of new messages return
+            # early, otherwise this sleeps for the full delay
+            self.invoker.wait(delay)
             self.delay *= self.backoff_factor
     
     def enqueue_periodic_commands(self):
+        """
+        Only the consumer holding the leader lease enqueues periodic commands.
+        The leader sleeps until the next periodic command is due, rather than
+        waking up every minute to check them all, but wakes often enough to
+        renew its lease.  The other consumers try to take the lease over at the
+        same interval
+        """
+        scheduler = None
+        
+        # whether another consumer may have held the lease before this one
+        takeover = False
+        
         while True:
-            start = time.time()
-            self.logger.info('Enqueueing periodic commands')
-            
-            try:
-                invoker.enqueue_periodic_commands()
-            except:
-                self.logger.error('periodic command error, exiting', exc_info=1)
-                raise
+            if self.acquire_leadership():
+                if scheduler is None:
+                    self.logger.info('Acquired the lease to enqueue periodic commands')
+                    scheduler = self.create_scheduler(datetime.datetime.now(), takeover)
+                
+                try:
+                    self.enqueue_due_commands(scheduler, datetime.datetime.now())
+                except:
+                    self.logger.error('periodic command error, exiting', exc_info=1)
+                    raise
+            else:
+                takeover = True
+                if scheduler is not None:
+                    self.logger.warn('Lost the lease to enqueue periodic commands')
+                    scheduler = None
             
-            end = time.time()
-            time.sleep(60 - (end - start))
+            time.sleep(self.get_periodic_wait(scheduler, datetime.datetime.now()))
+    
+    def create_scheduler(self, now, takeover=False):
+        """
+        A consumer taking the lease over from another starts with the next
+        minute, as the previous leader may already have enqueued the commands
+        due this minute
+        """
+        return PeriodicScheduler(
+            registry.get_periodic_commands(),
+            now,
+            current_minute=not takeover
+        )
+    
+    def get_periodic_wait(self, scheduler, now, ticks=None):
+        """
+        The number of seconds to sleep before checking the lease and the
+        periodic commands again
+        """
+        wait = self.lease / 3.0
+        if scheduler is not None:
+            # a command may be due right away, so 0 is a valid wait
+            due_in = scheduler.wait_time(now, ticks)
+            if due_in is not None:
+                wait = min(wait, due_in)
+        return wait
+    
+    def acquire_leadership(self):
+        """
+        Acquire or renew the lease on enqueueing periodic commands
+        """
+        try:
+            # the lease is always held on the default queue, so consumers of
+            # different queues still elect a single leader
+            return invoker.acquire_lease('periodic', self.consumer_id, self.lease)
+        except:
+            self.logger.error('unable to acquire the periodic command lease', exc_info=1)
+            return False
+    
+    def enqueue_due_commands(self, scheduler, now, ticks=None):
+        """
+        Enqueue every periodic command that is due as of 'now', including any
+        runs that were missed.  Returns the number of commands enqueued
+        """
+        due = scheduler.pop_due(now, ticks)
+        for dt, command in due:
+            self.logger.info('Enqueueing periodic command %s for %s' % (type(command).__name__, dt))
+            self.invoker.enqueue(type(command)())
+        return len(due)
 
 def get_parser():
     parser = OptionParser(usage='%prog [options]')
@@ -209,10 +845,24 @@ def get_parser():
         help='Destination for pid file')
     parser.add_option('--logfile', '-l', dest='logfile', default='',
         help='Destination for log file')
+    parser.add_option('--queues', '-q', dest='queues', default='',
+        help='Comma-separated names of the queues to consume, each with its own workers - default = the default queue')
     parser.add_option('--no-periodic', '-n', dest='no_periodic', action='store_true',
         default=False, help='Do not enqueue periodic commands')
+    parser.add_option('--lease', '-L', dest='lease', default=30,
+        help='Length of the lease held by the one consumer that enqueues periodic commands, in seconds - default = 30')
+    parser.add_option('--scheduler-interval', '-s', dest='scheduler_interval', default=1,
+        help='Interval between checks for scheduled commands that are due, in seconds - default = 1')
     parser.add_option('--threads', '-t', dest='threads', default=1,
         help='Number of worker threads, default = 1')
+    parser.add_option('--processes', '-P', dest='processes', default=0,
+        help='Number of worker processes, runs commands in a process pool instead of threads')
+    parser.add_option('--greenlets', '-g', dest='greenlets', default=0,
+        help='Maximum number of concurrent greenlets, runs commands using gevent instead of threads')
+    parser.add_option('--prefetch', '-r', dest='prefetch', default=1,
+        help='Number of messages to read from the queue at once, default = 1')
+    parser.add_option('--window', '-w', dest='window', default=0,
+        help='Maximum number of messages in flight, default = threads + prefetch')
     return parser
 
 if __name__ == '__main__':
@@ -225,12 +875,19 @@ if __name__ == '__main__':
         args = ['start']
     
     if not args:
-        print "usage: %s start|stop|restart" % sys.argv[0]
+        print "usage: %s start|stop|restart|replay" % sys.argv[0]
         sys.exit(2)
     
     # load up all commands.py modules in the installed apps
     autodiscover()
     
+    if args[0] == 'replay':
+        # move everything in the dead letter queues back onto the queues
+        for name in parse_queues(options.queues):
+            print 'Replayed %d messages to %s' % (
+                get_invoker(name).replay_dead_letters(), name)
+        sys.exit(0)
+    
     daemon = QueueDaemon(options)
     
     if not options.foreground:
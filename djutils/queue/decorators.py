@@ -1,12 +1,14 @@
 import datetime
-import re
 
 from django.utils.functional import wraps
 
+from djutils.queue.constants import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL
 from djutils.queue.queue import invoker, QueueCommand, PeriodicQueueCommand
+from djutils.queue.schedules import Crontab, Interval
+from djutils.queue.throttle import parse_rate
 
 
-def create_command(command_class, func, **kwargs):
+def create_command(command_class, func, shard_key=None, **kwargs):
     def execute(self):
         args, kwargs = self.data or ((), {})
         return func(*args, **kwargs)
@@ -16,6 +18,14 @@ def create_command(command_class, func, **kwargs):
         '__module__': func.__module__,
         '__doc__': func.__doc__
     }
+    
+    # the shard key is computed from the same arguments as the function
+    if shard_key is not None:
+        def get_shard_key(self):
+            args, kwargs = self.data or ((), {})
+            return shard_key(*args, **kwargs)
+        attrs['get_shard_key'] = get_shard_key
+    
     attrs.update(kwargs)
     
     klass = type(
@@ -26,20 +36,82 @@ def create_command(command_class, func, **kwargs):
     
     return klass
 
-def queue_command(func):
+def queue_command(func=None, **options):
     """
     Decorator to execute a function out-of-band via the consumer.  Usage::
     
     @queue_command
     def send_email(user, message):
         ... this code executed when dequeued by the consumer ...
+    
+    Any attribute of :class:`QueueCommand` can be overridden by passing it
+    as a keyword argument, for instance a priority (higher priority commands
+    are always executed before lower priority ones) or a retry policy::
+    
+    @queue_command(priority=PRIORITY_HIGH, retries=3, retry_delay=10, retry_backoff=2)
+    def send_password_reset(user):
+        ...
+    
+    To enqueue many calls at once using a single write to the queue, pass an
+    iterable of argument tuples to the ``map`` attribute::
+    
+    send_email.map((user, message) for user in users)
+    
+    To delay execution, use the ``schedule`` attribute with either an 'eta'
+    datetime or a 'countdown' in seconds::
+    
+    send_email.schedule(args=(user, message), countdown=600)
+    
+    The consumer can limit how many of a command run at once, and how often
+    they are started::
+    
+    @queue_command(max_concurrency=2, rate_limit='100/m')
+    def call_external_api(data):
+        ...
+    
+    Unique commands are only enqueued once within their ``unique_window``
+    of seconds, calls with the same arguments are dropped::
+    
+    @queue_command(unique=True, unique_window=60)
+    def recompute_totals(account_id):
+        ...
+    
+    With a sharded queue, calls that share a shard key are stored in order
+    on the same shard.  The key is computed from the call's arguments::
+    
+    @queue_command(shard_key=lambda account_id, amount: account_id)
+    def apply_payment(account_id, amount):
+        ...
     """
-    klass = create_command(QueueCommand, func)
+    for key in options:
+        if key != 'shard_key' and not hasattr(QueueCommand, key):
+            raise TypeError, 'queue_command() got an unexpected keyword argument %s' % key
+    
+    # catch a malformed rate limit now rather than in the consumer
+    if options.get('rate_limit'):
+        parse_rate(options['rate_limit'])
     
-    @wraps(func)
-    def inner_run(*args, **kwargs):
-        invoker.enqueue(klass((args, kwargs)))
-    return inner_run
+    def decorator(func):
+        klass = create_command(QueueCommand, func, **options)
+        
+        @wraps(func)
+        def inner_run(*args, **kwargs):
+            return invoker.enqueue(klass((args, kwargs)))
+        
+        def map(iterable):
+            return invoker.enqueue_many([klass((tuple(args), {})) for args in iterable])
+        
+        def schedule(args=None, kwargs=None, eta=None, countdown=None):
+            command = klass((tuple(args or ()), kwargs or {}))
+            return invoker.enqueue(command, eta=eta, countdown=countdown)
+        
+        inner_run.map = map
+        inner_run.schedule = schedule
+        return inner_run
+    
+    if func is None:
+        return decorator
+    return decorator(func)
 
 def periodic_command(validate_datetime):
     """
@@ -58,24 +130,29 @@ def periodic_command(validate_datetime):
         def method_validate(self, dt):
             return validate_datetime(dt)
         
-        klass = create_command(
-            PeriodicQueueCommand,
-            func,
-            validate_datetime=method_validate
-        )
+        attrs = {'validate_datetime': method_validate}
+        
+        # compiled schedules know when they are next due
+        if hasattr(validate_datetime, 'next_after'):
+            def method_next_after(self, dt):
+                return validate_datetime.next_after(dt)
+            attrs['next_after'] = method_next_after
+        
+        if isinstance(validate_datetime, Interval):
+            attrs['interval'] = validate_datetime.interval
+        
+        klass = create_command(PeriodicQueueCommand, func, **attrs)
         
         return func
     return decorator
 
 
-dash_re = re.compile('(\d+)-(\d+)')
-every_re = re.compile('\*\/(\d+)')
-
 def crontab(month='*', day='*', day_of_week='*', hour='*', minute='*'):
     """
     Convert a "crontab"-style set of parameters into a test function that will
     return True when the given datetime matches the parameters set forth in
-    the crontab.
+    the crontab.  The returned :class:`Crontab` can also compute the next
+    datetime that matches.
     
     Acceptable inputs:
     * = every distinct value
@@ -83,59 +160,15 @@ def crontab(month='*', day='*', day_of_week='*', hour='*', minute='*'):
     m-n = run every time m..n
     m,n = run on m and n
     """
-    validation = (
-        ('m', month, range(1, 13)),
-        ('d', day, range(1, 32)),
-        ('w', day_of_week, range(7)),
-        ('H', hour, range(24)),
-        ('M', minute, range(60))
-    )
-    cron_settings = []
-    min_interval = None
-    
-    for (date_str, value, acceptable) in validation:
-        settings = set([])
-        
-        if isinstance(value, int):
-            value = str(value)
-        
-        for piece in value.split(','):
-            if piece == '*':
-                settings.update(acceptable)
-                continue
-            
-            if piece.isdigit():
-                piece = int(piece)
-                if piece not in acceptable:
-                    raise ValidationError('%d is not a valid input' % piece)
-                settings.add(piece)
-            
-            else:
-                dash_match = dash_re.match(piece)
-                if dash_match:
-                    lhs, rhs = map(int, dash_match.groups())
-                    if lhs not in acceptable or rhs not in acceptable:
-                        raise ValidationError('%s is not a valid input' % piece)
-                    settings.update(range(lhs, rhs+1))
-                    continue
-                
-                every_match = every_re.match(piece)
-                if every_match:
-                    interval = int(every_match.groups()[0])
-                    settings.update(acceptable[::interval])
-        
-        cron_settings.append(sorted(list(settings)))
-    
-    def validate_date(dt):
-        _, m, d, H, M, _, w, _, _ = dt.timetuple()
-        
-        # fix the weekday to be sunday=0
-        w = (w + 1) % 7
-        
-        for (date_piece, selection) in zip([m, d, w, H, M], cron_settings):
-            if date_piece not in selection:
-                return False
-        
-        return True
+    return Crontab(month, day, day_of_week, hour, minute)
+
+def every(seconds=0, minutes=0, hours=0):
+    """
+    A schedule for :func:`periodic_command` that runs the command at a fixed
+    interval, which may be shorter than a minute::
     
-    return validate_date
+    @periodic_command(every(seconds=10))
+    def warm_cache():
+        ...
+    """
+    return Interval(seconds + minutes * 60 + hours * 3600)
@@ -1,2 +1,6 @@
 class QueueException(Exception):
     pass
+
+
+class ResultTimeout(QueueException):
+    pass
@@ -0,0 +1,184 @@
+import atexit
+import bisect
+import logging
+import threading
+import time
+import weakref
+
+from django.core.cache import cache
+from django.core.signals import request_finished
+
+from djutils.queue.throttle import clock
+
+
+logger = logging.getLogger('djutils.queue.logger')
+
+# upper bounds of the latency histogram buckets in milliseconds, with a final
+# bucket for anything slower
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 300000)
+
+FAILED_STATUSES = ('retry', 'dead', 'error')
+
+def percentile(buckets, p):
+    """
+    Estimate the 'p'th percentile, in milliseconds, given the counts of a
+    latency histogram.  Returns the upper bound of the bucket the percentile
+    falls in, or None if the histogram is empty
+    """
+    total = sum(buckets)
+    if not total:
+        return None
+    
+    seen = 0
+    for i, count in enumerate(buckets):
+        seen += count
+        if seen >= total * p / 100.0:
+            return LATENCY_BUCKETS[min(i, len(LATENCY_BUCKETS) - 1)]
+
+# every QueueMetrics in the process, so that counts recorded by a web process
+# are written at the end of the request rather than waiting for a later one
+_instances = weakref.WeakSet()
+
+def flush_all(**kwargs):
+    for metrics in list(_instances):
+        try:
+            metrics.flush()
+        except:
+            logger.error('error writing queue metrics', exc_info=1)
+
+request_finished.connect(flush_all)
+atexit.register(flush_all)
+
+
+class QueueMetrics(object):
+    """
+    Counts the commands of each class that are enqueued, executed and failed,
+    along with histograms of the time they spend in the queue and executing.
+    Counts are accumulated in memory by the minute they were recorded in and
+    periodically added to per-minute totals in django's cache, so that every
+    process using the queue adds to the same numbers -- this requires a cache
+    shared between processes, such as memcached.  Counts are also written at
+    the end of every request and when the process exits
+    """
+    # seconds between writes to the cache and how long the totals are kept
+    flush_interval = 10
+    ttl = 3600
+    
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        
+        # counts waiting to be written, keyed by minute and then by field
+        self._pending = {}
+        self._last_flush = clock()
+        _instances.add(self)
+    
+    def key(self, minute, field):
+        return 'djutils.queue.%s.metrics.%d.%s' % (self.name, minute, field)
+    
+    def add(self, counts):
+        minute = int(time.time() // 60)
+        self._lock.acquire()
+        try:
+            pending = self._pending.setdefault(minute, {})
+            for field, n in counts:
+                pending[field] = pending.get(field, 0) + n
+        finally:
+            self._lock.release()
+    
+    def record_enqueue(self, command_name, n=1):
+        self.add([('%s.enqueued' % command_name, n)])
+    
+    def record_execution(self, command_name, status, wait, duration):
+        """
+        Record the outcome of executing a command, where 'wait' is the number
+        of seconds the message spent in the queue, if known, and 'duration'
+        the number of seconds it took to execute
+        """
+        ms = int(duration * 1000)
+        counts = [
+            ('%s.executed' % command_name, 1),
+            ('%s.exec_ms' % command_name, ms),
+            ('%s.exec.%d' % (command_name, bisect.bisect_left(LATENCY_BUCKETS, ms)), 1),
+        ]
+        
+        if wait is not None:
+            ms = int(wait * 1000)
+            counts.extend([
+                ('%s.waited' % command_name, 1),
+                ('%s.wait_ms' % command_name, ms),
+                ('%s.wait.%d' % (command_name, bisect.bisect_left(LATENCY_BUCKETS, ms)), 1),
+            ])
+        
+        if status in FAILED_STATUSES:
+            counts.append(('%s.failed' % command_name, 1))
+        
+        self.add(counts)
+    
+    def maybe_flush(self):
+        if clock() - self._last_flush >= self.flush_interval:
+            self.flush()
+    
+    def flush(self, minute=None):
+        """
+        Add the counts accumulated since the last flush to the totals for the
+        minutes they were recorded in, or all of them to 'minute' if given
+        """
+        self._lock.acquire()
+        try:
+            pending, self._pending = self._pending, {}
+            self._last_flush = clock()
+        finally:
+            self._lock.release()
+        
+        totals = {}
+        for recorded, counts in pending.items():
+            for field, n in counts.items():
+                key = self.key(recorded if minute is None else minute, field)
+                totals[key] = totals.get(key, 0) + n
+        
+        for key, n in totals.items():
+            cache.add(key, 0, self.ttl)
+            try:
+                cache.incr(key, n)
+            except ValueError:
+                # expired between adding and incrementing
+                cache.set(key, n, self.ttl)
+    
+    def get_minute(self, command_names, minute=None):
+        """
+        Return the totals for a minute, by default the last complete minute,
+        as a dictionary keyed by command name.  Histograms are returned as a
+        list of bucket counts
+        """
+        if minute is None:
+            minute = int(time.time() // 60) - 1
+        
+        counters = ('enqueued', 'executed', 'failed', 'waited', 'wait_ms', 'exec_ms')
+        histograms = ('wait', 'exec')
+        buckets = range(len(LATENCY_BUCKETS) + 1)
+        
+        keys = {}
+        for name in command_names:
+            for field in counters:
+                keys[self.key(minute, '%s.%s' % (name, field))] = (name, field, None)
+            for field in histograms:
+                for i in buckets:
+                    keys[self.key(minute, '%s.%s.%d' % (name, field, i))] = (name, field, i)
+        
+        values = cache.get_many(keys.keys())
+        
+        totals = {}
+        for name in command_names:
+            totals[name] = dict([(field, 0) for field in counters])
+            for field in histograms:
+                totals[name][field] = [0 for i in buckets]
+        
+        for key, value in values.items():
+            name, field, i = keys[key]
+            if i is None:
+                totals[name][field] = int(value)
+            else:
+                totals[name][field][i] = int(value)
+        
+        return totals
@@ -1,18 +1,34 @@
 import datetime
+import logging
 import os
+import uuid
 
 from django.conf import settings
 
+from djutils.queue.constants import PRIORITY_NORMAL
 from djutils.queue.exceptions import QueueException
+from djutils.queue.metrics import QueueMetrics
 from djutils.queue.registry import registry
+from djutils.queue.results import AsyncResult, EagerResult
 from djutils.utils.helpers import load_class
 
 
+logger = logging.getLogger('djutils.queue.logger')
+
+
 def get_queue_class():
     return load_class(getattr(
         settings, 'QUEUE_CLASS', 'djutils.queue.backends.database.DatabaseQueue'
     ))
 
+def get_result_store_class():
+    path = getattr(settings, 'QUEUE_RESULT_STORE', None)
+    if path:
+        return load_class(path)
+
+def create_queue(name):
+    return get_queue_class()(name, getattr(settings, 'QUEUE_CONNECTION', None))
+
 def get_queue_name():
     if hasattr(settings, 'QUEUE_NAME'):
         return settings.QUEUE_NAME
@@ -27,31 +43,320 @@ class Invoker(object):
     up the proper :class:`QueueCommand` for each message
     """
     
-    def __init__(self, queue):
-        self.queue = queue
+    def __init__(self, queue, result_store=None, dead_letter_queue=None, acks=False,
+                 visibility_timeout=300, name=None):
+        # the queues may be given by name, in which case their backends are
+        # created when first used, and created again in a forked process
+        self._queues = {'queue': queue, 'dead_letter_queue': dead_letter_queue}
+        self._backends = {}
+        self._pid = None
+        
+        self.result_store = result_store
+        
+        # when acks are enabled messages are reserved rather than removed when
+        # read, and must be acknowledged once they have been processed
+        self.acks = acks
+        self.visibility_timeout = visibility_timeout
+        
+        self.metrics = QueueMetrics(getattr(queue, 'name', queue))
+        
+        # the name commands use to route themselves to this invoker, None for
+        # the default queue
+        self.name = name
     
-    def write(self, msg):
-        self.queue.write(msg)
+    def get_backend(self, key):
+        if self._pid != os.getpid():
+            self._backends = {}
+            self._pid = os.getpid()
+        
+        if key not in self._backends:
+            queue = self._queues[key]
+            if isinstance(queue, basestring):
+                queue = create_queue(queue)
+            if self._backends.setdefault(key, queue) is queue and key == 'queue':
+                queue.start_consumer(self)
+        return self._backends[key]
+    
+    queue = property(lambda self: self.get_backend('queue'))
+    dead_letter_queue = property(lambda self: self.get_backend('dead_letter_queue'))
     
-    def enqueue(self, command):
+    def write(self, msg, priority=PRIORITY_NORMAL):
+        self.queue.write(msg, priority)
+    
+    def enqueue(self, command, eta=None, countdown=None):
+        """
+        Enqueue a command for execution, returning an :class:`AsyncResult`.
+        To delay execution, pass either a datetime as the 'eta' or a number
+        of seconds as the 'countdown'
+        """
         if getattr(settings, 'QUEUE_ALWAYS_EAGER', False):
             # if the queue is set to always eager, run commands in-process --
             # useful if you're running DEBUG
-            return command.execute()
+            return EagerResult(command.execute())
+        
+        # commands may be routed to a named queue
+        if self.routes(command):
+            return get_invoker(command.queue).enqueue(command, eta, countdown)
+        
+        duplicate = self.get_duplicate(command)
+        if duplicate:
+            return AsyncResult(self.result_store, duplicate)
         
-        self.write(registry.get_message_for_command(command))
+        if countdown is not None:
+            eta = datetime.datetime.now() + datetime.timedelta(seconds=countdown)
+        
+        self.write_command(command, eta)
+        
+        self.metrics.record_enqueue(registry.command_to_string(type(command)))
+        self.metrics.maybe_flush()
+        
+        return AsyncResult(self.result_store, command.task_id)
+    
+    def get_duplicate(self, command):
+        """
+        If the command is unique and an identical command was enqueued within
+        its unique_window, return the task id of that command.  Otherwise the
+        window is claimed for this command
+        """
+        if not command.unique:
+            return None
+        
+        if not command.task_id:
+            command.task_id = uuid.uuid4().hex
+        
+        owner = self.queue.claim_unique(
+            registry.get_unique_key(command),
+            command.task_id,
+            command.unique_window,
+        )
+        if owner != command.task_id:
+            return owner
+    
+    def write_command(self, command, eta=None):
+        message = registry.get_message_for_command(command, eta, self.queue.binary)
+        
+        if eta is not None:
+            self.queue.schedule(message, eta, command.priority)
+        else:
+            self.write(message, command.priority)
+    
+    def write_many(self, messages, priority=PRIORITY_NORMAL):
+        self.queue.write_many(messages, priority)
+    
+    def enqueue_many(self, commands):
+        """
+        Enqueue a list of commands using a single batched write to the queue
+        for each priority, returning a list of :class:`AsyncResult`
+        """
+        commands = list(commands)
+        
+        if getattr(settings, 'QUEUE_ALWAYS_EAGER', False):
+            return [EagerResult(command.execute()) for command in commands]
+        
+        if [command for command in commands if self.routes(command)]:
+            return self.route_many(commands)
+        
+        task_ids = []
+        unique_commands = []
+        for command in commands:
+            duplicate = self.get_duplicate(command)
+            if not duplicate:
+                unique_commands.append(command)
+            task_ids.append(duplicate)
+        
+        self.write_commands(unique_commands)
+        
+        for command in unique_commands:
+            self.metrics.record_enqueue(registry.command_to_string(type(command)))
+        self.metrics.maybe_flush()
+        
+        return [
+            AsyncResult(self.result_store, task_id or command.task_id) \
+                for task_id, command in zip(task_ids, commands)
+        ]
+    
+    def routes(self, command):
+        """
+        Whether the command belongs to the queue of another invoker
+        """
+        return command.queue != self.name and get_invoker(command.queue) is not self
+    
+    def route_many(self, commands):
+        """
+        Enqueue commands bound for different queues with one batch per queue,
+        returning the results in the order the commands were given
+        """
+        by_queue = {}
+        for i, command in enumerate(commands):
+            target = self.routes(command) and get_invoker(command.queue) or self
+            by_queue.setdefault(target, []).append(i)
+        
+        results = [None] * len(commands)
+        for target, indexes in by_queue.items():
+            batch = target.enqueue_many([commands[i] for i in indexes])
+            for i, result in zip(indexes, batch):
+                results[i] = result
+        return results
+    
+    def write_commands(self, commands):
+        by_priority = {}
+        for command in commands:
+            by_priority.setdefault(command.priority, []).append(
+                registry.get_message_for_command(command, binary=self.queue.binary)
+            )
+        
+        for priority, messages in by_priority.items():
+            self.write_many(messages, priority)
+    
+    def promote_scheduled(self, now=None, limit=1000):
+        """
+        Move scheduled messages that are due onto the queue
+        """
+        return self.queue.promote(now or datetime.datetime.now(), limit)
     
     def read(self):
-        return self.queue.read()
+        if self.acks:
+            messages = self.read_many(1)
+            if messages:
+                return messages[0]
+        else:
+            return self.queue.read()
+    
+    def read_many(self, n, timeout=None):
+        """
+        Read up to 'n' messages.  Backends whose reads block until a message
+        is written give up after 'timeout' seconds, if given
+        """
+        if self.acks:
+            return self.queue.reserve_many(n, self.visibility_timeout)
+        if timeout is not None and self.queue.blocking:
+            return self.queue.read_many(n, timeout)
+        return self.queue.read_many(n)
+    
+    def ack(self, msg):
+        """
+        Acknowledge that a message has been processed, if acks are enabled
+        """
+        if self.acks:
+            self.queue.ack(msg)
+    
+    def requeue_expired(self, now=None):
+        """
+        Make messages whose reservation has expired visible to readers again
+        """
+        if self.acks:
+            return self.queue.requeue_expired(now or datetime.datetime.now())
+        return 0
+    
+    def sync(self):
+        self.queue.sync()
+    
+    def wait(self, timeout):
+        """
+        Block until a message may be available or 'timeout' seconds pass
+        """
+        return self.queue.wait(timeout)
+    
+    def acquire_lease(self, key, owner, timeout):
+        """
+        Acquire or renew a lease shared by every consumer of the queue,
+        returning whether 'owner' holds it
+        """
+        return self.queue.acquire_lease(key, owner, timeout)
     
     def dequeue(self):
         msg = self.read()
         
         if msg:
             command = registry.get_command_for_message(msg)
-            command.execute()
+            self.execute(command)
+            self.ack(msg)
             return msg
     
+    def execute(self, command):
+        """
+        Execute a dequeued command, storing the result if a result store has
+        been configured
+        """
+        result = command.execute()
+        if self.result_store and command.store_result and command.task_id:
+            self.store_result(command, result)
+        return result
+    
+    def store_result(self, command, result):
+        """
+        The command has already run by the time its result is stored, so a
+        failure to store the result is logged rather than retrying the command
+        """
+        try:
+            self.result_store.put(command.task_id, result)
+        except:
+            logger.error('unable to store the result of %s' % command.task_id, exc_info=1)
+    
+    def handle_failure(self, command):
+        """
+        Called when executing a dequeued command raises an exception.  If the
+        command has any retries left it is enqueued again after its retry
+        delay, otherwise it is moved to the dead letter queue.  Returns
+        either 'retry' or 'dead'
+        """
+        if command.attempt < command.retries:
+            delay = command.retry_delay * (command.retry_backoff ** command.attempt)
+            command.attempt += 1
+            
+            eta = None
+            if delay:
+                eta = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+            
+            self.write_command(command, eta)
+            return 'retry'
+        
+        if self.dead_letter_queue is None:
+            logger.error('%s %s is out of retries and there is no dead letter queue, dropping it' % (
+                registry.command_to_string(type(command)), command.task_id))
+        else:
+            self.bury(registry.get_message_for_command(command, binary=self.dead_letter_queue.binary))
+        return 'dead'
+    
+    def bury(self, message):
+        """
+        Move a message to the dead letter queue
+        """
+        if self.dead_letter_queue is not None:
+            self.dead_letter_queue.write(message)
+    
+    def replay_dead_letters(self, batch_size=100):
+        """
+        Move every message in the dead letter queue back onto the queue, with
+        their retries reset.  Messages whose command cannot be loaded are left
+        in the dead letter queue.  Returns the number of messages replayed
+        """
+        replayed = 0
+        unknown = []
+        
+        while 1:
+            messages = self.dead_letter_queue.read_many(batch_size)
+            if not messages:
+                break
+            
+            commands = []
+            for message in messages:
+                try:
+                    command = registry.get_command_for_message(message)
+                except Exception:
+                    unknown.append(message)
+                else:
+                    command.attempt = 0
+                    commands.append(command)
+            
+            self.write_commands(commands)
+            replayed += len(commands)
+        
+        if unknown:
+            self.dead_letter_queue.write_many(unknown)
+        
+        return replayed
+    
     def flush(self):
         self.queue.flush()
     
@@ -97,6 +402,47 @@ class QueueCommand(object):
     
     __metaclass__ = QueueCommandMetaClass
     
+    # name of the serializer used to store the command's data, defaults to
+    # the QUEUE_SERIALIZER setting
+    serializer = None
+    
+    # the envelope headers of the message the command was read from
+    headers = {}
+    
+    # commands with a higher priority are executed first
+    priority = PRIORITY_NORMAL
+    
+    # name of the queue the command is enqueued in, None for the default
+    # queue -- consumers started with --queues read from named queues
+    queue = None
+    
+    # unique id assigned when the command is enqueued
+    task_id = None
+    
+    # whether the return value of execute() is saved in the result store
+    store_result = True
+    
+    # number of times to retry the command if it raises an exception, the
+    # delay in seconds before the first retry and the factor by which the
+    # delay grows with each subsequent retry
+    retries = 0
+    retry_delay = 0
+    retry_backoff = 1
+    
+    # number of times execution of the command has already failed
+    attempt = 0
+    
+    # maximum number of commands of this class a consumer runs at once, and
+    # the rate at which it starts them, e.g. '100/m' (per 's', 'm' or 'h')
+    max_concurrency = None
+    rate_limit = None
+    
+    # when unique, enqueueing a command is a no-op if a command of the same
+    # class with the same data was enqueued within the last unique_window
+    # seconds
+    unique = False
+    unique_window = 60
+    
     def __init__(self, data=None):
         """
         Initialize the command object with a receiver and optional data.  The
@@ -112,20 +458,94 @@ class QueueCommand(object):
         """Called by the Invoker when a command is dequeued"""
         self.data = data
 
+    def get_shard_key(self):
+        """
+        Messages with the same shard key are always stored on the same shard
+        of a sharded queue, preserving their order.  By default commands
+        have no shard key and are spread evenly over the shards
+        """
+        return None
+
     def execute(self):
         """Execute any arbitary code here"""
         raise NotImplementedError
 
 
 class PeriodicQueueCommand(QueueCommand):
+    # nothing is around to collect the results
+    store_result = False
+    
+    # if set, the command is run every 'interval' seconds instead of on the
+    # minutes accepted by validate_datetime
+    interval = None
+    
     def validate_datetime(self, dt):
         """Validate that the command should execute at the given datetime"""
         return False
+    
+    def next_after(self, dt):
+        """
+        The next datetime after 'dt' at which the command may need to run --
+        without a compiled schedule this is simply the next minute, at which
+        point :meth:`validate_datetime` is checked
+        """
+        return dt.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
 
 
-# dynamically load up an instance of the Queue class we're using
-Queue = get_queue_class()
-
 queue_name = get_queue_name()
-queue = Queue(queue_name, getattr(settings, 'QUEUE_CONNECTION', None))
-invoker = Invoker(queue)
+
+ResultStore = get_result_store_class()
+if ResultStore:
+    result_store = ResultStore(
+        queue_name,
+        getattr(settings, 'QUEUE_RESULT_CONNECTION', None),
+        getattr(settings, 'QUEUE_RESULT_TTL', 3600),
+    )
+else:
+    result_store = None
+
+# backends are created when first used rather than at import time, so that
+# nothing connects to the queue before a web server forks its workers.
+# messages that could not be executed are stored in a separate queue
+invoker = Invoker(
+    queue_name,
+    result_store,
+    '%s.dead' % queue_name,
+    getattr(settings, 'QUEUE_ACKS', False),
+    getattr(settings, 'QUEUE_VISIBILITY_TIMEOUT', 300),
+)
+
+# invokers of the named queues, created the first time they are used
+invokers = {}
+
+def get_invoker(name=None):
+    """
+    Return the invoker for a named queue, or the default invoker if no name
+    or 'default' is given.  Named queues share the result store but have
+    their own dead letter queue
+    """
+    if name is None or name == 'default':
+        return invoker
+    
+    if name not in invokers:
+        full_name = '%s.%s' % (queue_name, name)
+        invokers.setdefault(name, Invoker(
+            full_name,
+            result_store,
+            '%s.dead' % full_name,
+            invoker.acks,
+            invoker.visibility_timeout,
+            name,
+        ))
+    return invokers[name]
+
+def get_invokers():
+    """
+    Return the default invoker followed by the invokers of every named queue
+    that registered commands are routed to
+    """
+    names = set(invokers.keys())
+    for klass in registry.get_command_classes():
+        if klass.queue not in (None, 'default'):
+            names.add(klass.queue)
+    return [invoker] + [get_invoker(name) for name in sorted(names)]
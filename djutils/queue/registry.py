@@ -2,10 +2,28 @@ try:
     import cPickle as pickle
 except ImportError:
     import pickle
+import base64
+import hashlib
+import pickletools
+import time
+import uuid
+import zlib
 
 from django.conf import settings
 
 from djutils.queue.exceptions import QueueException
+from djutils.queue.serializers import get_compressor, get_serializer, get_write_compressor
+
+
+ENVELOPE_VERSION = '1'
+
+def shard_hash(key):
+    """
+    Hash a shard key, or the name of a shard, to a 32-bit integer
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(str(key)).hexdigest()[:8], 16)
 
 
 class CommandRegistry(object):
@@ -18,17 +36,38 @@ class CommandRegistry(object):
     _registry = {}
     _periodic_commands = []
     
+    # maps compact class ids to the dotted path of the class they identify,
+    # or to None if two registered classes share the same id
+    _class_ids = {}
+    
+    # messages are stored as a versioned envelope:
+    # @<version>:<headers>:<class>:<payload>
+    envelope_template = '@%(VERSION)s:%(HEADERS)s:%(CLASS)s:%(DATA)s'
+    
+    # messages written before the envelope was introduced
     message_template = '%(CLASS)s:%(DATA)s'
 
     def command_to_string(self, command):
         return '%s.%s' % (command.__module__, command.__name__)
     
+    def command_to_id(self, command):
+        """
+        A short, stable identifier for a command class derived from its path
+        """
+        return '#%08x' % (zlib.crc32(self.command_to_string(command)) & 0xffffffff)
+    
     def register(self, command_class):
         klass_str = self.command_to_string(command_class)
         
         if klass_str not in self._registry:
             self._registry[klass_str] = command_class
             
+            class_id = self.command_to_id(command_class)
+            if class_id in self._class_ids:
+                self._class_ids[class_id] = None
+            else:
+                self._class_ids[class_id] = klass_str
+            
             # store an instance in a separate list of periodic commands
             if hasattr(command_class, 'validate_datetime'):
                 self._periodic_commands.append(command_class())
@@ -46,22 +85,154 @@ class CommandRegistry(object):
     def __contains__(self, command_class):
         return str(command_class) in self._registry
 
-    def get_message_for_command(self, command):
-        """Convert a command object to a message for storage in the queue"""
-        return self.message_template % {
-            'CLASS': self.command_to_string(type(command)),
-            'DATA': pickle.dumps(command.get_data())
+    def get_serializer_for_command(self, command):
+        return get_serializer(
+            getattr(command, 'serializer', None) or \
+            getattr(settings, 'QUEUE_SERIALIZER', 'pickle')
+        )
+    
+    def encode_class(self, command_class):
+        """
+        Use the compact class id if enabled and it is unambiguous, otherwise
+        the full dotted path to the class
+        """
+        if getattr(settings, 'QUEUE_COMPACT_CLASS_IDS', False):
+            class_id = self.command_to_id(command_class)
+            if self._class_ids.get(class_id):
+                return class_id
+        return self.command_to_string(command_class)
+    
+    def decode_class(self, klass_str):
+        if klass_str.startswith('#'):
+            klass_str = self._class_ids.get(klass_str) or klass_str
+        
+        klass = self._registry.get(klass_str)
+        if not klass:
+            raise QueueException, '%s not found in CommandRegistry' % klass_str
+        return klass
+    
+    def encode_headers(self, headers):
+        return ','.join(['%s=%s' % item for item in sorted(headers.items())])
+    
+    def decode_headers(self, header_str):
+        if not header_str:
+            return {}
+        return dict([piece.split('=', 1) for piece in header_str.split(',')])
+    
+    def get_unique_key(self, command):
+        """
+        A key identifying commands of the same class enqueued with the same
+        data
+        """
+        # cPickle only memoizes objects that are referenced elsewhere, which
+        # would give equal data different pickles -- optimizing strips the
+        # unused memo operations
+        data = pickletools.optimize(pickle.dumps(command.get_data(), pickle.HIGHEST_PROTOCOL))
+        return hashlib.sha1('%s:%s' % (self.command_to_string(type(command)), data)).hexdigest()
+    
+    def get_message_for_command(self, command, eta=None, binary=False):
+        """
+        Convert a command object to a message for storage in the queue.
+        Binary payloads are base64-encoded unless 'binary' is set, meaning the
+        queue can store arbitrary bytes
+        """
+        serializer = self.get_serializer_for_command(command)
+        
+        # every message gets a unique id, which is also used to look up the
+        # command's result
+        if not command.task_id:
+            command.task_id = uuid.uuid4().hex
+        headers = {'s': serializer.name, 'id': command.task_id}
+        
+        # the time the message is available to consumers, used to measure how
+        # long messages spend in the queue
+        if eta is not None:
+            headers['t'] = '%.3f' % (time.mktime(eta.timetuple()) + eta.microsecond / 1e6)
+        else:
+            headers['t'] = '%.3f' % time.time()
+        if command.attempt:
+            headers['r'] = command.attempt
+        
+        # the hashed shard key lets a sharded queue route the message without
+        # decoding it
+        shard_key = command.get_shard_key()
+        if shard_key is not None:
+            headers['k'] = '%08x' % shard_hash(shard_key)
+        
+        data = serializer.dumps(command.get_data())
+        
+        # compress payloads larger than the threshold, recording the original
+        # size so the consumer can report the compression ratio
+        threshold = getattr(settings, 'QUEUE_COMPRESSION_THRESHOLD', None)
+        if threshold is not None and len(data) >= threshold:
+            compressor = get_write_compressor(getattr(settings, 'QUEUE_COMPRESSION', 'zlib'))
+            headers['z'] = compressor.name
+            headers['o'] = len(data)
+            data = compressor.compress(data)
+        
+        if not binary and (serializer.binary or 'z' in headers):
+            # messages must be safe to store as text
+            data = base64.b64encode(data)
+            headers['e'] = 'b64'
+        
+        return self.envelope_template % {
+            'VERSION': ENVELOPE_VERSION,
+            'HEADERS': self.encode_headers(headers),
+            'CLASS': self.encode_class(type(command)),
+            'DATA': data,
         }
 
     def get_command_for_message(self, msg):
         """Convert a message from the queue into a command"""
+        if not msg.startswith('@'):
+            return self.get_command_for_legacy_message(msg)
+        
         # parse out the pieces from the enqueued message
-        klass_str, data = msg.split(':', 1)
+        version, header_str, klass_str, data = msg.split(':', 3)
+        if version != '@' + ENVELOPE_VERSION:
+            raise QueueException, 'Unsupported message version %s' % version[1:]
         
-        klass = self._registry.get(klass_str)
-        if not klass:
-            raise QueueException, '%s not found in CommandRegistry' % klass_str
+        klass = self.decode_class(klass_str)
+        headers = self.decode_headers(header_str)
+        
+        if headers.get('e') == 'b64':
+            data = base64.b64decode(data)
+        
+        if 'z' in headers:
+            data = get_compressor(headers['z']).decompress(data)
         
+        command = klass(get_serializer(headers['s']).loads(data))
+        command.headers = headers
+        command.task_id = headers.get('id')
+        command.attempt = int(headers.get('r', 0))
+        return command
+    
+    def get_class_for_message(self, msg):
+        """Load the command class of a message without decoding its data"""
+        if msg.startswith('@'):
+            pieces = msg.split(':', 3)
+            if len(pieces) == 4:
+                return self.decode_class(pieces[2])
+        elif ':' in msg:
+            return self.decode_class(msg.split(':', 1)[0])
+        raise QueueException, 'Malformed message'
+    
+    def get_headers_for_message(self, msg):
+        """Read the envelope headers of a message without decoding its data"""
+        if msg.startswith('@') and msg.count(':') >= 3:
+            return self.decode_headers(msg.split(':', 3)[1])
+        return {}
+    
+    def get_command_names(self):
+        return self._registry.keys()
+    
+    def get_command_classes(self):
+        return self._registry.values()
+    
+    def get_command_for_legacy_message(self, msg):
+        """Convert a message written with a protocol 0 pickle into a command"""
+        klass_str, data = msg.split(':', 1)
+        klass = self.decode_class(klass_str)
         return klass(pickle.loads(str(data)))
     
     def get_periodic_commands(self):
@@ -0,0 +1,219 @@
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import base64
+import datetime
+import time
+
+from django.core.cache import cache
+from django.db import transaction, IntegrityError
+
+from djutils.models import QueueResult
+from djutils.queue.exceptions import QueueException, ResultTimeout
+
+
+class EmptyResult(object):
+    pass
+
+
+class BaseResultStore(object):
+    """
+    Stores the return values of commands executed by the consumer so they
+    can be retrieved by the code that enqueued them.  Results expire after
+    'ttl' seconds
+    """
+    # when polling for a result, initial time to sleep, rate of backoff, maximum
+    backoff = (0.01, 1.5, 1.0)
+    
+    def __init__(self, name, connection, ttl):
+        self.name = name
+        self.connection = connection
+        self.ttl = ttl
+    
+    def put(self, task_id, value):
+        raise NotImplementedError
+    
+    def get(self, task_id):
+        """
+        Return the stored value, or EmptyResult if there is none
+        """
+        raise NotImplementedError
+    
+    def purge_expired(self):
+        """
+        Remove expired results, for stores that do not expire them on their
+        own.  Called periodically by the consumer
+        """
+        pass
+    
+    def wait(self, task_id, timeout=None):
+        """
+        Block until a result is available or 'timeout' seconds have elapsed,
+        returning EmptyResult in the latter case.  The default implementation
+        polls the store, backing off between attempts
+        """
+        delay, factor, max_delay = self.backoff
+        if timeout is not None:
+            deadline = time.time() + timeout
+        
+        while 1:
+            value = self.get(task_id)
+            if value is not EmptyResult:
+                return value
+            
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return EmptyResult
+                delay = min(delay, remaining)
+            
+            time.sleep(delay)
+            delay = min(delay * factor, max_delay)
+
+
+class CacheResultStore(BaseResultStore):
+    """
+    Stores results using django's cache
+    """
+    def key(self, task_id):
+        return 'djutils.queue.%s.result.%s' % (self.name, task_id)
+    
+    def put(self, task_id, value):
+        # wrap the value so a result of None can be told apart from a miss
+        cache.set(self.key(task_id), (value,), self.ttl)
+    
+    def get(self, task_id):
+        wrapped = cache.get(self.key(task_id))
+        if wrapped is None:
+            return EmptyResult
+        return wrapped[0]
+
+
+class DatabaseResultStore(BaseResultStore):
+    """
+    Stores results in the database, expired results are removed periodically
+    by the consumer
+    """
+    def put(self, task_id, value):
+        now = datetime.datetime.now()
+        sid = transaction.savepoint()
+        try:
+            QueueResult.objects.create(
+                task_id=task_id,
+                result=base64.b64encode(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+                expires=now + datetime.timedelta(seconds=self.ttl),
+            )
+        except IntegrityError:
+            # the message was delivered again after its result was stored
+            transaction.savepoint_rollback(sid)
+        else:
+            transaction.savepoint_commit(sid)
+    
+    def get(self, task_id):
+        try:
+            result = QueueResult.objects.get(
+                task_id=task_id,
+                expires__gt=datetime.datetime.now()
+            )
+        except QueueResult.DoesNotExist:
+            return EmptyResult
+        return pickle.loads(base64.b64decode(result.result))
+    
+    def purge_expired(self):
+        QueueResult.objects.filter(expires__lte=datetime.datetime.now()).delete()
+
+
+class RedisResultStore(BaseResultStore):
+    """
+    Stores each result in a single-item list with an expiry.  Waiting for a
+    result blocks on the list rather than polling for it
+    """
+    def __init__(self, name, connection, ttl):
+        """
+        QUEUE_RESULT_CONNECTION = 'host:port:database' or defaults to localhost:6379:0
+        """
+        from djutils.queue.backends.redis_backend import get_client
+        
+        super(RedisResultStore, self).__init__(name, connection, ttl)
+        self.get_client = get_client
+    
+    @property
+    def conn(self):
+        # looked up on each use, so a forked process uses a client of its own
+        return self.get_client(self.connection)
+    
+    def key(self, task_id):
+        return 'djutils.redis.%s.result.%s' % (self.name, task_id)
+    
+    def put(self, task_id, value):
+        key = self.key(task_id)
+        pipe = self.conn.pipeline()
+        pipe.rpush(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+    
+    def get(self, task_id):
+        data = self.conn.lindex(self.key(task_id), 0)
+        if data is None:
+            return EmptyResult
+        return pickle.loads(data)
+    
+    def wait(self, task_id, timeout=None):
+        # popping and pushing the item back onto the same list blocks until the
+        # result is available without removing it.  redis treats a timeout of
+        # 0 as "wait forever" and only accepts whole seconds
+        if timeout is None:
+            timeout = 0
+        else:
+            timeout = max(int(round(timeout)), 1)
+        
+        key = self.key(task_id)
+        data = self.conn.brpoplpush(key, key, timeout)
+        if data is None:
+            return EmptyResult
+        return pickle.loads(data)
+
+
+class AsyncResult(object):
+    """
+    A handle to the result of an enqueued command
+    """
+    def __init__(self, result_store, task_id):
+        self.result_store = result_store
+        self.task_id = task_id
+    
+    def _get_store(self):
+        if self.result_store is None:
+            raise QueueException, 'No result store has been configured'
+        return self.result_store
+    
+    def ready(self):
+        return self._get_store().get(self.task_id) is not EmptyResult
+    
+    def get(self, timeout=None):
+        """
+        Block until the command has been executed and return its result,
+        raising :class:`ResultTimeout` if 'timeout' seconds pass first
+        """
+        value = self._get_store().wait(self.task_id, timeout)
+        if value is EmptyResult:
+            raise ResultTimeout, 'No result for %s after %s seconds' % (self.task_id, timeout)
+        return value
+
+
+class EagerResult(object):
+    """
+    The result of a command executed in-process because QUEUE_ALWAYS_EAGER
+    is set
+    """
+    task_id = None
+    
+    def __init__(self, value):
+        self.value = value
+    
+    def ready(self):
+        return True
+    
+    def get(self, timeout=None):
+        return self.value
@@ -0,0 +1,217 @@
+import datetime
+import heapq
+import re
+
+from django.core.exceptions import ValidationError
+
+from djutils.queue.throttle import clock
+
+
+dash_re = re.compile('^(\d+)-(\d+)$')
+every_re = re.compile('^\*\/(\d+)$')
+
+def parse_field(value, lowest, highest):
+    """
+    Convert one field of a crontab into a bitmask of the values it matches,
+    where bit 'n' is set if the value 'n' matches
+    """
+    acceptable = range(lowest, highest + 1)
+    mask = 0
+    
+    for piece in str(value).split(','):
+        if piece == '*':
+            values = acceptable
+        elif piece.isdigit():
+            values = [int(piece)]
+        elif dash_re.match(piece):
+            lhs, rhs = map(int, dash_re.match(piece).groups())
+            if lhs not in acceptable or rhs not in acceptable:
+                raise ValidationError('%s is not a valid input' % piece)
+            values = range(lhs, rhs + 1)
+        elif every_re.match(piece):
+            values = acceptable[::int(every_re.match(piece).groups()[0])]
+        else:
+            raise ValidationError('%s is not a valid input' % piece)
+        
+        for n in values:
+            if n not in acceptable:
+                raise ValidationError('%d is not a valid input' % n)
+            mask |= 1 << n
+    
+    return mask
+
+def next_bit(mask, start):
+    """
+    Return the lowest value at or above 'start' that is set in the bitmask, or
+    None if there is no such value
+    """
+    mask >>= start
+    if not mask:
+        return None
+    return start + (mask & -mask).bit_length() - 1
+
+
+class Crontab(object):
+    """
+    A compiled crontab schedule.  Calling it with a datetime returns whether
+    the datetime matches, and :meth:`next_after` finds the next datetime that
+    does, without having to test every minute in between
+    """
+    # give up looking for a matching date after this many years, for
+    # schedules such as february 30th
+    max_years = 30
+    
+    def __init__(self, month='*', day='*', day_of_week='*', hour='*', minute='*'):
+        self.month = parse_field(month, 1, 12)
+        self.day = parse_field(day, 1, 31)
+        self.day_of_week = parse_field(day_of_week, 0, 6)
+        self.hour = parse_field(hour, 0, 23)
+        self.minute = parse_field(minute, 0, 59)
+    
+    def matches_date(self, dt):
+        # the weekday with sunday=0
+        w = dt.isoweekday() % 7
+        return bool(
+            (self.month >> dt.month) & 1 and
+            (self.day >> dt.day) & 1 and
+            (self.day_of_week >> w) & 1
+        )
+    
+    def __call__(self, dt):
+        return bool(
+            self.matches_date(dt) and
+            (self.hour >> dt.hour) & 1 and
+            (self.minute >> dt.minute) & 1
+        )
+    
+    def next_after(self, dt):
+        """
+        Return the first whole minute after 'dt' that matches, or None if the
+        schedule never matches
+        """
+        dt = dt.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = dt.year + self.max_years
+        
+        while dt.year < limit:
+            month = next_bit(self.month, dt.month)
+            if month is None:
+                dt = datetime.datetime(dt.year + 1, 1, 1)
+                continue
+            if month != dt.month:
+                dt = datetime.datetime(dt.year, month, 1)
+                continue
+            
+            if not self.matches_date(dt):
+                dt = datetime.datetime(dt.year, dt.month, dt.day) + datetime.timedelta(days=1)
+                continue
+            
+            hour = next_bit(self.hour, dt.hour)
+            if hour is None:
+                dt = datetime.datetime(dt.year, dt.month, dt.day) + datetime.timedelta(days=1)
+                continue
+            if hour != dt.hour:
+                dt = dt.replace(hour=hour, minute=0)
+            
+            minute = next_bit(self.minute, dt.minute)
+            if minute is None:
+                dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
+                continue
+            return dt.replace(minute=minute)
+
+
+class Interval(object):
+    """
+    A schedule that runs every so many seconds.  Interval schedules are not
+    tied to the minutes of the wall clock, the consumer runs them on a timer
+    """
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise ValidationError('interval must be greater than 0')
+        self.interval = seconds
+    
+    def __call__(self, dt):
+        return False
+
+
+class PeriodicScheduler(object):
+    """
+    Keeps periodic commands in a heap ordered by the next time each is due,
+    so finding the due commands does not depend on how many there are.
+    Commands with an interval are kept in a separate heap of timer readings
+    """
+    def __init__(self, commands, now, ticks=None, current_minute=True):
+        if ticks is None:
+            ticks = clock()
+        
+        # start from the beginning of the current minute, so commands due this
+        # minute are not skipped -- unless another consumer may already have
+        # enqueued them
+        start = now
+        if current_minute:
+            start = now.replace(second=0, microsecond=0) - datetime.timedelta(minutes=1)
+        
+        self._heap = []
+        self._timers = []
+        for i, command in enumerate(commands):
+            if command.interval:
+                heapq.heappush(self._timers, (ticks + command.interval, i, command))
+            else:
+                self.push(command.next_after(start), i, command)
+    
+    def push(self, dt, i, command):
+        if dt is not None:
+            heapq.heappush(self._heap, (dt, i, command))
+    
+    def wait_time(self, now, ticks=None):
+        """
+        The number of seconds until the next command is due, or None if
+        nothing is scheduled
+        """
+        if ticks is None:
+            ticks = clock()
+        
+        waits = []
+        if self._heap:
+            delta = self._heap[0][0] - now
+            waits.append(delta.days * 86400 + delta.seconds + delta.microseconds / 1e6)
+        if self._timers:
+            waits.append(self._timers[0][0] - ticks)
+        if waits:
+            return max(min(waits), 0)
+    
+    def next_run(self):
+        """
+        The datetime the next command without an interval is due, or None if
+        there is no such command
+        """
+        if self._heap:
+            return self._heap[0][0]
+    
+    def pop_due(self, now, ticks=None):
+        """
+        Return a list of (datetime, command) for every run that is due at or
+        before 'now', in order.  If runs were missed, for instance because the
+        consumer was busy, each of them is returned once -- except for interval
+        commands, which only run once however many intervals were missed
+        """
+        if ticks is None:
+            ticks = clock()
+        
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            dt, i, command = heapq.heappop(self._heap)
+            if command.validate_datetime(dt):
+                due.append((dt, command))
+            self.push(command.next_after(dt), i, command)
+        
+        while self._timers and self._timers[0][0] <= ticks:
+            due_ticks, i, command = heapq.heappop(self._timers)
+            due.append((now - datetime.timedelta(seconds=ticks - due_ticks), command))
+            
+            # the next run is a whole number of intervals after this one, so
+            # the timer does not drift however late this run was
+            missed = int((ticks - due_ticks) / command.interval)
+            heapq.heappush(self._timers, (due_ticks + (missed + 1) * command.interval, i, command))
+        
+        due.sort(key=lambda item: item[0])
+        return due
@@ -0,0 +1,146 @@
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import logging
+import zlib
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+from djutils.queue.exceptions import QueueException
+
+
+logger = logging.getLogger('djutils.queue.logger')
+
+
+class BaseSerializer(object):
+    """
+    Converts the data attached to a :class:`QueueCommand` to and from a
+    string.  Serializers that produce binary output should set ``binary``
+    so the payload is encoded before being stored in the queue
+    """
+    name = None
+    binary = False
+    
+    def dumps(self, data):
+        raise NotImplementedError
+    
+    def loads(self, data):
+        raise NotImplementedError
+
+
+class PickleSerializer(BaseSerializer):
+    name = 'pickle'
+    binary = True
+    
+    def dumps(self, data):
+        return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JSONSerializer(BaseSerializer):
+    name = 'json'
+    
+    def dumps(self, data):
+        return json.dumps(data, separators=(',', ':'))
+    
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgPackSerializer(BaseSerializer):
+    """
+    Requires the msgpack package
+    """
+    name = 'msgpack'
+    binary = True
+    
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+    
+    def dumps(self, data):
+        return self.msgpack.packb(data)
+    
+    def loads(self, data):
+        return self.msgpack.unpackb(data)
+
+
+class ZlibCompressor(object):
+    name = 'zlib'
+    
+    def compress(self, data):
+        return zlib.compress(data)
+    
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class LZ4Compressor(object):
+    """
+    Requires the lz4 package
+    """
+    name = 'lz4'
+    
+    def __init__(self):
+        import lz4.frame
+        self.lz4 = lz4.frame
+    
+    def compress(self, data):
+        return self.lz4.compress(data)
+    
+    def decompress(self, data):
+        return self.lz4.decompress(data)
+
+
+serializer_classes = dict([
+    (klass.name, klass) for klass in (PickleSerializer, JSONSerializer, MsgPackSerializer)
+])
+
+compressor_classes = dict([
+    (klass.name, klass) for klass in (ZlibCompressor, LZ4Compressor)
+])
+
+_serializers = {}
+_compressors = {}
+
+# compressors used for new messages, keyed by the name in the settings
+_write_compressors = {}
+
+def get_serializer(name):
+    """
+    Return a (cached) serializer instance given its name
+    """
+    if name not in _serializers:
+        if name not in serializer_classes:
+            raise QueueException, '%s is not a known serializer' % name
+        _serializers[name] = serializer_classes[name]()
+    return _serializers[name]
+
+def get_compressor(name):
+    """
+    Return a (cached) compressor instance given its name
+    """
+    if name not in _compressors:
+        if name not in compressor_classes:
+            raise QueueException, '%s is not a known compressor' % name
+        _compressors[name] = compressor_classes[name]()
+    return _compressors[name]
+
+def get_write_compressor(name):
+    """
+    Return the compressor to use for new messages.  If the one named needs a
+    package that is not installed, zlib is used instead
+    """
+    if name not in _write_compressors:
+        try:
+            _write_compressors[name] = get_compressor(name)
+        except ImportError:
+            logger.warn('%s compression is not available, using zlib' % name, exc_info=1)
+            _write_compressors[name] = get_compressor('zlib')
+    return _write_compressors[name]
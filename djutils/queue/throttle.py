@@ -0,0 +1,136 @@
+import ctypes
+import ctypes.util
+import os
+import sys
+import threading
+import time
+
+from djutils.queue.exceptions import QueueException
+
+
+# the id of CLOCK_MONOTONIC on platforms known to have clock_gettime
+CLOCK_MONOTONIC_IDS = {'linux': 1, 'freebsd': 4, 'darwin': 6}
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def get_monotonic_clock():
+    """
+    Return a function giving the time in seconds from a clock that is not
+    affected by changes to the system time.  Python 2 has no such clock of
+    its own, so clock_gettime is called through ctypes, falling back to the
+    elapsed time from os.times() which only has a resolution of 10ms
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    
+    platform = sys.platform.rstrip('0123456789')
+    try:
+        clock_id = CLOCK_MONOTONIC_IDS[platform]
+        libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        
+        def monotonic():
+            ts = timespec()
+            if clock_gettime(clock_id, ctypes.byref(ts)):
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return ts.tv_sec + ts.tv_nsec / 1e9
+        
+        monotonic()
+        return monotonic
+    except (KeyError, AttributeError, OSError):
+        return lambda: os.times()[4]
+
+clock = get_monotonic_clock()
+
+RATE_PERIODS = {'s': 1, 'm': 60, 'h': 3600}
+
+def parse_rate(rate):
+    """
+    Parse a rate limit such as '100/m' into a 2-tuple of the number of
+    commands and the period in seconds
+    """
+    try:
+        count, period = rate.split('/')
+        return int(count), RATE_PERIODS[period]
+    except (AttributeError, KeyError, ValueError):
+        raise QueueException, '%r is not a valid rate limit' % (rate,)
+
+
+class TokenBucket(object):
+    """
+    Allows bursts of up to 'capacity' commands, refilling at a steady rate of
+    'capacity' tokens every 'period' seconds
+    """
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = float(capacity) / period
+        self.tokens = float(capacity)
+        self.updated = clock()
+    
+    def consume(self, now=None):
+        """
+        Take a token, returning 0, or if the bucket is empty return the number
+        of seconds until the next token is available
+        """
+        if now is None:
+            now = clock()
+        
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Throttle(object):
+    """
+    Enforces the ``max_concurrency`` and ``rate_limit`` of each command class
+    in the consumer
+    """
+    # seconds to wait before checking again whether a command that is at its
+    # max_concurrency may run
+    concurrency_wait = .1
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = {}
+        self._buckets = {}
+    
+    def is_limited(self, klass):
+        return bool(klass.max_concurrency or klass.rate_limit)
+    
+    def acquire(self, klass, now=None):
+        """
+        Returns 0 if a command of the given class may run now, in which case
+        it counts towards the class' concurrency until :meth:`release` is
+        called.  Otherwise return the number of seconds to wait before
+        trying again
+        """
+        self._lock.acquire()
+        try:
+            running = self._running.get(klass, 0)
+            if klass.max_concurrency and running >= klass.max_concurrency:
+                return self.concurrency_wait
+            
+            if klass.rate_limit:
+                if klass not in self._buckets:
+                    self._buckets[klass] = TokenBucket(*parse_rate(klass.rate_limit))
+                wait = self._buckets[klass].consume(now)
+                if wait:
+                    return wait
+            
+            self._running[klass] = running + 1
+            return 0
+        finally:
+            self._lock.release()
+    
+    def release(self, klass):
+        self._lock.acquire()
+        try:
+            self._running[klass] -= 1
+        finally:
+            self._lock.release()
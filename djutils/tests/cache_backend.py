@@ -8,7 +8,7 @@ class CacheClass(BaseCache):
     def __init__(self, *args, **kwargs):
         self._cache = {}
 
-    def get(self, key, default=None):
+    def get(self, key, default=None, version=None):
         self.validate_key(key)
         return self._cache.get(key, default)
 
@@ -16,14 +16,22 @@ class CacheClass(BaseCache):
         self.validate_key(key)
         self._cache[key] = value
 
+    def add(self, key, value, timeout=None):
+        self.validate_key(key)
+        if key in self._cache:
+            return False
+        self._cache[key] = value
+        return True
+
     def delete(self, key, *args, **kwargs):
         self.validate_key(key)
         if key in self._cache:
             del(self._cache[key])
     
-    def incr(self, key):
+    def incr(self, key, delta=1):
         self._cache.setdefault(key, 0)
-        self._cache[key] += 1
+        self._cache[key] += delta
+        return self._cache[key]
     
     def clear(self):
         self._cache = {}
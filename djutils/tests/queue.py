@@ -1,23 +1,72 @@
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 import datetime
 import logging
+import os
+import shutil
+import sys
+import tempfile
 import threading
 import time
 
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.signals import request_finished
 from django.contrib.auth.models import User
+from django.utils import unittest
 
-from djutils.queue.bin.consumer import QueueDaemon
-from djutils.queue.decorators import crontab, queue_command, periodic_command
-from djutils.queue.queue import QueueCommand, PeriodicQueueCommand, QueueException, invoker
-from djutils.queue.registry import registry
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from djutils.models import QueueMessage, QueueResult, QueueUniqueKey
+from djutils.queue import serializers
+from djutils.queue.backends.base import BaseQueue
+from djutils.queue.backends.filesystem import FileQueue
+from djutils.queue.backends.memory import MemoryQueue
+from djutils.queue.bin.consumer import QueueDaemon, greenlets_requested
+from djutils.queue.constants import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL
+from djutils.queue.decorators import crontab, every, queue_command, periodic_command
+from djutils.queue.exceptions import ResultTimeout
+from djutils.queue.metrics import QueueMetrics, percentile as metrics_percentile
+from djutils.queue.queue import Invoker, QueueCommand, PeriodicQueueCommand, QueueException, get_invoker, get_invokers, invoker
+from djutils.queue.registry import registry, shard_hash
+from djutils.queue.results import CacheResultStore, DatabaseResultStore, EmptyResult, RedisResultStore
+from djutils.queue.schedules import PeriodicScheduler
+from djutils.queue.throttle import Throttle, TokenBucket, clock, parse_rate
 from djutils.test import TestCase
 
+if redis is not None:
+    from djutils.queue.backends.redis_backend import HashRing, RedisBlockingQueue, RedisQueue, ShardedRedisQueue
+
+# the redis tests use a database of their own on a server running locally
+REDIS_CONNECTION = 'localhost:6379:15'
+
+def redis_running():
+    if redis is None:
+        return False
+    try:
+        return redis.Redis(db=15).ping()
+    except redis.ConnectionError:
+        return False
+
 
 class DummyThreadQueue():
     """A replacement for the stdlib Queue.Queue"""
+    def __init__(self, daemon):
+        self.daemon = daemon
+    
     def put(self, message):
-        command = registry.get_command_for_message(message)
-        command.execute()
+        self.daemon.execute_message(message)
+        self.daemon.finish_message(message)
     
     def join(self):
         pass
@@ -33,10 +82,24 @@ class TestQueueDaemon(QueueDaemon):
     def get_logger(self):
         return logging.getLogger('djutils.tests.queue.logger')
     
+    def initialize_window(self):
+        super(TestQueueDaemon, self).initialize_window()
+        self.reports = []
+    
+    def report(self, status, tb):
+        self.reports.append((status, tb))
+        super(TestQueueDaemon, self).report(status, tb)
+    
     def initialize_threads(self):
+        super(TestQueueDaemon, self).initialize_threads()
         self._threads = []
-        self._error = threading.Event()
-        self._queue = DummyThreadQueue()
+        self._queue = DummyThreadQueue(self)
+
+
+class ThreadedTestQueueDaemon(TestQueueDaemon):
+    """Consumer that executes messages using real worker threads"""
+    def initialize_threads(self):
+        QueueDaemon.initialize_threads(self)
 
 
 class Options(dict):
@@ -56,6 +119,25 @@ def user_command(user, data):
     user.save()
 
 
+@queue_command
+def add(a, b):
+    return a + b
+
+@queue_command
+def return_none():
+    pass
+
+@queue_command(priority=PRIORITY_HIGH)
+def urgent_user_command(user, data):
+    user.email = data
+    user.save()
+
+@queue_command(priority=PRIORITY_LOW)
+def lazy_user_command(user, data):
+    user.email = data
+    user.save()
+
+
 class BampfException(Exception):
     pass
 
@@ -63,6 +145,76 @@ class BampfException(Exception):
 def throw_error():
     raise BampfException('bampf')
 
+@queue_command
+def raise_queue_exception():
+    raise QueueException('skip me')
+
+flaky_calls = []
+
+@queue_command(retries=2)
+def flaky_command(failures):
+    flaky_calls.append(1)
+    if len(flaky_calls) <= failures:
+        raise BampfException('flaky')
+
+@queue_command(retries=2, retry_delay=10, retry_backoff=3)
+def always_fails():
+    raise BampfException('always')
+
+
+blocking_started = []
+blocking_release = threading.Event()
+
+@queue_command
+def write_pid(filename):
+    fh = open(filename, 'a')
+    fh.write('%s\n' % os.getpid())
+    fh.close()
+
+@queue_command
+def cooperative_sleep(seconds):
+    gevent.sleep(seconds)
+
+@queue_command
+def blocking_command(i):
+    blocking_started.append(i)
+    blocking_release.wait(5)
+
+
+rate_limited_calls = []
+
+@queue_command(rate_limit='1/h')
+def rate_limited(i):
+    rate_limited_calls.append(i)
+
+@queue_command(max_concurrency=1)
+def one_at_a_time():
+    pass
+
+@queue_command(unique=True)
+def recompute(pk):
+    pass
+
+resize_calls = []
+
+@queue_command(queue='images')
+def resize(pk):
+    resize_calls.append(pk)
+
+@queue_command(shard_key=lambda account, amount: account)
+def apply_payment(account, amount):
+    pass
+
+class JSONCommand(QueueCommand):
+    serializer = 'json'
+    
+    def execute(self):
+        return self.data
+
+class BrokenResultStore(CacheResultStore):
+    def put(self, task_id, value):
+        raise BampfException('unable to store')
+
 
 class TestPeriodicCommand(PeriodicQueueCommand):
     def execute(self):
@@ -75,6 +227,23 @@ class TestPeriodicCommand(PeriodicQueueCommand):
 def every_fifteen():
     User.objects.create_user('fifteen', 'fifteen', 'fifteen')
 
+@periodic_command(every(seconds=10))
+def every_ten_seconds():
+    pass
+
+
+def every_ten_seconds_class():
+    return registry._registry['djutils.tests.queue.queuecmd_every_ten_seconds']
+
+def every_fifteen_class():
+    return registry._registry['djutils.tests.queue.queuecmd_every_fifteen']
+
+def one_at_a_time_class():
+    return registry._registry['djutils.tests.queue.queuecmd_one_at_a_time']
+
+def always_fails_class():
+    return registry._registry['djutils.tests.queue.queuecmd_always_fails']
+
 
 class QueueTest(TestCase):
     def setUp(self):
@@ -89,12 +258,24 @@ class QueueTest(TestCase):
             backoff=2,
             max_delay=.4,
             no_periodic=False,
+            scheduler_interval=1,
+            lease=30,
+            queues='',
             threads=2,
+            processes=0,
+            greenlets=0,
+            prefetch=1,
+            window=0,
         )
         invoker.flush()
+        invoker.dead_letter_queue.flush()
     
     def tearDown(self):
         settings.QUEUE_ALWAYS_EAGER = self.orig_always_eager
+        invoker.result_store = None
+        invoker.acks = False
+        settings.QUEUE_COMPACT_CLASS_IDS = False
+        settings.QUEUE_COMPRESSION_THRESHOLD = None
 
     def test_basic_processing(self):
         # make sure UserCommand got registered
@@ -133,6 +314,402 @@ class QueueTest(TestCase):
         self.assertEqual(dummy.email, 'decor@ted.com')
         self.assertEqual(len(invoker.queue), 0)
     
+    def test_enqueue_many(self):
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        
+        invoker.enqueue_many([
+            UserCommand((self.dummy, self.dummy.email, 'first@example.com')),
+            UserCommand((other, other.email, 'second@example.com')),
+            UserCommand((self.dummy, self.dummy.email, 'third@example.com')),
+        ])
+        self.assertEqual(len(invoker.queue), 3)
+        
+        # messages are dequeued in the order they were written
+        invoker.dequeue()
+        self.assertEqual(User.objects.get(username='username').email, 'first@example.com')
+        
+        invoker.dequeue()
+        self.assertEqual(User.objects.get(username='other').email, 'second@example.com')
+        
+        invoker.dequeue()
+        self.assertEqual(User.objects.get(username='username').email, 'third@example.com')
+        self.assertEqual(len(invoker.queue), 0)
+        
+        # any iterable of commands may be given
+        results = invoker.enqueue_many(
+            UserCommand((self.dummy, self.dummy.email, 'g%d@example.com' % i)) for i in range(2)
+        )
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(invoker.queue), 2)
+    
+    def test_decorated_function_map(self):
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        
+        user_command.map([(self.dummy, 'map1@example.com'), (other, 'map2@example.com')])
+        self.assertEqual(len(invoker.queue), 2)
+        
+        # nothing has been executed yet
+        self.assertEqual(User.objects.get(username='username').email, 'user@example.com')
+        
+        invoker.dequeue()
+        invoker.dequeue()
+        
+        self.assertEqual(User.objects.get(username='username').email, 'map1@example.com')
+        self.assertEqual(User.objects.get(username='other').email, 'map2@example.com')
+        
+        # an empty iterable is a no-op
+        user_command.map([])
+        self.assertEqual(len(invoker.queue), 0)
+        
+        # large batches are split across several INSERT statements
+        user_command.map([(self.dummy, 'x%d@example.com' % i) for i in range(600)])
+        self.assertEqual(len(invoker.queue), 600)
+    
+    def test_read_many(self):
+        invoker.enqueue_many([
+            UserCommand((self.dummy, self.dummy.email, 'u%d@example.com' % i)) \
+                for i in range(5)
+        ])
+        
+        # read a batch, leaving the remainder in the queue
+        messages = invoker.read_many(3)
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(len(invoker.queue), 2)
+        
+        # messages come off the queue in FIFO order
+        emails = [registry.get_command_for_message(m).data[2] for m in messages]
+        self.assertEqual(emails, ['u0@example.com', 'u1@example.com', 'u2@example.com'])
+        
+        # asking for more than is available returns what is left
+        messages = invoker.read_many(10)
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(len(invoker.queue), 0)
+        
+        self.assertEqual(invoker.read_many(10), [])
+    
+    def test_read_skips_claimed_messages(self):
+        invoker.enqueue_many([
+            UserCommand((self.dummy, self.dummy.email, 'u%d@example.com' % i)) \
+                for i in range(3)
+        ])
+        
+        # simulate another consumer having claimed the oldest message
+        first = QueueMessage.objects.filter(queue=invoker.queue.name)[0]
+        QueueMessage.objects.filter(pk=first.pk).update(claim='another-consumer')
+        
+        messages = invoker.read_many(3)
+        emails = [registry.get_command_for_message(m).data[2] for m in messages]
+        self.assertEqual(emails, ['u1@example.com', 'u2@example.com'])
+        
+        # the claimed message is left alone for its owner to delete
+        self.assertEqual(invoker.read(), None)
+        self.assertEqual(len(invoker.queue), 1)
+        self.assertEqual(QueueMessage.objects.get(claim='another-consumer').pk, first.pk)
+    
+    def test_reserve_and_ack(self):
+        invoker.acks = True
+        invoker.enqueue_many([
+            UserCommand((self.dummy, self.dummy.email, 'u%d@example.com' % i)) \
+                for i in range(3)
+        ])
+        
+        # reserved messages are hidden from readers but stay in the table
+        messages = invoker.read_many(2)
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(len(invoker.read_many(2)), 1)
+        self.assertEqual(invoker.read(), None)
+        self.assertEqual(len(invoker.queue), 3)
+        
+        # acknowledging a message removes it for good
+        invoker.ack(messages[0])
+        self.assertEqual(len(invoker.queue), 2)
+        
+        # unacknowledged messages are requeued once their timeout expires
+        now = datetime.datetime.now()
+        self.assertEqual(invoker.requeue_expired(now), 0)
+        self.assertEqual(invoker.requeue_expired(now + datetime.timedelta(seconds=301)), 2)
+        
+        emails = [registry.get_command_for_message(m).data[2] for m in invoker.read_many(2)]
+        self.assertEqual(emails, ['u1@example.com', 'u2@example.com'])
+    
+    def test_priorities(self):
+        lazy_user_command(self.dummy, 'low@example.com')
+        user_command(self.dummy, 'normal1@example.com')
+        urgent_user_command.map([(self.dummy, 'high1@example.com'), (self.dummy, 'high2@example.com')])
+        user_command(self.dummy, 'normal2@example.com')
+        urgent_user_command(self.dummy, 'high3@example.com')
+        self.assertEqual(len(invoker.queue), 6)
+        
+        # higher priority messages are read first, FIFO within a priority
+        emails = [
+            registry.get_command_for_message(m).data[0][1] for m in invoker.read_many(4)
+        ]
+        self.assertEqual(emails, [
+            'high1@example.com', 'high2@example.com', 'high3@example.com', 'normal1@example.com',
+        ])
+        
+        emails = [registry.get_command_for_message(invoker.read()).data[0][1] for i in range(2)]
+        self.assertEqual(emails, ['normal2@example.com', 'low@example.com'])
+        self.assertEqual(invoker.read(), None)
+    
+    def test_scheduled_commands(self):
+        now = datetime.datetime.now()
+        
+        command = UserCommand((self.dummy, self.dummy.email, 'eta@example.com'))
+        invoker.enqueue(command, eta=now + datetime.timedelta(seconds=60))
+        user_command.schedule(args=(self.dummy, 'countdown@example.com'), countdown=120)
+        
+        # scheduled messages are not visible to readers
+        self.assertEqual(len(invoker.queue), 0)
+        self.assertEqual(invoker.read(), None)
+        
+        # nothing is due yet
+        self.assertEqual(invoker.promote_scheduled(now), 0)
+        
+        # promote the first message
+        self.assertEqual(invoker.promote_scheduled(now + datetime.timedelta(seconds=90)), 1)
+        self.assertEqual(len(invoker.queue), 1)
+        
+        invoker.dequeue()
+        self.assertEqual(User.objects.get(username='username').email, 'eta@example.com')
+        
+        # then the second
+        self.assertEqual(invoker.promote_scheduled(now + datetime.timedelta(seconds=180)), 1)
+        invoker.dequeue()
+        self.assertEqual(User.objects.get(username='username').email, 'countdown@example.com')
+        self.assertEqual(invoker.promote_scheduled(now + datetime.timedelta(seconds=180)), 0)
+    
+    def _test_result_store(self, result_store):
+        invoker.result_store = result_store
+        
+        result = add(1, 2)
+        none_result = return_none()
+        self.assertNotEqual(result.task_id, none_result.task_id)
+        
+        # nothing has been executed yet
+        self.assertFalse(result.ready())
+        self.assertRaises(ResultTimeout, result.get, timeout=.05)
+        
+        invoker.dequeue()
+        invoker.dequeue()
+        
+        self.assertTrue(result.ready())
+        self.assertEqual(result.get(), 3)
+        self.assertEqual(result.get(timeout=1), 3)
+        
+        # a result of None is distinguishable from no result at all
+        self.assertTrue(none_result.ready())
+        self.assertEqual(none_result.get(timeout=1), None)
+        
+        results = add.map([(1, 1), (2, 2)])
+        invoker.dequeue()
+        invoker.dequeue()
+        self.assertEqual([r.get() for r in results], [2, 4])
+    
+    def test_shard_key(self):
+        klass = registry._registry['djutils.tests.queue.queuecmd_apply_payment']
+        
+        # the shard key is computed from the call's arguments and stored hashed
+        command = klass((('acct-1', 10), {}))
+        self.assertEqual(command.get_shard_key(), 'acct-1')
+        headers = registry.get_headers_for_message(registry.get_message_for_command(command))
+        self.assertEqual(headers['k'], '%08x' % shard_hash('acct-1'))
+        
+        other = klass((('acct-1', 20), {}))
+        self.assertEqual(registry.get_headers_for_message(registry.get_message_for_command(other))['k'], headers['k'])
+        
+        # commands without a shard key carry no header
+        message = registry.get_message_for_command(UserCommand((self.dummy, 'a', 'b')))
+        self.assertFalse('k' in registry.get_headers_for_message(message))
+        self.assertEqual(shard_hash(u'acct-1'), shard_hash('acct-1'))
+    
+    def test_unique_commands(self):
+        first = recompute(1)
+        self.assertEqual(recompute(1).task_id, first.task_id)
+        self.assertNotEqual(recompute(2).task_id, first.task_id)
+        self.assertEqual(len(invoker.queue), 2)
+        
+        # duplicates are dropped from batches as well, including each other
+        results = recompute.map([(1,), (3,), (3,)])
+        self.assertEqual(results[0].task_id, first.task_id)
+        self.assertEqual(results[1].task_id, results[2].task_id)
+        self.assertEqual(len(invoker.queue), 3)
+        
+        # once the window has passed the command can be enqueued again
+        QueueUniqueKey.objects.update(expires=datetime.datetime.now())
+        self.assertNotEqual(recompute(1).task_id, first.task_id)
+        self.assertEqual(len(invoker.queue), 4)
+        
+        # retries are never dropped
+        command = registry.get_command_for_message(invoker.read())
+        self.assertEqual(invoker.handle_failure(command), 'dead')
+        self.assertEqual(len(invoker.dead_letter_queue), 1)
+    
+    def test_unique_commands_cache(self):
+        queue = BaseQueue('unique-test', None)
+        self.assertEqual(queue.claim_unique('key', 'first', 60), 'first')
+        self.assertEqual(queue.claim_unique('key', 'second', 60), 'first')
+        self.assertEqual(queue.claim_unique('other', 'second', 60), 'second')
+    
+    def test_cache_result_store(self):
+        self._test_result_store(CacheResultStore('testqueue', None, 60))
+    
+    def test_result_store_failure(self):
+        invoker.result_store = BrokenResultStore('testqueue', None, 60)
+        
+        # failing to store the result does not count as a failure of the
+        # command, which would run it again
+        del flaky_calls[:]
+        flaky_command(0)
+        self.assertTrue(invoker.dequeue())
+        self.assertEqual(len(flaky_calls), 1)
+        self.assertEqual(len(invoker.queue), 0)
+        self.assertEqual(len(invoker.dead_letter_queue), 0)
+    
+    def test_database_result_store(self):
+        store = DatabaseResultStore('testqueue', None, 60)
+        self._test_result_store(store)
+        
+        # a result stored again, when its message is delivered twice, keeps
+        # the first value
+        store.put('redelivered', 1)
+        store.put('redelivered', 2)
+        self.assertEqual(store.get('redelivered'), 1)
+        
+        # expired results are not returned
+        store.ttl = -1
+        result = add(5, 5)
+        invoker.dequeue()
+        self.assertFalse(result.ready())
+        
+        # they are removed by the consumer's periodic housekeeping
+        daemon = TestQueueDaemon(self.consumer_options)
+        daemon.purge_results()
+        self.assertTrue(QueueResult.objects.filter(task_id=result.task_id).exists())
+        daemon._purged_at -= daemon.purge_interval
+        daemon.purge_results()
+        self.assertFalse(QueueResult.objects.filter(task_id=result.task_id).exists())
+    
+    def test_result_without_store(self):
+        result = add(1, 2)
+        self.assertRaises(QueueException, result.get)
+        
+        # eager results are available immediately
+        settings.QUEUE_ALWAYS_EAGER = True
+        self.assertEqual(add(1, 2).get(), 3)
+    
+    def test_message_envelope(self):
+        command = UserCommand((self.dummy, 'old@example.com', 'new@example.com'))
+        message = registry.get_message_for_command(command)
+        
+        # the envelope records the version, serializer and full class path
+        version, headers, klass_str, data = message.split(':', 3)
+        self.assertEqual(version, '@1')
+        headers = registry.decode_headers(headers)
+        self.assertTrue(abs(float(headers.pop('t')) - time.time()) < 5)
+        self.assertEqual(headers, {'s': 'pickle', 'e': 'b64', 'id': command.task_id})
+        self.assertEqual(klass_str, 'djutils.tests.queue.UserCommand')
+        
+        decoded = registry.get_command_for_message(message)
+        self.assertTrue(isinstance(decoded, UserCommand))
+        self.assertEqual(decoded.data, (self.dummy, 'old@example.com', 'new@example.com'))
+        
+        # queues that can store bytes get the payload without encoding
+        raw = registry.get_message_for_command(command, binary=True)
+        self.assertFalse('e' in registry.get_headers_for_message(raw))
+        self.assertTrue(len(raw) < len(message))
+        self.assertEqual(registry.get_command_for_message(raw).data, decoded.data)
+        
+        memory_invoker = Invoker(MemoryQueue('testqueue.memory', None))
+        memory_invoker.enqueue(command)
+        self.assertFalse('e' in registry.get_headers_for_message(memory_invoker.queue.read()))
+        
+        # the consumer logs messages by class and id rather than payload
+        daemon = TestQueueDaemon(self.consumer_options)
+        self.assertEqual(daemon.describe_message(raw), 'djutils.tests.queue.UserCommand %s' % command.task_id)
+        self.assertEqual(daemon.describe_message('garbage'), 'unreadable message')
+        
+        # messages written in the old format can still be read
+        legacy = 'djutils.tests.queue.UserCommand:%s' % pickle.dumps(('a', 'b', 'c'))
+        self.assertEqual(registry.get_command_for_message(legacy).data, ('a', 'b', 'c'))
+        
+        # unknown envelope versions are rejected
+        self.assertRaises(QueueException, registry.get_command_for_message,
+            '@99:s=pickle:djutils.tests.queue.UserCommand:')
+    
+    def test_json_serializer(self):
+        command = JSONCommand({'recipient': 'somebody@example.com', 'count': 3})
+        message = registry.get_message_for_command(command)
+        
+        headers = registry.get_headers_for_message(message)
+        del(headers['t'])
+        self.assertEqual(headers, {'s': 'json', 'id': command.task_id})
+        self.assertTrue(message.endswith('{"count":3,"recipient":"somebody@example.com"}'))
+        
+        decoded = registry.get_command_for_message(message)
+        self.assertEqual(decoded.execute(), {'recipient': 'somebody@example.com', 'count': 3})
+    
+    def test_compact_class_ids(self):
+        command = UserCommand(('a', 'b', 'c'))
+        
+        settings.QUEUE_COMPACT_CLASS_IDS = True
+        message = registry.get_message_for_command(command)
+        
+        klass_str = message.split(':')[2]
+        self.assertEqual(klass_str, registry.command_to_id(UserCommand))
+        self.assertEqual(len(klass_str), 9)
+        
+        # compact ids are understood regardless of the setting
+        settings.QUEUE_COMPACT_CLASS_IDS = False
+        decoded = registry.get_command_for_message(message)
+        self.assertTrue(isinstance(decoded, UserCommand))
+        self.assertEqual(decoded.data, ('a', 'b', 'c'))
+        
+        self.assertRaises(QueueException, registry.get_command_for_message,
+            '@1:s=pickle:#00000000:')
+    
+    def test_compression(self):
+        body = 'lorem ipsum dolor sit amet ' * 200
+        command = JSONCommand({'body': body})
+        
+        # by default nothing is compressed
+        message = registry.get_message_for_command(command)
+        self.assertFalse('z' in registry.decode_headers(message.split(':')[1]))
+        
+        # small payloads are left alone
+        settings.QUEUE_COMPRESSION_THRESHOLD = 1024
+        small = registry.get_message_for_command(JSONCommand({'body': 'short'}))
+        self.assertFalse('z' in registry.decode_headers(small.split(':')[1]))
+        
+        compressed = registry.get_message_for_command(command)
+        headers = registry.decode_headers(compressed.split(':')[1])
+        self.assertEqual(headers['z'], 'zlib')
+        self.assertEqual(headers['e'], 'b64')
+        self.assertEqual(int(headers['o']), len(message.split(':', 3)[3]))
+        self.assertTrue(len(compressed) < len(message) / 10)
+        
+        # consumers decompress transparently
+        decoded = registry.get_command_for_message(compressed)
+        self.assertEqual(decoded.execute(), {'body': body})
+        self.assertEqual(decoded.headers['z'], 'zlib')
+        
+        # lz4 falls back to zlib when the package is not installed
+        settings.QUEUE_COMPRESSION = 'lz4'
+        orig_lz4 = sys.modules.get('lz4')
+        sys.modules['lz4'] = None
+        serializers._write_compressors.pop('lz4', None)
+        try:
+            fallback = registry.get_message_for_command(command)
+        finally:
+            del settings.QUEUE_COMPRESSION
+            serializers._write_compressors.pop('lz4', None)
+            if orig_lz4 is None:
+                del sys.modules['lz4']
+            else:
+                sys.modules['lz4'] = orig_lz4
+        self.assertEqual(registry.get_headers_for_message(fallback)['z'], 'zlib')
+        self.assertEqual(registry.get_command_for_message(fallback).execute(), {'body': body})
+    
     def test_always_eager(self):
         settings.QUEUE_ALWAYS_EAGER = True
         
@@ -228,10 +805,147 @@ class QueueTest(TestCase):
         # fails validation on minute
         self.assertFalse(validate(datetime.datetime(2011, 1, 1, 4, 6)))
     
+    def test_crontab_next_after(self):
+        dt = datetime.datetime
+        
+        every_fifteen = crontab(minute='*/15')
+        self.assertEqual(every_fifteen.next_after(dt(2011, 1, 1, 1, 0, 30)), dt(2011, 1, 1, 1, 15))
+        self.assertEqual(every_fifteen.next_after(dt(2011, 1, 1, 1, 15)), dt(2011, 1, 1, 1, 30))
+        self.assertEqual(every_fifteen.next_after(dt(2011, 12, 31, 23, 45)), dt(2012, 1, 1, 0, 0))
+        
+        # jan 1, 2011 is a saturday, may 1, 2011 is a sunday
+        validate = crontab(
+            month='1,5',
+            day='1,4,7',
+            day_of_week='0,6',
+            hour='*/4',
+            minute='1-5,10-15,50'
+        )
+        self.assertEqual(validate.next_after(dt(2011, 1, 1, 0, 1)), dt(2011, 1, 1, 0, 2))
+        self.assertEqual(validate.next_after(dt(2011, 1, 1, 0, 5)), dt(2011, 1, 1, 0, 10))
+        self.assertEqual(validate.next_after(dt(2011, 1, 1, 0, 50)), dt(2011, 1, 1, 4, 1))
+        self.assertEqual(validate.next_after(dt(2011, 1, 1, 20, 50)), dt(2011, 5, 1, 0, 1))
+        
+        # the next run always validates, and nothing in between does
+        start = dt(2011, 1, 1)
+        expected = [start + datetime.timedelta(minutes=m) for m in range(1, 3000) \
+                    if validate(start + datetime.timedelta(minutes=m))]
+        runs = [validate.next_after(start)]
+        while runs[-1] <= expected[-1]:
+            runs.append(validate.next_after(runs[-1]))
+        self.assertEqual(runs[:-1], expected)
+        
+        # a schedule that never matches
+        self.assertEqual(crontab(month='2', day='30').next_after(start), None)
+        self.assertRaises(ValidationError, crontab, minute='60')
+        self.assertRaises(ValidationError, crontab, hour='noon')
+    
+    def test_periodic_scheduler(self):
+        commands = [TestPeriodicCommand(), every_fifteen_class()()]
+        scheduler = PeriodicScheduler(commands, datetime.datetime(2011, 1, 1, 1, 14, 30))
+        
+        # commands without a compiled schedule are checked every minute
+        self.assertEqual(scheduler.next_run(), datetime.datetime(2011, 1, 1, 1, 14))
+        
+        # missed runs are caught up, in order
+        due = scheduler.pop_due(datetime.datetime(2011, 1, 1, 1, 31))
+        self.assertEqual([(dt.minute, type(command)) for dt, command in due], [
+            (15, every_fifteen_class()),
+            (30, TestPeriodicCommand),
+            (30, every_fifteen_class()),
+        ])
+        self.assertEqual(scheduler.pop_due(datetime.datetime(2011, 1, 1, 1, 31)), [])
+        self.assertEqual(scheduler.next_run(), datetime.datetime(2011, 1, 1, 1, 32))
+        
+        # only compiled schedules
+        scheduler = PeriodicScheduler(commands[1:], datetime.datetime(2011, 1, 1, 1, 14, 30))
+        self.assertEqual(scheduler.next_run(), datetime.datetime(2011, 1, 1, 1, 15))
+        
+        daemon = TestQueueDaemon(self.consumer_options)
+        self.assertEqual(daemon.enqueue_due_commands(scheduler, datetime.datetime(2011, 1, 1, 2, 0)), 4)
+        self.assertEqual(len(invoker.queue), 4)
+        
+        # a consumer taking over the lease does not enqueue this minute's
+        # commands a second time
+        now = datetime.datetime(2011, 1, 1, 1, 15, 30)
+        scheduler = PeriodicScheduler(commands, now, current_minute=False)
+        self.assertEqual(scheduler.next_run(), datetime.datetime(2011, 1, 1, 1, 16))
+        self.assertEqual(daemon.create_scheduler(now).next_run(), datetime.datetime(2011, 1, 1, 1, 15))
+        self.assertEqual(daemon.create_scheduler(now, True).next_run(), datetime.datetime(2011, 1, 1, 1, 16))
+    
+    def test_interval_schedule(self):
+        self.assertEqual(every(minutes=1, seconds=5).interval, 65)
+        self.assertRaises(ValidationError, every)
+        
+        command = every_ten_seconds_class()()
+        self.assertEqual(command.interval, 10)
+        
+        # interval commands run on the timer, the timer readings are passed
+        # explicitly here
+        now = datetime.datetime(2011, 1, 1, 1, 0)
+        scheduler = PeriodicScheduler([command], now, ticks=100)
+        self.assertEqual(scheduler.next_run(), None)
+        self.assertEqual(scheduler.wait_time(now, 100), 10)
+        self.assertEqual(scheduler.pop_due(now, 105), [])
+        
+        due = scheduler.pop_due(now, 112)
+        self.assertEqual(due, [(now - datetime.timedelta(seconds=2), command)])
+        
+        # running late does not push back the following runs
+        self.assertEqual(scheduler.wait_time(now, 112), 8)
+        
+        # missed intervals are only run once
+        self.assertEqual(len(scheduler.pop_due(now, 145)), 1)
+        self.assertEqual(scheduler.wait_time(now, 145), 5)
+        
+        # the consumer does not sleep past a command that is already due
+        daemon = TestQueueDaemon(self.consumer_options)
+        self.assertEqual(daemon.get_periodic_wait(None, now), 10)
+        self.assertEqual(daemon.get_periodic_wait(scheduler, now, 145), 5)
+        self.assertEqual(daemon.get_periodic_wait(scheduler, now, 150), 0)
+        self.assertEqual(daemon.get_periodic_wait(PeriodicScheduler([], now), now), 10)
+        
+        # the legacy once a minute check never picks them up
+        invoker.enqueue_periodic_commands(datetime.datetime(2011, 1, 1, 1, 1))
+        self.assertEqual(len(invoker.queue), 0)
+    
+    def test_leader_lease(self):
+        self.assertTrue(invoker.acquire_lease('periodic', 'first', 30))
+        self.assertFalse(invoker.acquire_lease('periodic', 'second', 30))
+        
+        # the holder renews its lease
+        self.assertTrue(invoker.acquire_lease('periodic', 'first', 30))
+        self.assertFalse(invoker.acquire_lease('periodic', 'second', 30))
+        
+        # once the lease expires another consumer takes over
+        QueueUniqueKey.objects.update(expires=datetime.datetime.now())
+        self.assertTrue(invoker.acquire_lease('periodic', 'second', 30))
+        self.assertFalse(invoker.acquire_lease('periodic', 'first', 30))
+        
+        # the lease does not conflict with unique commands
+        self.assertTrue(recompute(1).task_id)
+        self.assertEqual(len(invoker.queue), 1)
+        
+        # consumers get an id of their own
+        daemon = TestQueueDaemon(self.consumer_options)
+        other = TestQueueDaemon(self.consumer_options)
+        self.assertNotEqual(daemon.consumer_id, other.consumer_id)
+        self.assertFalse(daemon.acquire_leadership())
+        
+        QueueUniqueKey.objects.all().delete()
+        self.assertTrue(daemon.acquire_leadership())
+        self.assertFalse(other.acquire_leadership())
+    
+    def test_leader_lease_cache(self):
+        queue = BaseQueue('lease-test', None)
+        self.assertTrue(queue.acquire_lease('periodic', 'first', 30))
+        self.assertTrue(queue.acquire_lease('periodic', 'first', 30))
+        self.assertFalse(queue.acquire_lease('periodic', 'second', 30))
+    
     def test_registry_get_periodic_commands(self):
-        # three, one for the base class, one for the TestPeriodicCommand, and
-        # one for the decorated function
-        self.assertEqual(len(registry.get_periodic_commands()), 3)
+        # four, one for the base class, one for the TestPeriodicCommand, and
+        # one for each decorated function
+        self.assertEqual(len(registry.get_periodic_commands()), 4)
     
     def test_periodic_command_registration(self):
         # make sure TestPeriodicCommand got registered
@@ -328,7 +1042,38 @@ class QueueTest(TestCase):
         self.assertRaises(ValueError, daemon_factory, self.consumer_options)
         
         self.consumer_options['threads'] = 1
+        self.consumer_options['processes'] = -1
+        self.assertRaises(ValueError, daemon_factory, self.consumer_options)
+        
+        self.consumer_options['processes'] = 2
+        self.consumer_options['greenlets'] = 2
+        self.assertRaises(ValueError, daemon_factory, self.consumer_options)
+        
+        self.consumer_options['processes'] = 0
+        self.consumer_options['greenlets'] = -1
+        self.assertRaises(ValueError, daemon_factory, self.consumer_options)
+        
+        self.consumer_options['greenlets'] = 0
+        self.consumer_options['scheduler_interval'] = 0
+        self.assertRaises(ValueError, daemon_factory, self.consumer_options)
+        
+        self.consumer_options['scheduler_interval'] = 1
+        self.consumer_options['lease'] = 0
+        self.assertRaises(ValueError, daemon_factory, self.consumer_options)
+        
+        self.consumer_options['lease'] = 30
+        self.consumer_options['prefetch'] = 0
+        self.assertRaises(ValueError, daemon_factory, self.consumer_options)
+        
+        self.consumer_options['prefetch'] = 1
         other_daemon = daemon_factory(self.consumer_options)
+        
+        # the window defaults to enough room for every thread and one batch
+        self.assertEqual(other_daemon.window, 2)
+        
+        self.consumer_options['window'] = 5
+        other_daemon = daemon_factory(self.consumer_options)
+        self.assertEqual(other_daemon.window, 5)
     
     def test_daemon_delay(self):
         daemon = TestQueueDaemon(self.consumer_options)
@@ -337,6 +1082,9 @@ class QueueTest(TestCase):
         daemon.initialize_threads()
         daemon.start_workers()
         
+        # ignore wakeups for messages written by earlier tests
+        invoker.wait(0)
+        
         # processing when there is no message will sleep
         start = time.time()
         daemon.process_message()
@@ -368,8 +1116,595 @@ class QueueTest(TestCase):
         # make sure the delay was reset
         self.assertEqual(daemon.delay, .1)
     
+    def test_wait_notifications(self):
+        queue = invoker.queue
+        queue.wait(0)
+        
+        # writing a message wakes the waiting consumer immediately
+        add(1, 2)
+        add.map([(1, 2), (3, 4)])
+        start = time.time()
+        self.assertTrue(queue.wait(1))
+        self.assertTrue(time.time() - start < .5)
+        
+        # however many messages were written
+        self.assertFalse(queue.wait(.05))
+        
+        # writing nothing does not wake it
+        queue.write_many([])
+        self.assertFalse(queue.wait(.05))
+        
+        # promoting scheduled messages wakes it too
+        add.schedule(args=(1, 2), eta=datetime.datetime.now())
+        self.assertFalse(queue.wait(.05))
+        invoker.promote_scheduled()
+        self.assertTrue(queue.wait(1))
+        
+        # with notifications disabled the queue falls back to sleeping
+        queue.notifications = False
+        try:
+            add(1, 2)
+            start = time.time()
+            self.assertFalse(queue.wait(.1))
+            self.assertTrue(time.time() - start >= .09)
+        finally:
+            queue.notifications = True
+    
+    def test_named_queues(self):
+        images = get_invoker('images')
+        images.flush()
+        self.assertTrue(get_invoker('images') is images)
+        self.assertTrue(get_invoker('default') is invoker)
+        self.assertEqual(images.queue.name, 'testqueue.images')
+        self.assertEqual(images.dead_letter_queue.name, 'testqueue.images.dead')
+        
+        # every queue commands are routed to is known, for reporting
+        self.assertTrue(get_invokers()[0] is invoker)
+        self.assertTrue(images in get_invokers())
+        
+        # commands are routed to their queue
+        del resize_calls[:]
+        resize(1)
+        self.assertEqual(len(invoker.queue), 0)
+        self.assertEqual(len(images.queue), 1)
+        
+        # whichever invoker they are enqueued with, results keep their order
+        resize_class = registry._registry['djutils.tests.queue.queuecmd_resize']
+        commands = [
+            resize_class(((2,), {})),
+            UserCommand((self.dummy, 'user@example.com', 'routed@example.com')),
+        ]
+        results = invoker.enqueue_many(commands)
+        self.assertEqual([r.task_id for r in results], [c.task_id for c in commands])
+        self.assertEqual(len(invoker.queue), 1)
+        self.assertEqual(len(images.queue), 2)
+        
+        # the consumer reads the queues it is given, each with its own workers
+        self.consumer_options['queues'] = 'images, default'
+        daemon = TestQueueDaemon(self.consumer_options)
+        self.assertEqual(daemon.queues, ['images', 'default'])
+        self.assertTrue(daemon.invoker is images)
+        self.assertEqual(daemon.pidfile, '/var/run/djutils-testqueue-images-default.pid')
+        
+        daemon.initialize_threads()
+        daemon.process_message()
+        daemon.process_message()
+        self.assertEqual(resize_calls, [1, 2])
+        self.assertEqual(len(invoker.queue), 1)
+        
+        consumer = daemon.get_queue_consumer('default')
+        self.assertTrue(consumer.invoker is invoker)
+        consumer.initialize_threads()
+        self.assertFalse(consumer._queue is daemon._queue)
+        consumer.process_message()
+        self.assertEqual(len(invoker.queue), 0)
+        self.assertEqual(User.objects.get(username='username').email, 'routed@example.com')
+    
+    def test_lazy_backends(self):
+        lazy = Invoker('testqueue.lazy', dead_letter_queue='testqueue.lazy.dead')
+        
+        # nothing is created until the queue is used
+        self.assertEqual(lazy._backends, {})
+        queue = lazy.queue
+        self.assertTrue(lazy.queue is queue)
+        self.assertEqual(queue.name, 'testqueue.lazy')
+        self.assertEqual(lazy.dead_letter_queue.name, 'testqueue.lazy.dead')
+        
+        # a forked process creates backends of its own
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.write(w, lazy.queue is queue and 'shared' or 'new')
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(r, 10), 'new')
+        os.close(r)
+        os.close(w)
+        self.assertTrue(lazy.queue is queue)
+        
+        # backends given as instances are used as-is
+        self.assertTrue(Invoker(queue).queue is queue)
+    
+    def test_memory_queue(self):
+        queue = MemoryQueue('testqueue.memory', None)
+        queue.read_timeout = .05
+        self.assertEqual(queue.read_many(1), [])
+        
+        # messages are read highest priority first, in the order written
+        queue.write('low', PRIORITY_LOW)
+        queue.write_many(['a', 'b'])
+        queue.write('high', PRIORITY_HIGH)
+        self.assertEqual(len(queue), 4)
+        self.assertEqual(queue.read_many(3), ['high', 'a', 'b'])
+        self.assertEqual(queue.read(), 'low')
+        
+        # a read waits for a message to be written by another thread
+        queue.read_timeout = 1
+        threading.Timer(.05, queue.write, ('late',)).start()
+        start = time.time()
+        self.assertEqual(queue.read_many(5), ['late'])
+        self.assertTrue(time.time() - start < .5)
+        
+        self.assertFalse(queue.wait(.01))
+        queue.write('x')
+        self.assertTrue(queue.wait(.01))
+        queue.flush()
+        
+        # scheduled messages are held until promoted
+        now = datetime.datetime.now()
+        queue.schedule('later', now + datetime.timedelta(seconds=60))
+        queue.schedule('sooner', now)
+        self.assertEqual(queue.promote(now, 10), 1)
+        self.assertEqual(queue.read(), 'sooner')
+        
+        # reserved messages come back unless they are acknowledged
+        queue.write_many(['r1', 'r2'])
+        self.assertEqual(queue.reserve_many(2, 10), ['r1', 'r2'])
+        queue.ack('r1')
+        self.assertEqual(queue.requeue_expired(now), 0)
+        self.assertEqual(queue.requeue_expired(now + datetime.timedelta(seconds=20)), 1)
+        self.assertEqual(queue.read(), 'r2')
+        
+        self.assertEqual(queue.claim_unique('k', 'a', 10), 'a')
+        self.assertEqual(queue.claim_unique('k', 'b', 10), 'a')
+        self.assertTrue(queue.acquire_lease('l', 'a', 10))
+        self.assertFalse(queue.acquire_lease('l', 'b', 10))
+        self.assertTrue(queue.acquire_lease('l', 'a', 10))
+    
+    @unittest.skipIf(redis is None, 'redis is not installed')
+    def test_hash_ring(self):
+        hashes = [shard_hash('key-%d' % i) for i in range(1000)]
+        ring = HashRing(['a', 'b', 'c'])
+        before = [ring.get_node(h) for h in hashes]
+        
+        # keys are spread over every node
+        for node in range(3):
+            self.assertTrue(before.count(node) > 150)
+        
+        # adding a node only moves keys onto the new node
+        after = [HashRing(['a', 'b', 'c', 'd']).get_node(h) for h in hashes]
+        moved = [i for i in range(len(hashes)) if before[i] != after[i]]
+        self.assertTrue(0 < len(moved) < 400)
+        self.assertEqual(set([after[i] for i in moved]), set([3]))
+    
+    @unittest.skipIf(redis is None, 'redis is not installed')
+    def test_sharded_redis_queue(self):
+        # no connection is made until a shard is used, so the shards can be
+        # replaced with queues kept in memory
+        queue = ShardedRedisQueue('testqueue.sharded', 'localhost:6379:1,localhost:6379:2')
+        queue.shards = [MemoryQueue('testqueue.shard%d' % i, None) for i in range(2)]
+        for shard in queue.shards:
+            shard.read_timeout = .01
+        
+        # messages with the same shard key are stored in order on one shard
+        klass = registry._registry['djutils.tests.queue.queuecmd_apply_payment']
+        payments = [registry.get_message_for_command(klass((('acct-1', i), {})), binary=True) for i in range(3)]
+        queue.write(payments[0])
+        queue.write_many(payments[1:])
+        shard = queue.get_shard_for_key('acct-1')
+        self.assertEqual(len(shard), 3)
+        self.assertEqual(shard.read_many(3), payments)
+        
+        # other messages are written to the shards in turn
+        queue.write_many(['m%d' % i for i in range(4)])
+        self.assertEqual([len(shard) for shard in queue.shards], [2, 2])
+        
+        # reads take an equal share from each shard, starting with a
+        # different shard each time
+        queue.write_many(['n%d' % i for i in range(4)])
+        owner = dict([(data, i) for i, shard in enumerate(queue.shards) for data in shard._lanes[PRIORITY_NORMAL]])
+        first = queue.read_many(2)
+        second = queue.read_many(2)
+        self.assertEqual([len(shard) for shard in queue.shards], [2, 2])
+        self.assertEqual(sorted(first + second), ['m0', 'm1', 'm2', 'm3'])
+        self.assertEqual(sorted([owner[data] for data in first]), [0, 1])
+        self.assertNotEqual(owner[first[0]], owner[second[0]])
+        
+        # acknowledgements go to the shard that reserved the message
+        reserved = queue.reserve_many(4, 10)
+        self.assertEqual(len(reserved), 4)
+        for data in reserved:
+            queue.ack(data)
+        now = datetime.datetime.now() + datetime.timedelta(seconds=20)
+        self.assertEqual(queue.requeue_expired(now), 0)
+        self.assertEqual(len(queue), 0)
+    
+    @unittest.skipUnless(redis_running(), 'redis is not running')
+    def test_redis_queue(self):
+        queue = RedisQueue('testqueue.redis', REDIS_CONNECTION)
+        queue.flush()
+        
+        try:
+            # messages are read highest priority first, in the order written
+            queue.write('low', PRIORITY_LOW)
+            queue.write_many(['a', 'b'])
+            queue.write('high', PRIORITY_HIGH)
+            self.assertEqual(len(queue), 4)
+            self.assertEqual(queue.read_many(3), ['high', 'a', 'b'])
+            self.assertEqual(queue.read(), 'low')
+            self.assertEqual(queue.read_many(5), [])
+            
+            # scheduled messages are held until promoted, onto the list for
+            # their priority
+            now = datetime.datetime.now()
+            queue.schedule('later', now + datetime.timedelta(seconds=60))
+            queue.schedule('sooner', now)
+            queue.schedule('urgent', now, PRIORITY_HIGH)
+            self.assertEqual(queue.promote(now, 1), 1)
+            self.assertEqual(queue.promote(now, 10), 1)
+            self.assertEqual(queue.read_many(5), ['urgent', 'sooner'])
+            self.assertEqual(queue.promote(now + datetime.timedelta(seconds=61), 10), 1)
+            self.assertEqual(queue.read(), 'later')
+            
+            # reserved messages come back unless they are acknowledged
+            queue.write('r1')
+            queue.write('r2', PRIORITY_HIGH)
+            self.assertEqual(queue.reserve_many(2, 10), ['r2', 'r1'])
+            self.assertEqual(len(queue), 0)
+            queue.ack('r1')
+            self.assertEqual(queue.requeue_expired(now), 0)
+            self.assertEqual(queue.requeue_expired(now + datetime.timedelta(seconds=20)), 1)
+            self.assertEqual(queue.conn.llen(queue.processing_key), 0)
+            self.assertEqual(queue.read_many(5), ['r2'])
+            
+            self.assertEqual(queue.claim_unique('k', 'a', 10), 'a')
+            self.assertEqual(queue.claim_unique('k', 'b', 10), 'a')
+            self.assertTrue(queue.acquire_lease('l', 'a', 10))
+            self.assertFalse(queue.acquire_lease('l', 'b', 10))
+            self.assertTrue(queue.acquire_lease('l', 'a', 10))
+        finally:
+            queue.flush()
+            queue.conn.delete('%s.unique.k' % queue.queue_name, '%s.lease.l' % queue.queue_name)
+    
+    @unittest.skipUnless(redis_running(), 'redis is not running')
+    def test_redis_blocking_queue(self):
+        queue = RedisBlockingQueue('testqueue.redis', REDIS_CONNECTION)
+        queue.flush()
+        
+        try:
+            # a reservation waits for a message to be written
+            threading.Timer(.05, queue.write, ('late',)).start()
+            start = time.time()
+            self.assertEqual(queue.reserve_many(5, 10), ['late'])
+            self.assertTrue(time.time() - start < 1)
+            
+            member, = queue.conn.lrange(queue.processing_key, 0, -1)
+            self.assertTrue(member.endswith(':%s:late' % PRIORITY_NORMAL))
+            queue.ack('late')
+            self.assertEqual(queue.conn.llen(queue.processing_key), 0)
+            
+            # a bare message stamped by requeue_expired before the blocking
+            # reservation could stamp it keeps a single deadline
+            queue.conn.lpush(queue.processing_key, 'bare')
+            self.assertEqual(queue.requeue_expired(datetime.datetime.now()), 0)
+            member = '%r:%s:bare' % (time.time() + 10, PRIORITY_NORMAL)
+            self.assertEqual(queue._stamp(keys=[queue.processing_key], args=['bare', member]), 1)
+            self.assertEqual(queue.conn.lrange(queue.processing_key, 0, -1), [member])
+            self.assertEqual(queue._stamp(keys=[queue.processing_key], args=['gone', member]), 0)
+        finally:
+            queue.flush()
+    
+    @unittest.skipUnless(redis_running(), 'redis is not running')
+    def test_redis_result_store(self):
+        store = RedisResultStore('testqueue', REDIS_CONNECTION, 60)
+        self.assertEqual(store.get('t1'), EmptyResult)
+        
+        try:
+            # waiting blocks until the result is stored, and leaves it there
+            threading.Timer(.05, store.put, ('t1', {'a': 1})).start()
+            start = time.time()
+            self.assertEqual(store.wait('t1', 5), {'a': 1})
+            self.assertTrue(time.time() - start < 1)
+            self.assertEqual(store.get('t1'), {'a': 1})
+            self.assertTrue(0 < store.conn.ttl(store.key('t1')) <= 60)
+            
+            store.put('t2', None)
+            self.assertEqual(store.wait('t2', 1), None)
+            self.assertEqual(store.wait('t3', .1), EmptyResult)
+        finally:
+            store.conn.delete(store.key('t1'), store.key('t2'))
+    
+    def test_handle_failure_without_dead_letter_queue(self):
+        # a command out of retries is dropped rather than crashing the worker
+        queue = MemoryQueue('testqueue.memory', None)
+        command = always_fails_class()(((), {}))
+        command.attempt = command.retries
+        self.assertEqual(Invoker(queue).handle_failure(command), 'dead')
+        self.assertEqual(len(queue), 0)
+    
+    def test_memory_queue_workers(self):
+        dead = MemoryQueue('testqueue.memory.dead', None)
+        memory_invoker = Invoker(MemoryQueue('testqueue.memory', '2'), dead_letter_queue=dead)
+        self.assertEqual(len(memory_invoker.queue._threads), 2)
+        
+        # the embedded workers execute commands, retrying them if they fail
+        del flaky_calls[:]
+        klass = registry._registry['djutils.tests.queue.queuecmd_flaky_command']
+        memory_invoker.enqueue(klass(((1,), {})))
+        memory_invoker.queue.write('djutils.tests.queue.Missing:')
+        
+        start = time.time()
+        while (len(flaky_calls) < 2 or not len(dead)) and time.time() - start < 5:
+            time.sleep(.01)
+        self.assertEqual(len(flaky_calls), 2)
+        self.assertEqual(dead.read(), 'djutils.tests.queue.Missing:')
+        self.assertEqual(len(invoker.queue), 0)
+        
+        memory_invoker.queue.stop_consumer()
+        self.assertEqual(memory_invoker.queue._threads, [])
+        
+        # messages are buried whatever stops them being decoded, and a failure
+        # to bury one is logged rather than raised
+        poison = '@1:e=b64,s=pickle:djutils.tests.queue.UserCommand:!!!notbase64'
+        memory_invoker.queue.execute_message(memory_invoker, poison)
+        self.assertEqual(dead.read(), poison)
+        
+        def broken_write(message):
+            raise IOError('disk full')
+        dead.write = broken_write
+        memory_invoker.queue.execute_message(memory_invoker, poison)
+        self.assertEqual(len(dead), 0)
+    
+    def test_file_queue(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            queue = FileQueue('testqueue', tmp_dir)
+            queue.segment_size = 64
+            for log in queue.logs.values():
+                log.segment_size = 64
+            self.assertEqual(queue.read(), None)
+            
+            # messages are read highest priority first, in the order written
+            queue.write('low', PRIORITY_LOW)
+            queue.write_many(['message-0', 'message-1'])
+            for i in range(2, 10):
+                queue.write('message-%d' % i)
+            queue.write('high', PRIORITY_HIGH)
+            self.assertEqual(len(queue), 12)
+            self.assertEqual(queue.read_many(3), ['high', 'message-0', 'message-1'])
+            
+            # the messages were spread over several segments, the ones that
+            # have been read are removed
+            log = queue.logs[PRIORITY_NORMAL]
+            self.assertTrue(len(log.segments()) > 1)
+            queue.read_many(4)
+            self.assertNotEqual(log.segments()[0], '%016x.seg' % 0)
+            
+            # a new instance, as after a restart, carries on from the checkpoint
+            # and recovers a record that was only partly written
+            fh = open(log.segment_path(log.segments()[-1]), 'ab')
+            fh.write('\x00\x00\x01\x00torn')
+            fh.close()
+            
+            queue = FileQueue('testqueue', tmp_dir)
+            queue.write('after')
+            self.assertEqual(len(queue), 6)
+            self.assertEqual(queue.read_many(10), ['message-6', 'message-7', 'message-8', 'message-9', 'after', 'low'])
+            self.assertEqual(queue.read_many(10), [])
+            
+            # a process that already has the segment open does not append
+            # after a record another process left partly written
+            queue.write('before')
+            log = queue.logs[PRIORITY_NORMAL]
+            fh = open(log.segment_path(log._tail[0]), 'ab')
+            fh.write('\x00\x00\x01\x00torn')
+            fh.close()
+            queue.write('after')
+            self.assertEqual(queue.read_many(10), ['before', 'after'])
+            
+            # scheduled messages are held until promoted
+            now = datetime.datetime.now()
+            queue.schedule('later', now + datetime.timedelta(seconds=60))
+            queue.schedule('sooner', now, PRIORITY_HIGH)
+            queue.schedule('also', now)
+            self.assertEqual(queue.promote(now, 1), 1)
+            self.assertEqual(queue.promote(now, 10), 1)
+            self.assertEqual(queue.promote(now, 10), 0)
+            self.assertEqual(queue.read_many(10), ['sooner', 'also'])
+            
+            # scheduled messages are synced in batches too
+            queue._unsynced_schedules = 0
+            queue._schedule_synced_at = time.time()
+            queue.schedule('unsynced', now + datetime.timedelta(seconds=60))
+            self.assertEqual(queue._unsynced_schedules, 1)
+            queue._schedule_synced_at -= queue.sync_interval
+            queue.sync()
+            self.assertEqual(queue._unsynced_schedules, 0)
+            
+            # writes that are not yet synced are synced once the interval has
+            # passed, without waiting for more messages
+            log = queue.logs[PRIORITY_NORMAL]
+            log.sync_every = 100
+            log._unsynced_writes = 0
+            log._synced_at = time.time()
+            queue.write('unsynced')
+            self.assertEqual(log._unsynced_writes, 1)
+            queue.sync()
+            self.assertEqual(log._unsynced_writes, 1)
+            log._synced_at -= log.sync_interval
+            queue.sync()
+            self.assertEqual(log._unsynced_writes, 0)
+            self.assertEqual(queue.read(), 'unsynced')
+            
+            queue.write('x')
+            queue.flush()
+            self.assertEqual(len(queue), 0)
+            self.assertEqual(queue.promote(now + datetime.timedelta(seconds=120), 10), 0)
+            
+            # the queue can be used by an invoker like any other backend
+            file_invoker = Invoker(queue)
+            file_invoker.enqueue(UserCommand((self.dummy, self.dummy.email, 'file@example.com')))
+            self.assertEqual(len(queue), 1)
+            file_invoker.dequeue()
+            self.assertEqual(User.objects.get(username='username').email, 'file@example.com')
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def test_daemon_prefetch(self):
+        self.consumer_options['prefetch'] = 2
+        daemon = TestQueueDaemon(self.consumer_options)
+        daemon.initialize_threads()
+        daemon.start_workers()
+        
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        user_command(self.dummy, 'first@example.com')
+        user_command(other, 'second@example.com')
+        user_command(self.dummy, 'third@example.com')
+        
+        # the first two messages are pulled off the queue together
+        daemon.process_message()
+        self.assertEqual(len(invoker.queue), 1)
+        self.assertEqual(User.objects.get(username='username').email, 'first@example.com')
+        self.assertEqual(User.objects.get(username='other').email, 'second@example.com')
+        
+        daemon.process_message()
+        self.assertEqual(len(invoker.queue), 0)
+        self.assertEqual(User.objects.get(username='username').email, 'third@example.com')
+    
+    def test_daemon_promote_scheduled(self):
+        daemon = TestQueueDaemon(self.consumer_options)
+        
+        past = datetime.datetime.now() - datetime.timedelta(seconds=10)
+        for i in range(5):
+            user_command.schedule(args=(self.dummy, 'u%d@example.com' % i), eta=past)
+        user_command.schedule(args=(self.dummy, 'future@example.com'), countdown=60)
+        
+        # due messages are promoted in batches until none remain
+        self.assertEqual(daemon.promote_scheduled(batch_size=2), 5)
+        self.assertEqual(len(invoker.queue), 5)
+        self.assertEqual(daemon.promote_scheduled(batch_size=2), 0)
+    
     def test_daemon_multithreading(self):
-        pass
+        self.consumer_options['prefetch'] = 3
+        self.consumer_options['window'] = 2
+        daemon = ThreadedTestQueueDaemon(self.consumer_options)
+        daemon.initialize_threads()
+        daemon.start_workers()
+        
+        del blocking_started[:]
+        blocking_release.clear()
+        blocking_command.map([(1,), (2,), (3,)])
+        
+        # only two messages fit in the window, they are both dispatched
+        # without waiting on one another
+        daemon.process_message()
+        self.assertEqual(len(invoker.queue), 1)
+        
+        start = time.time()
+        while len(blocking_started) < 2 and time.time() - start < 2:
+            time.sleep(.01)
+        self.assertEqual(sorted(blocking_started), [1, 2])
+        self.assertEqual(daemon._in_flight, 2)
+        
+        # once the workers finish, the window frees up for the last message
+        blocking_release.set()
+        daemon.process_message()
+        daemon._queue.join()
+        
+        self.assertEqual(sorted(blocking_started), [1, 2, 3])
+        self.assertEqual(len(invoker.queue), 0)
+        self.assertEqual(daemon._in_flight, 0)
+    
+    def test_daemon_processes(self):
+        self.consumer_options['processes'] = 2
+        self.consumer_options['prefetch'] = 4
+        daemon = TestQueueDaemon(self.consumer_options)
+        self.assertEqual(daemon.window, 6)
+        
+        tmp_dir = tempfile.mkdtemp()
+        filename = os.path.join(tmp_dir, 'pids')
+        try:
+            daemon.initialize_pool()
+            
+            write_pid.map([(filename,)] * 4)
+            daemon.process_message()
+            self.assertEqual(len(invoker.queue), 0)
+            
+            daemon._pool.close()
+            daemon._pool.join()
+            
+            # the commands were executed by the worker processes
+            pids = open(filename).read().split()
+            self.assertEqual(len(pids), 4)
+            self.assertFalse(str(os.getpid()) in pids)
+            self.assertEqual([status for status, tb in daemon.reports], ['ok'] * 4)
+            self.assertEqual(daemon._in_flight, 0)
+            self.assertFalse(daemon._error.is_set())
+        finally:
+            shutil.rmtree(tmp_dir)
+        
+        # failures in the worker processes are reported back to the parent
+        daemon.initialize_pool()
+        raise_queue_exception()
+        daemon.process_message()
+        daemon._pool.close()
+        daemon._pool.join()
+        
+        self.assertEqual([status for status, tb in daemon.reports], ['warn'])
+        self.assertTrue('QueueException: skip me' in daemon.reports[-1][1])
+        self.assertFalse(daemon._error.is_set())
+        
+        # messages that cannot be decoded are reported back and free their
+        # slots -- the workers cannot bury them while the test holds the
+        # database locked
+        daemon.initialize_pool()
+        invoker.write_many(['@1:e=b64,s=pickle:djutils.tests.queue.UserCommand:!!!notbase64'] * 3)
+        daemon.process_message()
+        daemon._pool.close()
+        daemon._pool.join()
+        
+        self.assertEqual(len(daemon.reports), 3)
+        self.assertTrue('TypeError: Incorrect padding' in daemon.reports[0][1])
+        self.assertEqual(daemon._in_flight, 0)
+    
+    @unittest.skipIf(gevent is None, 'gevent is not installed')
+    def test_daemon_greenlets(self):
+        self.consumer_options['greenlets'] = 10
+        self.consumer_options['prefetch'] = 10
+        daemon = TestQueueDaemon(self.consumer_options)
+        daemon.initialize_greenlets()
+        
+        cooperative_sleep.map([(.1,)] * 10)
+        
+        start = time.time()
+        daemon.process_message()
+        daemon._pool.join()
+        end = time.time()
+        
+        # the commands all ran concurrently on the event loop
+        self.assertTrue(end - start < .5)
+        self.assertEqual(len(invoker.queue), 0)
+        self.assertEqual(daemon._in_flight, 0)
+    
+    def test_greenlets_requested(self):
+        # gevent only patches the standard library for a non-zero count
+        self.assertTrue(greenlets_requested(['--greenlets=10']))
+        self.assertTrue(greenlets_requested(['-f', '--greenlets', '10']))
+        self.assertTrue(greenlets_requested(['-g10']))
+        self.assertTrue(greenlets_requested(['-g', '10', 'start']))
+        self.assertFalse(greenlets_requested(['--greenlets=0']))
+        self.assertFalse(greenlets_requested(['-g', '0']))
+        self.assertFalse(greenlets_requested(['-t', '4', 'start']))
     
     def test_daemon_periodic_commands(self):
         pass
@@ -377,5 +1712,258 @@ class QueueTest(TestCase):
     def test_daemon_worker_exception(self):
         pass
     
+    def test_daemon_retries(self):
+        daemon = TestQueueDaemon(self.consumer_options)
+        daemon.initialize_threads()
+        
+        # fails twice, then succeeds on the last retry
+        del flaky_calls[:]
+        flaky_command(2)
+        
+        daemon.process_message()
+        self.assertEqual(len(flaky_calls), 1)
+        self.assertEqual(len(invoker.queue), 1)
+        
+        daemon.process_message()
+        daemon.process_message()
+        self.assertEqual(len(flaky_calls), 3)
+        self.assertEqual(len(invoker.queue), 0)
+        self.assertEqual(len(invoker.dead_letter_queue), 0)
+        self.assertFalse(daemon._error.is_set())
+    
+    def test_daemon_retry_backoff(self):
+        daemon = TestQueueDaemon(self.consumer_options)
+        daemon.initialize_threads()
+        
+        always_fails()
+        now = datetime.datetime.now()
+        
+        # the first retry is scheduled after the retry delay
+        daemon.process_message()
+        self.assertEqual(len(invoker.queue), 0)
+        self.assertEqual(invoker.promote_scheduled(now + datetime.timedelta(seconds=5)), 0)
+        self.assertEqual(invoker.promote_scheduled(now + datetime.timedelta(seconds=11)), 1)
+        
+        # the second after the delay multiplied by the backoff factor
+        daemon.process_message()
+        self.assertEqual(invoker.promote_scheduled(now + datetime.timedelta(seconds=25)), 0)
+        self.assertEqual(invoker.promote_scheduled(now + datetime.timedelta(seconds=31)), 1)
+        
+        # out of retries, the message is moved to the dead letter queue
+        daemon.process_message()
+        self.assertEqual(len(invoker.queue), 0)
+        self.assertEqual(len(invoker.dead_letter_queue), 1)
+        self.assertFalse(daemon._error.is_set())
+        
+        # messages that cannot be loaded go to the dead letter queue as well,
+        # whatever the reason they cannot be decoded
+        invoker.write('djutils.tests.queue.Missing:')
+        daemon.process_message()
+        self.assertEqual(len(invoker.dead_letter_queue), 2)
+        
+        invoker.write('@1:e=b64,s=pickle:djutils.tests.queue.UserCommand:!!!notbase64')
+        daemon.process_message()
+        self.assertEqual(len(invoker.dead_letter_queue), 3)
+        self.assertEqual(daemon.reports[-1][0], 'invalid')
+        self.assertEqual(daemon._in_flight, 0)
+        
+        # replaying moves the loadable messages back with their retries reset
+        self.assertEqual(invoker.replay_dead_letters(), 1)
+        self.assertEqual(len(invoker.dead_letter_queue), 2)
+        
+        command = registry.get_command_for_message(invoker.read())
+        self.assertTrue(isinstance(command, always_fails_class()))
+        self.assertEqual(command.attempt, 0)
+    
+    def test_daemon_acks(self):
+        invoker.acks = True
+        daemon = TestQueueDaemon(self.consumer_options)
+        daemon.initialize_threads()
+        
+        user_command(self.dummy, 'acked@example.com')
+        always_fails()
+        invoker.write('djutils.tests.queue.Missing:')
+        
+        # executed, retried and invalid messages are all acknowledged
+        daemon.process_message()
+        daemon.process_message()
+        daemon.process_message()
+        self.assertEqual([status for status, tb in daemon.reports], ['ok', 'retry', 'invalid'])
+        self.assertEqual(User.objects.get(username='username').email, 'acked@example.com')
+        self.assertEqual(QueueMessage.objects.filter(queue=invoker.queue.name).count(), 1)
+        self.assertEqual(QueueMessage.objects.filter(claim__isnull=False).count(), 0)
+    
+    def test_monotonic_clock(self):
+        # the timers are not tied to the system time, which can be changed
+        self.assertNotEqual(clock, time.time)
+        self.assertTrue(abs(clock() - time.time()) > 60)
+        
+        start = clock()
+        time.sleep(.05)
+        self.assertTrue(.04 < clock() - start < .5)
+    
+    def test_rate_limits(self):
+        self.assertEqual(parse_rate('100/m'), (100, 60))
+        self.assertRaises(QueueException, parse_rate, '100/fortnight')
+        self.assertRaises(QueueException, queue_command, rate_limit='lots')
+        
+        # bursts up to the capacity, then one token every 'period / capacity'
+        bucket = TokenBucket(2, 10)
+        bucket.updated = 0
+        self.assertEqual(bucket.consume(0), 0)
+        self.assertEqual(bucket.consume(0), 0)
+        self.assertEqual(bucket.consume(1), 4)
+        self.assertEqual(bucket.consume(5), 0)
+        
+        # commands at their max concurrency wait for a running one to finish
+        throttle = Throttle()
+        klass = one_at_a_time_class()
+        self.assertEqual(throttle.acquire(klass), 0)
+        self.assertEqual(throttle.acquire(klass), throttle.concurrency_wait)
+        throttle.release(klass)
+        self.assertEqual(throttle.acquire(klass), 0)
+    
+    def test_daemon_throttling(self):
+        self.consumer_options['prefetch'] = 3
+        daemon = TestQueueDaemon(self.consumer_options)
+        daemon.initialize_threads()
+        
+        del rate_limited_calls[:]
+        rate_limited(1)
+        rate_limited(2)
+        user_command(self.dummy, 'unlimited@example.com')
+        
+        # the throttled message is held back without holding up the others
+        daemon.process_message()
+        self.assertEqual(rate_limited_calls, [1])
+        self.assertEqual(User.objects.get(username='username').email, 'unlimited@example.com')
+        self.assertEqual(len(daemon._deferred), 1)
+        self.assertEqual(daemon._in_flight, 0)
+        
+        # it is dispatched once its wait is over
+        ready_at, message, klass, deadline = daemon._deferred[0]
+        self.assertEqual(registry.get_class_for_message(message), klass)
+        self.assertTrue(0 < daemon.get_deferred_wait() <= 3600)
+        daemon._deferred[0] = (0, message, klass, deadline)
+        daemon.throttle._buckets[klass].tokens = 1
+        daemon.process_message()
+        self.assertEqual(rate_limited_calls, [1, 2])
+        self.assertEqual(daemon._deferred, [])
+        
+        # once the window is full of deferred messages no more are read
+        daemon.window = 1
+        rate_limited(3)
+        rate_limited(4)
+        daemon.process_message()
+        self.assertEqual(len(daemon._deferred), 1)
+        self.assertEqual(len(invoker.queue), 1)
+        
+        daemon.process_message()
+        self.assertEqual(rate_limited_calls, [1, 2])
+        self.assertEqual(len(daemon._deferred), 1)
+        self.assertEqual(len(invoker.queue), 1)
+        self.assertEqual(QueueMessage.objects.filter(scheduled_at__isnull=False).count(), 0)
+    
+    def test_daemon_throttling_acks(self):
+        invoker.acks = True
+        invoker.visibility_timeout = 10
+        daemon = TestQueueDaemon(self.consumer_options)
+        daemon.initialize_threads()
+        
+        # a message that would be held past its visibility timeout is left
+        # reserved, rather than being written to the queue a second time
+        del rate_limited_calls[:]
+        rate_limited(1)
+        rate_limited(2)
+        try:
+            daemon.process_message()
+            daemon.process_message()
+        finally:
+            invoker.visibility_timeout = 300
+        
+        self.assertEqual(rate_limited_calls, [1])
+        self.assertEqual(daemon._deferred, [])
+        self.assertEqual(QueueMessage.objects.count(), 1)
+        self.assertEqual(QueueMessage.objects.filter(claim__isnull=False).count(), 1)
+        
+        # and is delivered again once its reservation expires
+        later = datetime.datetime.now() + datetime.timedelta(seconds=20)
+        self.assertEqual(invoker.requeue_expired(later), 1)
+        self.assertEqual(QueueMessage.objects.filter(claim__isnull=False).count(), 0)
+        
+        # a blocking read gives up in time for deferred messages
+        queue = MemoryQueue('testqueue.memory', None)
+        start = time.time()
+        self.assertEqual(Invoker(queue).read_many(1, .05), [])
+        self.assertTrue(time.time() - start < .5)
+    
+    def test_metrics(self):
+        metrics = invoker.metrics
+        metrics.flush(minute=0)
+        
+        add_path = 'djutils.tests.queue.queuecmd_add'
+        user_path = registry.command_to_string(UserCommand)
+        
+        add(1, 2)
+        add(3, 4)
+        invoker.enqueue(UserCommand((self.dummy, 'a@example.com', 'b@example.com')))
+        throw_error()
+        
+        daemon = TestQueueDaemon(self.consumer_options)
+        daemon.initialize_threads()
+        daemon.process_message()
+        daemon.process_message()
+        
+        metrics.flush(minute=1)
+        totals = metrics.get_minute([add_path, user_path], minute=1)
+        self.assertEqual(totals[add_path]['enqueued'], 2)
+        self.assertEqual(totals[add_path]['executed'], 2)
+        self.assertEqual(totals[add_path]['waited'], 2)
+        self.assertEqual(totals[add_path]['failed'], 0)
+        self.assertEqual(sum(totals[add_path]['exec']), 2)
+        self.assertEqual(totals[user_path]['enqueued'], 1)
+        self.assertEqual(totals[user_path]['executed'], 0)
+        
+        # failures are counted per command class
+        throw_path = 'djutils.tests.queue.queuecmd_throw_error'
+        daemon.process_message()
+        daemon.process_message()
+        metrics.flush(minute=1)
+        totals = metrics.get_minute([throw_path, user_path], minute=1)
+        self.assertEqual(totals[throw_path]['executed'], 1)
+        self.assertEqual(totals[throw_path]['failed'], 1)
+        self.assertEqual(totals[user_path]['executed'], 1)
+        
+        # totals from other minutes are kept apart
+        self.assertEqual(metrics.get_minute([add_path], minute=2)[add_path]['executed'], 0)
+        
+        # latencies are recorded in histograms
+        metrics.flush(minute=0)
+        for ms in (1, 2, 3, 40, 2000):
+            metrics.record_execution(add_path, 'ok', None, ms / 1000.)
+        metrics.flush(minute=3)
+        exec_buckets = metrics.get_minute([add_path], minute=3)[add_path]['exec']
+        self.assertEqual(metrics_percentile(exec_buckets, 50), 5)
+        self.assertEqual(metrics_percentile(exec_buckets, 80), 50)
+        self.assertEqual(metrics_percentile(exec_buckets, 95), 2500)
+        self.assertEqual(metrics_percentile([0] * len(exec_buckets), 95), None)
+        
+        # counts are written to the minute they were recorded in, not the
+        # minute they happen to be flushed in
+        metrics = QueueMetrics('metrics-test')
+        metrics.record_enqueue(add_path)
+        recorded = metrics._pending.keys()[0]
+        metrics._pending[7] = metrics._pending.pop(recorded)
+        metrics.record_enqueue(add_path, 2)
+        metrics.flush()
+        self.assertEqual(metrics.get_minute([add_path], minute=7)[add_path]['enqueued'], 1)
+        self.assertEqual(metrics.get_minute([add_path], minute=recorded)[add_path]['enqueued'], 2)
+        
+        # and are written at the end of each request
+        metrics.record_enqueue(add_path)
+        request_finished.send(sender=None)
+        self.assertEqual(metrics._pending, {})
+        self.assertEqual(metrics.get_minute([add_path], minute=recorded)[add_path]['enqueued'], 3)
+    
     def test_daemon_periodic_thread_exception(self):
         pass